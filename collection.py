@@ -0,0 +1,317 @@
+# Copyright (C) 2018-2021 Teemu Ikonen <tpikonen@gmail.com>
+
+# This file is part of Taival.
+# Taival is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License version 3 as published by the
+# Free Software Foundation. See the file COPYING for license text.
+
+# Versioned on-disk store for collected data.
+#
+# A collection is an SQLite file with a 'meta' table holding the schema
+# version and the kind of the collection, and a 'records' table of pickled
+# values keyed by (section, key). Large dicts in the collected data, like the
+# lines of a mode or the stops, are stored with one record per item, so that
+# reports can load only the items they need. Other values are stored in
+# section '' under their top level key.
+
+import datetime, json, logging, pickle, sqlite3
+from collections import defaultdict
+from collections.abc import Mapping
+import overpy
+import osm
+
+log = logging.getLogger(__name__)
+
+schema_version = 1
+
+schema = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS records (section TEXT, key TEXT, value BLOB,
+    PRIMARY KEY (section, key));
+"""
+
+# Top level keys of collected dicts stored with one record per item, by
+# collection kind. A key ending in '/*' is a dict of dicts, where each
+# inner dict is a section of its own.
+indexed_sections = {
+    "routes": [ "lines" ],
+    "stops": [ "ost", "rst", "pst/*", "pcl" ],
+    "stations": [],
+    "citybikes": [ "ocbs", "orest", "pcbs" ],
+}
+
+sqlite_magic = b"SQLite format 3\x00"
+
+
+def collection_kind(d):
+    """Return the collection kind of a collected dict from its keys."""
+    if "lines" in d.keys():
+        return "routes"
+    elif "ost" in d.keys():
+        return "stops"
+    elif "ostat" in d.keys():
+        return "stations"
+    elif "ocbs" in d.keys():
+        return "citybikes"
+    else:
+        return None
+
+
+# Keys of route line dicts computed when collecting, so that reports can
+# be made without network access
+route_line_keys = [ "osmshapes", "osmgaps", "osmplatforms", "osmstopcounts" ]
+
+
+def stale_lines(d, linerefs=None):
+    """Return a list of refs of lines in route data d, all or those in
+    linerefs, which have OSM routes but lack some of route_line_keys,
+    because they were collected with an older version."""
+    lines = d["lines"]
+    return [ r for r in (linerefs if linerefs is not None else lines.keys())
+        if "rels" in lines[r] and any(k not in lines[r] for k in route_line_keys) ]
+
+
+def is_collection(fname):
+    """Return True if fname is a collection store file (not a pickle)."""
+    with open(fname, "rb") as f:
+        return f.read(len(sqlite_magic)) == sqlite_magic
+
+
+class LazySection(Mapping):
+    """Read-only mapping of records in a collection section, loaded from
+    the store when accessed and cached."""
+
+    def __init__(self, store, section):
+        self.store = store
+        self.section = section
+        self.cache = {}
+        self._keys = None
+
+    def __getitem__(self, key):
+        if key not in self.cache:
+            self.cache[key] = self.store.get(self.section, key)
+        return self.cache[key]
+
+    def __contains__(self, key):
+        return key in self.cache or self.store.has(self.section, key)
+
+    def keys(self):
+        if self._keys is None:
+            self._keys = self.store.keys(self.section)
+        return self._keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def load_all(self):
+        """Load all records of the section to the cache with one query."""
+        if self._keys is not None and len(self.cache) == len(self._keys):
+            return
+        keys = []
+        for k, v in self.store.records(self.section):
+            keys.append(k)
+            if k not in self.cache:
+                self.cache[k] = v
+        self._keys = keys
+
+    def items(self):
+        self.load_all()
+        return [ (k, self.cache[k]) for k in self._keys ]
+
+    def values(self):
+        self.load_all()
+        return [ self.cache[k] for k in self._keys ]
+
+    def copy(self):
+        """Return a plain dict with all the records loaded."""
+        return dict(self.items())
+
+
+class CollectionStore:
+    """Collected data stored in an SQLite file."""
+
+    def __init__(self, fname, kind=None, create=False):
+        """Open an existing collection in fname, or create a new one of
+        kind, overwriting existing records, if create is True."""
+        self.fname = fname
+        self.conn = sqlite3.connect(fname)
+        if create:
+            self.conn.executescript(schema)
+            self.conn.execute("DELETE FROM records")
+            self.conn.execute("DELETE FROM meta")
+            self.set_meta("schema_version", schema_version)
+            self.set_meta("kind", kind)
+            self.set_meta("created", datetime.datetime.now().isoformat())
+            self.set_meta("complete", False)
+            self.conn.commit()
+        version = self.get_meta("schema_version")
+        if version is None:
+            raise ValueError(f"'{fname}' is not a collection file")
+        if version > schema_version:
+            raise ValueError(f"Collection file '{fname}' has schema version {version}, only versions up to {schema_version} are supported")
+        self.kind = self.get_meta("kind")
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def get_meta(self, key, default=None):
+        try:
+            row = self.conn.execute("SELECT value FROM meta WHERE key=?",
+                (key,)).fetchone()
+        except sqlite3.DatabaseError:
+            return default
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+            (key, json.dumps(value)))
+
+    def put(self, section, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO records VALUES (?, ?, ?)",
+            (section, json.dumps(key), pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+
+    def get(self, section, key):
+        row = self.conn.execute(
+            "SELECT value FROM records WHERE section=? AND key=?",
+            (section, json.dumps(key))).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return pickle.loads(row[0])
+
+    def has(self, section, key):
+        return self.conn.execute(
+            "SELECT 1 FROM records WHERE section=? AND key=?",
+            (section, json.dumps(key))).fetchone() is not None
+
+    def keys(self, section):
+        """Return a list of keys in section, in insertion order."""
+        rows = self.conn.execute(
+            "SELECT key FROM records WHERE section=? ORDER BY rowid",
+            (section,)).fetchall()
+        return [ json.loads(r[0]) for r in rows ]
+
+    def records(self, section):
+        """Iterate (key, value) pairs in section, in insertion order."""
+        rows = self.conn.execute(
+            "SELECT key, value FROM records WHERE section=? ORDER BY rowid",
+            (section,))
+        for k, v in rows:
+            yield json.loads(k), pickle.loads(v)
+
+    def delete_section(self, section):
+        self.conn.execute("DELETE FROM records WHERE section=?", (section,))
+
+    def sections(self):
+        rows = self.conn.execute("SELECT DISTINCT section FROM records")
+        return [ r[0] for r in rows.fetchall() ]
+
+    def save(self, d):
+        """Store a collected dict d and mark the collection complete."""
+        for k, v in d.items():
+            if k in indexed_sections.get(self.kind, []):
+                self.delete_section(k)
+                for kk, vv in v.items():
+                    self.put(k, kk, vv)
+            elif k + "/*" in indexed_sections.get(self.kind, []):
+                self.put("", k + "/*", list(v.keys()))
+                for kk, vv in v.items():
+                    self.delete_section(k + "/" + kk)
+                    for kkk, vvv in vv.items():
+                        self.put(k + "/" + kk, kkk, vvv)
+            else:
+                self.put("", k, v)
+        self.set_meta("complete", True)
+        self.conn.commit()
+
+    def load(self):
+        """Return the collected dict, with indexed sections as
+        LazySection mappings which load records on access."""
+        if not self.get_meta("complete", True):
+            log.warning(f"Collection '{self.fname}' is incomplete, resume the collect to complete it")
+        d = {}
+        for k in self.keys(""):
+            if k.endswith("/*"):
+                name = k[:-2]
+                d[name] = defaultdict(dict, { kk: LazySection(self, name + "/" + kk)
+                    for kk in self.get("", k) })
+            else:
+                d[k] = self.get("", k)
+        for k in indexed_sections.get(self.kind, []):
+            if not k.endswith("/*"):
+                d[k] = LazySection(self, k)
+        return d
+
+
+class Collection(dict):
+    """Collected dict returned by load_collection(). Closing it closes the
+    store of its lazily loaded sections, it can also be used as a context
+    manager."""
+
+    def __init__(self, d, store=None):
+        super().__init__(d)
+        self.store = store
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def save_collection(fname, d):
+    """Write a collected dict d to a new collection file fname."""
+    store = CollectionStore(fname, collection_kind(d), create=True)
+    store.save(d)
+    store.close()
+
+
+def load_collection(fname, lazy=True):
+    """Return a Collection of collected data from a collection file fname,
+    with items of large sections loaded lazily, or all loaded to plain
+    dicts if lazy is False. Lazily loaded collections must be closed after
+    use. Old pickle files are also read, as a whole."""
+    if is_collection(fname):
+        store = CollectionStore(fname)
+        d = store.load()
+        if lazy:
+            return Collection(d, store)
+        for k, v in d.items():
+            if isinstance(v, LazySection):
+                d[k] = v.copy()
+            elif isinstance(v, defaultdict):
+                for kk, vv in v.items():
+                    if isinstance(vv, LazySection):
+                        v[kk] = vv.copy()
+        store.close()
+        return Collection(d)
+    log.warning(f"Reading '{fname}' as a pickle file, convert it with 'taival.py migrate'")
+    with open(fname, "rb") as f:
+        return Collection(pickle.load(f))
+
+
+def migrate(infile, outfile):
+    """Convert a pickle file from an earlier version to a collection file.
+    Return the collection kind."""
+    with open(infile, "rb") as f:
+        d = pickle.load(f)
+    kind = collection_kind(d)
+    if kind is None:
+        raise ValueError(f"Unrecognized data in pickle file '{infile}'")
+    if kind == "routes":
+        for lineref in stale_lines(d):
+            ld = d["lines"][lineref]
+            try:
+                ld.update(osm.route_member_values(ld["rels"]))
+            except overpy.exception.DataIncomplete as e:
+                raise ValueError(f"Route data in '{infile}' lacks OSM members of line {lineref} ({e}), collect the routes again")
+    save_collection(outfile, d)
+    return kind
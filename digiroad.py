@@ -8,7 +8,7 @@
 import csv
 import os
 import sys
-from collections import defaultdict
+import spatial
 
 _basedir = os.path.join(os.path.dirname(os.path.realpath(sys.argv[0])))
 datadir = './data/digiroad/'
@@ -24,13 +24,41 @@ datadir = './data/digiroad/'
 gtfs_stops_file = os.path.join(_basedir,
                                os.path.join(datadir, "./stops/HSL/stops.txt"))
 
+# Maximum distance in meters from an OSM stop to its Digiroad stop
+findr_radius = 50.0
+
+_stops = None
+_index = None
+
+
 def read_digiroad_stops(filename):
-    dialect = 'excel'
-    stopdict = defaultdict(list)
+    """Return a list of stop dicts from a GTFS stops.txt file."""
     with open(filename, 'r', encoding='utf-8-sig') as fi:
-        reader = csv.DictReader(fi)
-        for r in reader:
-            stopdict[r['stop_name']].append(r)
-    return stopdict
+        return list(csv.DictReader(fi))
+
+
+def get_stops():
+    """Return a list of Digiroad stops, read on the first call."""
+    global _stops
+    if _stops is None:
+        _stops = read_digiroad_stops(gtfs_stops_file)
+    return _stops
+
+
+def stop_index():
+    """Return a spatial.PointIndex of Digiroad stops, built on the first
+    call."""
+    global _index
+    if _index is None:
+        _index = spatial.PointIndex([ (float(s['stop_lat']), float(s['stop_lon']))
+            for s in get_stops() ])
+    return _index
+
 
-stops_by_name = read_digiroad_stops(gtfs_stops_file)
+def stops_near(latlons, radius=findr_radius, k=4):
+    """Return a list with a list of (dist, stop) tuples of at most k
+    Digiroad stops within radius meters, nearest first, for each point in
+    latlons."""
+    stops = get_stops()
+    return [ [ (d, stops[i]) for d, i in near ]
+        for near in stop_index().within(latlons, radius, k) ]
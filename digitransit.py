@@ -5,7 +5,7 @@
 # terms of the GNU Affero General Public License version 3 as published by the
 # Free Software Foundation. See the file COPYING for license text.
 
-import requests, json, logging, time
+import requests, json, logging, time, hashlib
 from collections import defaultdict
 
 # Obtain data from digitransit.fi GraphQL API
@@ -48,14 +48,41 @@ class RouteDict(dict):
         self.mode = mode
         self.dt_mode = mode_from_osm[mode]
         self.dt = dt
-        log.debug(f"Running RouteDict('{mode}') query...")
+        self._gtfsids = None
+        self._types = None
+
+    def _routes_query(self):
+        log.debug(f"Running RouteDict('{self.mode}') query...")
         query = """{routes(transportModes:[%s]) {
     shortName
     gtfsId
+    type
 }}""" % (self.dt_mode)
         r = self.dt.apiquery(query)
         data = json.loads(r.text)["data"]["routes"]
-        self.gtfsids = { d["shortName"]: d["gtfsId"] for d in data }
+        self._gtfsids = { d["shortName"]: d["gtfsId"] for d in data }
+        self._types = { d["shortName"]: d["type"] for d in data }
+
+    @property
+    def gtfsids(self):
+        """Dict of shortName -> gtfsId, queried on first access."""
+        if self._gtfsids is None:
+            self._routes_query()
+        return self._gtfsids
+
+    @property
+    def types(self):
+        """Dict of shortName -> GTFS route type, queried on first access."""
+        if self._types is None:
+            self._routes_query()
+        return self._types
+
+    def pattern(self, code):
+        """Return the pattern dict with a given pattern code. Only the route
+        of the pattern is queried, if not already cached."""
+        gtfsid = ":".join(code.split(":")[:2])
+        key = next(k for k, v in self.gtfsids.items() if v == gtfsid)
+        return next(p for p in self[key]["patterns"] if p["code"] == code)
 
     def do_apiquery(self, key):
         gtfsid = self.gtfsids.get(key, None)
@@ -159,23 +186,21 @@ class Digitransit:
         """
         Make a graphql query via requests.
         """
-        ok = False
-        tries = 0
         sleeptime = 10
-        while tries < max_tries:
+        for tries in range(max_tries):
             try:
-                tries += 1
                 r = requests.post(url=self.url, data=query, headers=self.headers)
                 r.raise_for_status()
+                break
             except (requests.exceptions.ConnectionError,
               requests.exceptions.HTTPError) as e:
-                log.warning(f"Digitransit API query failed, waiting {sleeptime} secs and retrying...")
-                time.sleep(sleeptime)
-            finally:
-                if r.status_code == requests.codes.ok:
-                    break
-        if tries >= max_tries:
+                err = e
+                if tries < max_tries - 1:
+                    log.warning(f"Digitransit API query failed, waiting {sleeptime} secs and retrying...")
+                    time.sleep(sleeptime)
+        else:
             log.error(f"Failed to get a response from Digitransit API after {max_tries} attempts.")
+            raise err
         r.encoding = 'utf-8'
         return r
 
@@ -200,6 +225,13 @@ class Digitransit:
         return self.routedicts[mode][lineref]
 
 
+    def route_fingerprint(self, lineref, mode):
+        """Return a hex digest of the cached route data, including all
+        patterns, for lineref."""
+        data = json.dumps(self.routedicts[mode][lineref], sort_keys=True)
+        return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
     def tags_query(self, lineref, mode):
         """
         Return a dict with tag-like info for a route with given lineref
@@ -361,9 +393,7 @@ class Digitransit:
         Return geometry from route cache for given pattern code as
         tuple (directionId, latlon).
         """
-        # FIXME needs a code -> pattern dict
-        rts = self.routedicts[mode]
-        pat = next(p for r in rts.values() for p in r["patterns"] if p["code"] == code)
+        pat = self.routedicts[mode].pattern(code)
         dirid = pat["directionId"] # int
         latlon = [[c["lat"], c["lon"]] for c in pat["geometry"]] \
           if ("geometry" in pat.keys() and pat["geometry"] is not None) else []
@@ -399,9 +429,7 @@ class Digitransit:
         Return platform tuple (lat, lon, code, name) from cached routes for
         a given pattern code as list.
         """
-        rts = self.routedicts[mode]
-        # FIXME: make a pattern dict from cached data
-        pat = next(p for r in rts.values() for p in r["patterns"] if p["code"] == code)
+        pat = self.routedicts[mode].pattern(code)
         stops = pat["stops"]
         return [(s["lat"], s["lon"], s.get("code", "<no code>"), s["name"]) for s in stops]
 
@@ -411,9 +439,10 @@ class Digitransit:
         URL points to a reittiopas page for the line."""
         rts = self.routedicts[mode]
         # Also filter out taxibuses (lähibussit) (type == 704)
-        refs = { k: gtfsid2url(r["gtfsId"]) for k, r in rts.items() if r["type"] != 704 }
-        self.taxibus_refs = \
-               { k: gtfsid2url(r["gtfsId"]) for k, r in rts.items() if r["type"] == 704 }
+        refs = { k: gtfsid2url(g) for k, g in rts.gtfsids.items()
+            if rts.types[k] != 704 }
+        self.taxibus_refs = { k: gtfsid2url(g) for k, g in rts.gtfsids.items()
+            if rts.types[k] == 704 }
         return refs
 
 
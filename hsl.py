@@ -6,7 +6,8 @@
 # Free Software Foundation. See the file COPYING for license text.
 
 import re
-from collections import defaultdict
+from collections import Counter, defaultdict
+from functools import lru_cache
 
 datadir = "./data/HSL"
 
@@ -187,15 +188,69 @@ synonyms = [
 # Sort to descending length of abbreviation
 synonyms.sort(key=lambda x: (len(x[0]), x[1], x[0]), reverse=True)
 
+
+def trie_regex(words):
+    """Return a regex pattern string matching any of words, as a trie of
+    nested groups, which prefers the longest match at a position."""
+    trie = {}
+    for w in words:
+        node = trie
+        for c in w:
+            node = node.setdefault(c, {})
+        node[""] = True
+    def pattern(node):
+        alts = [ re.escape(c) + pattern(n) for c, n in sorted(node.items()) if c ]
+        if not alts:
+            return ""
+        p = alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+        if "" in node:
+            p = "(?:" + p + ")?"
+        return p
+    return pattern(trie)
+
+
+# Full name -> list of its abbreviations in synonyms
+synonym_abbrs = defaultdict(list)
+for _abbr, _full in synonyms:
+    synonym_abbrs[_full].append(_abbr)
+# Full names are replaced when they end a word, so that suffixes of
+# compound words, like 'tie' in 'Kivitie', are abbreviated too. The
+# lookahead finds the longest full name starting at every position.
+synonym_full_re = re.compile(
+  r"(?=(" + trie_regex(synonym_abbrs.keys()) + r")(?!\w))")
+synonym_sub_res = { full: re.compile(re.escape(full) + r"(?!\w)")
+    for full in synonym_abbrs }
+
+
+@lru_cache(maxsize=1 << 16)
+def abbreviated_names(name):
+    """Return a frozenset of names, where one full name from hsl.synonyms
+    in name is replaced by one of its abbreviations."""
+    out = set()
+    for full in { m.group(1) for m in synonym_full_re.finditer(name) }:
+        for abbr in synonym_abbrs[full]:
+            out.add(synonym_sub_res[full].sub(abbr, name))
+    return frozenset(out)
+
+
+def names_match(osmname, hslname):
+    """Return True if the OSM name is equal to the HSL name, or if the HSL
+    name is an abbreviation of the OSM name. Abbreviated OSM names do not
+    match full HSL names."""
+    if osmname == hslname:
+        return True
+    if not osmname or not hslname:
+        return False
+    return hslname in abbreviated_names(osmname)
+
 def get_overpass_area(clist):
-    area = "("+ ' '.join(\
-      [ 'area[boundary=administrative][admin_level=8][name="{}"][ref={}];'\
-        .format(c, city2ref[c]) for c in clist ]) + ")->.hel;"
-    return area
+    """Return a tuple of (name, ref) tuples of cities in clist, to be used
+    as an area in the osm module."""
+    return tuple((c, city2ref[c]) for c in clist)
 
 overpass_area = get_overpass_area(cities)
 # Stops can also be in cities outside of HSL area
-overpass_stopref_area = get_overpass_area(set(prefix2city.values()))
+overpass_stopref_area = get_overpass_area(sorted(set(prefix2city.values())))
 
 
 def longname2stops(longname):
@@ -215,8 +270,25 @@ def longname2stops(longname):
     return stops
 
 
+def stop_namecounts(pst):
+    """Return a Counter of the names of provider stops in pst, a dict of
+    mode -> code -> stop dict."""
+    return Counter(ps["name"] for mdict in pst.values() for ps in mdict.values())
+
+
+def add_namecounts(pst):
+    """Set 'namecount' of provider stops in pst to the number of stops
+    with the same name, counted in one pass with stop_namecounts()."""
+    counts = stop_namecounts(pst)
+    for mdict in pst.values():
+        for ps in mdict.values():
+            ps["namecount"] = counts[ps["name"]]
+
+
 def get_stopname(ps):
-    """Return stop name composed from 'name' and 'platformCode' fields."""
+    """Return stop name composed from 'name' and 'platformCode' fields.
+    The number of stops with the same name is read from 'namecount', set
+    by add_namecounts()."""
     pname = ps.get("name", None)
     pplat = ps.get("platformCode", None)
     namecount = ps.get("namecount", None)
@@ -239,3 +311,13 @@ def normalize_helsinki_codes(dd, change_code=False):
                 dd[r]['code'] = newref
             dd[newref] = dd.pop(r)
 
+
+
+stopcode_re = re.compile("^X?([^0-9]*)[0-9]{4,4}$")
+
+def stopcode_city(code):
+    """Return the city of a stop from the prefix of its code, or None if
+    the code does not have a city prefix. Codes with an 'X' before the
+    prefix (temporary stops) are also recognized."""
+    m = stopcode_re.match(code)
+    return prefix2city.get(m.group(1), None) if m else None
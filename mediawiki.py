@@ -5,15 +5,13 @@
 # terms of the GNU Affero General Public License version 3 as published by the
 # Free Software Foundation. See the file COPYING for license text.
 
-import difflib, sys, logging
-import osm, hsl
+import difflib, sys, logging, hashlib, json
+import osm, hsl, spatial
 from util import *
 from digitransit import pattern2url, terminalid2url, citybike2url
 
 log = logging.getLogger(__name__)
 
-outfile = None
-
 style_problem = "background-color: #ffaaaa"
 style_ok = "background-color: #aaffaa"
 style_maybe = "background-color: #eeee00"
@@ -23,15 +21,179 @@ style_details = "background-color: #ffffff"
 # Match codes with last number '0'
 zerocodepat = re.compile("^..*0[^0-9]*$")
 
-def wr(*args, **kwargs):
-    kwargs["file"] = outfile
-    print(*args, **kwargs)
-
+class ReportWriter:
+    """Buffered writer for report output.
+
+    Text written with wr() is collected to a buffer, which is written to
+    file when it has more than flushsize characters, and in flush().
+    The file is closed on exit if closefile is True."""
+
+    def __init__(self, file, flushsize=1 << 16, closefile=False):
+        self.file = file
+        self.flushsize = flushsize
+        self.closefile = closefile
+        self.buf = []
+        self.size = 0
+
+    def wr(self, *args, sep=" ", end="\n"):
+        """Write args like print()."""
+        s = sep.join(str(a) for a in args) + end
+        self.buf.append(s)
+        self.size += len(s)
+        if self.size > self.flushsize:
+            self.flush()
+
+    def wr_if(self, s, **kwargs):
+        """Write s if it's not empty."""
+        if s:
+            self.wr(s, **kwargs)
+
+    def write(self, s):
+        """Write string s as is, like a file."""
+        self.wr(s, end="")
+
+    def flush(self):
+        self.file.write("".join(self.buf))
+        self.buf = []
+        self.size = 0
+
+    def page_full(self):
+        """Return True if the report should continue on a new page."""
+        return False
+
+    def new_page(self, label):
+        pass
 
-def wr_if(s, **kwargs):
-    """Write s if it's not empty."""
-    if s:
-        wr(s, **kwargs)
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+        if self.closefile:
+            self.file.close()
+
+
+class PagedReportWriter(ReportWriter):
+    """ReportWriter which splits a report to pages of about maxsize
+    characters.
+
+    Pages are written to files '<base>-<n>.wiki' as they are produced.
+    A new page is started when new_page() is called, which the report
+    functions do on the first row of a zerocodepat group when
+    page_full() returns True. An index page with links to wiki pages
+    '<pagename>/<n>' is written to '<base>.wiki' on exit."""
+
+    def __init__(self, base, maxsize, pagename=None, flushsize=1 << 16):
+        super().__init__(None, flushsize)
+        self.base = base
+        self.maxsize = maxsize
+        self.pagename = pagename if pagename else base.split("/")[-1]
+        self.pages = [] # (file name, label of first row)
+        self.pagesize = 0
+        self._open_page(None)
+
+    def _open_page(self, label):
+        fname = "{}-{}.wiki".format(self.base, len(self.pages) + 1)
+        self.file = open(fname, "w", encoding="utf-8")
+        self.pages.append((fname, label))
+        self.pagesize = 0
+
+    def flush(self):
+        self.pagesize += self.size
+        super().flush()
+
+    def page_full(self):
+        return self.pagesize + self.size >= self.maxsize
+
+    def new_page(self, label):
+        """Close the current page and start a new one, where label is the
+        key of the first row, used in the index."""
+        self.flush()
+        self.file.close()
+        self._open_page(label)
+
+    def __exit__(self, *exc):
+        self.flush()
+        self.file.close()
+        with open(self.base + ".wiki", "w", encoding="utf-8") as f:
+            f.write("This report is split to {} pages:\n\n".format(len(self.pages)))
+            for i, (_, label) in enumerate(self.pages):
+                f.write("* [[{}/{}|Page {}]]{}\n".format(self.pagename, i + 1,
+                    i + 1, " (from {})".format(label) if label else ""))
+
+
+def table_page_break(w, label, footer, *headers):
+    """Close the table and continue it on a new page, if the page of
+    writer w is full. Return True if a new page was started."""
+    if not w.page_full():
+        return False
+    w.wr(footer)
+    w.new_page(label)
+    for h in headers:
+        w.wr(h)
+    return True
+
+
+# Increase when the checks change, so that all rows are reported again
+fingerprint_version = 2
+
+def fingerprint(*data):
+    """Return a stable hex digest of JSON serializable data."""
+    s = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha1(s.encode("utf-8")).hexdigest()
+
+
+class RowFingerprints:
+    """Fingerprints of the data of report rows, with the fingerprints
+    from a previous report. Tables only include rows which have changed
+    from the previous report, unchanged rows are not checked."""
+
+    def __init__(self, previous=None):
+        self.previous = previous if previous is not None else {}
+        self.current = {}
+
+    @classmethod
+    def load(cls, fname):
+        """Return RowFingerprints with previous fingerprints from a JSON
+        file fname, or none if the file does not exist."""
+        try:
+            with open(fname, encoding="utf-8") as f:
+                return cls(json.load(f))
+        except FileNotFoundError:
+            return cls()
+
+    def save(self, fname):
+        """Write the current fingerprints to a JSON file fname."""
+        with open(fname, "w", encoding="utf-8") as f:
+            json.dump(self.current, f, sort_keys=True, indent=0)
+
+    def changed(self, key, *data):
+        """Store the fingerprint of data for row key. Return True if it
+        differs from the previous one."""
+        fp = fingerprint(fingerprint_version, *data)
+        self.current[key] = fp
+        return self.previous.get(key, None) != fp
+
+    def changes(self):
+        """Return a dict with lists of added, changed and removed row keys."""
+        return {
+            "added": sorted(k for k in self.current if k not in self.previous),
+            "changed": sorted(k for k, v in self.current.items()
+                if k in self.previous and self.previous[k] != v),
+            "removed": sorted(k for k in self.previous if k not in self.current),
+        }
+
+
+def line_row_data(ld):
+    """Return the data of a line dict used in a route table row and
+    details in a JSON serializable form."""
+    def reldata(rel):
+        return [ rel.id, rel.tags, [ (m._type_value, m.ref, m.role) for m in rel.members ] ]
+    d = { k: v for k, v in ld.items()
+        if k not in ("rels", "rm_rels", "details") }
+    d["rels"] = [ reldata(r) for r in ld.get("rels", []) ]
+    d["rm_rels"] = [ reldata(r) for r in ld.get("rm_rels", []) ]
+    return d
 
 
 def keykey(dkey, return_type=str):
@@ -102,17 +264,13 @@ def test_hsl_routename(ts, lineref, longname):
     return out
 
 
-def test_stop_positions(rel, mode="bus"):
-    wr("'''Stop positions:'''\n")
-    stops = [mem.resolve(resolve_missing=True) \
-      for mem in rel.members if mem.role == "stop"]
-    platforms = [mem.resolve(resolve_missing=True) \
-      for mem in rel.members if mem.role == "platform"]
-#    wr("Route [%s %s] '%s' " % (osm.relid2url(rel.id), rel.id, \
+def test_stop_positions(w, ld, relindex, mode="bus"):
+    w.wr("'''Stop positions:'''\n")
+    (nstops, nplatforms) = ld["osmstopcounts"][relindex]
+#    w.wr("Route [%s %s] '%s' " % (osm.relid2url(rel.id), rel.id, \
 #      rel.tags.get("name", "<no-name-tag>")))
-    wr("%d stop_positions vs. %d platforms." \
-      % (len(stops), len(platforms)))
-    wr("")
+    w.wr("%d stop_positions vs. %d platforms." % (nstops, nplatforms))
+    w.wr("")
 #    # FIXME: Output something sensible
 #    for s in stops:
 #        test_tag(s.tags, "ref")
@@ -137,11 +295,11 @@ def test_stop_positions(rel, mode="bus"):
 #        elif len(namematches) > 1:
 #            sout += " More than one stop_position with matching name!"
 #        if len(sout) > linit:
-#            wr(sout)
-    wr("")
+#            w.wr(sout)
+    w.wr("")
 
 
-def print_route_master(ld):
+def print_route_master(w, ld):
     """Test if a route_master relation for lineref exists and contains the
     given route_ids."""
     lineref = ld["lineref"]
@@ -150,53 +308,53 @@ def print_route_master(ld):
     route_ids = [r.id for r in ld["rels"]]
 
     nr = len(rm_rels)
-    wr("'''Route master:'''")
+    w.wr("'''Route master:'''")
     if nr < 1:
-        wr("No route_master relation found.\n")
+        w.wr("No route_master relation found.\n")
         return
     elif nr > 1:
-        wr("More than one route_master relations found: %s\n" \
+        w.wr("More than one route_master relations found: %s\n" \
           % (", ".join("[%s %s]" \
             % (osm.relid2url(r.id), r.id) for r in rm_rels)))
         return
     elif nr == 1:
         rel = rm_rels[0]
-        wr("Relation: [%s %s]\n" % (osm.relid2url(rel.id), rel.id))
+        w.wr("Relation: [%s %s]\n" % (osm.relid2url(rel.id), rel.id))
     memrefs = [m.ref for m in rel.members]
     refs_not_in_routes = [r for r in memrefs if r not in route_ids]
     if refs_not_in_routes:
-        wr("route_master has extra members: %s\n" % (", ".join("[%s %s]" \
+        w.wr("route_master has extra members: %s\n" % (", ".join("[%s %s]" \
           % (osm.relid2url(r), r) for r in refs_not_in_routes)))
     routes_not_in_refs = [r for r in route_ids if r not in memrefs]
     if routes_not_in_refs:
-        wr("Found matching routes not in route_master: %s\n" \
+        w.wr("Found matching routes not in route_master: %s\n" \
           % (", ".join("[%s %s]" \
             % (osm.relid2url(r), r) for r in routes_not_in_refs)))
     tags = rel.tags
-    wr_if(test_tag(tags, "route_master", mode), end='\n\n')
-    wr_if(test_tag(tags, "ref", lineref), end='\n\n')
-    wr_if(test_tag(tags, "name"), end='\n\n')
-    wr_if(test_tag(tags, "network", "HSL"), end='\n\n')
+    w.wr_if(test_tag(tags, "route_master", mode), end='\n\n')
+    w.wr_if(test_tag(tags, "ref", lineref), end='\n\n')
+    w.wr_if(test_tag(tags, "name"), end='\n\n')
+    w.wr_if(test_tag(tags, "network", "HSL"), end='\n\n')
 
-    wr("")
+    w.wr("")
 
 
-def print_abstract(md):
+def print_abstract(w, md):
     mode = md["mode"]
-    wr("This is a comparison of OSM public transit route data with [%s %s] %s transit data (via [http://digitransit.fi digitransit.fi]) generated by a [https://github.com/tpikonen/taival script].\n" % (md["agencyurl"], md["agency"], mode))
+    w.wr("This is a comparison of OSM public transit route data with [%s %s] %s transit data (via [http://digitransit.fi digitransit.fi]) generated by a [https://github.com/tpikonen/taival script].\n" % (md["agencyurl"], md["agency"], mode))
     if mode == "subway":
-        wr("See also [http://osmz.ru/subways/finland.html osmz.ru subway validator].\n")
+        w.wr("See also [http://osmz.ru/subways/finland.html osmz.ru subway validator].\n")
 
 
-def print_summary(md):
+def print_summary(w, md):
     osmdict = md["osmdict"]
     hsldict = md["hsldict"]
     refless = md["refless"]
     osmlines = set(osmdict)
     hsllines = set(hsldict)
-    wr("= Summary of %s transit in %s region. =" % (md["mode"], md["agency"]))
-    wr("%d lines in OSM.\n" % len(osmlines))
-    wr("%d lines in %s.\n" % (len(hsllines), md["agency"]))
+    w.wr("= Summary of %s transit in %s region. =" % (md["mode"], md["agency"]))
+    w.wr("%d lines in OSM.\n" % len(osmlines))
+    w.wr("%d lines in %s.\n" % (len(hsllines), md["agency"]))
 
     osmextra = osmlines.difference(hsllines)
     if md["mode"] == "bus":
@@ -205,91 +363,91 @@ def print_summary(md):
     else:
         osmextra = list(osmextra)
     osmextra.sort(key=linesortkey)
-    wr("%d lines in OSM but not in %s:" % (len(osmextra), md["agency"]))
+    w.wr("%d lines in OSM but not in %s:" % (len(osmextra), md["agency"]))
     if osmextra:
-        wr(" %s" % ", ".join(["%s (%s)" % \
+        w.wr(" %s" % ", ".join(["%s (%s)" % \
           (x, ", ".join(["[%s %d]" % (osmdict[x][z], z+1) \
             for z in range(len(osmdict[x]))])) for x in osmextra ] ))
-    wr("")
+    w.wr("")
 
     hslextra = list(hsllines.difference(osmlines))
     hslextra.sort(key=linesortkey)
-    wr("%d lines in %s but not in OSM:" % (len(hslextra), md["agency"]))
+    w.wr("%d lines in %s but not in OSM:" % (len(hslextra), md["agency"]))
     if hslextra:
-        wr(" %s" % ", ".join(["[%s %s]" % (hsldict[x], x) for x in hslextra]))
-    wr("")
+        w.wr(" %s" % ", ".join(["[%s %s]" % (hsldict[x], x) for x in hslextra]))
+    w.wr("")
 
-    wr(f"{len(refless)} lines without a 'ref' tag:")
+    w.wr(f"{len(refless)} lines without a 'ref' tag:")
     if refless:
-        wr(" %s" % ", ".join(["[%s %s]" % (osm.relid2url(r.id), r.tags.get("name", str(r.id))) for r in refless]))
-    wr("")
+        w.wr(" %s" % ", ".join(["[%s %s]" % (osm.relid2url(r.id), r.tags.get("name", str(r.id))) for r in refless]))
+    w.wr("")
 
 #    commons = list(hsllines.intersection(osmlines))
 #    commons.sort(key=linesortkey)
-#    wr("%d lines in both %s and OSM." % (len(commons), md["agency"]))
+#    w.wr("%d lines in both %s and OSM." % (len(commons), md["agency"]))
 #    if commons:
-#        wr(" %s" % ", ".join(["%s (%s)" % \
+#        w.wr(" %s" % ", ".join(["%s (%s)" % \
 #          (x, ", ".join(["[%s %d]" % (osmdict[x][z], z+1) \
 #            for z in range(len(osmdict[x]))])) for x in commons] ))
-#    wr("")
+#    w.wr("")
 
-def print_localbus(md):
+def print_localbus(w, md):
     hsl_localbus = md["hsl_localbus"]
     hsl_locallines = set(hsl_localbus)
     osmdict = md["osmdict"]
     osmlines = set(osmdict)
     lbuses = list(hsl_locallines)
     lbuses.sort(key=linesortkey)
-    wr("= Local bus lines =")
-    wr("%d bus routes with GTFS type 704 (lähibussi) in %s." \
+    w.wr("= Local bus lines =")
+    w.wr("%d bus routes with GTFS type 704 (lähibussi) in %s." \
         % (len(lbuses), md["agency"]))
     if lbuses:
-        wr(" %s" % ", ".join(["[%s %s]" % (hsl_localbus[x], x) \
+        w.wr(" %s" % ", ".join(["[%s %s]" % (hsl_localbus[x], x) \
           for x in lbuses] ))
-    wr("")
+    w.wr("")
     lcommons = list(hsl_locallines.intersection(osmlines))
     lcommons.sort(key=linesortkey)
-    wr("%d normal bus routes in OSM with %s local bus route number." \
+    w.wr("%d normal bus routes in OSM with %s local bus route number." \
         % (len(lcommons), md["agency"]))
     if lcommons:
-        wr(" %s" % ", ".join(["%s (%s)" % \
+        w.wr(" %s" % ", ".join(["%s (%s)" % \
           (x, ", ".join(["[%s %d]" % (osmdict[x][z], z+1) \
             for z in range(len(osmdict[x]))])) for x in lcommons ] ))
-    wr("")
+    w.wr("")
     osm_minibusdict = md["osm_minibusdict"]
     osm_minibuslines = list(osm_minibusdict)
     osm_minibuslines.sort(key=linesortkey)
-    wr("%d route=minibus routes in OSM." % (len(osm_minibuslines)))
+    w.wr("%d route=minibus routes in OSM." % (len(osm_minibuslines)))
     if osm_minibuslines:
-        wr(" %s" % ", ".join(["%s (%s)" % \
+        w.wr(" %s" % ", ".join(["%s (%s)" % \
           (x, ", ".join(["[%s %d]" % (osm_minibusdict[x][z], z+1) \
             for z in range(len(osm_minibusdict[x]))])) \
             for x in osm_minibuslines ] ))
-    wr("")
+    w.wr("")
 
 
-def print_oldlines(md):
+def print_oldlines(w, md):
     mode = md["mode"]
     wasroutes = md["wasroutes"]
-    wr("= Old lines =")
+    w.wr("= Old lines =")
     waslines = list(wasroutes)
     waslines.sort(key=linesortkey)
-    wr("%d routes with type 'was:route=%s'." % (len(wasroutes), mode))
+    w.wr("%d routes with type 'was:route=%s'." % (len(wasroutes), mode))
     if wasroutes:
-        wr(" %s" % ", ".join(["%s (%s)" % \
+        w.wr(" %s" % ", ".join(["%s (%s)" % \
           (x, ", ".join(["[%s %d]" % (wasroutes[x][z], z+1) \
             for z in range(len(wasroutes[x]))])) for x in waslines] ))
-    wr("")
+    w.wr("")
 
     disroutes = md["disroutes"]
     dislines = list(disroutes)
     dislines.sort(key=linesortkey)
-    wr("%d routes with type 'disused:route=%s'." % (len(disroutes), mode))
+    w.wr("%d routes with type 'disused:route=%s'." % (len(disroutes), mode))
     if disroutes:
-        wr(" %s" % ", ".join(["%s (%s)" % \
+        w.wr(" %s" % ", ".join(["%s (%s)" % \
           (x, ", ".join(["[%s %d]" % (disroutes[x][z], z+1) \
             for z in range(len(disroutes[x]))])) for x in dislines] ))
-    wr("")
+    w.wr("")
 
 
 def cell_route_master(ld):
@@ -342,11 +500,232 @@ def cell_route_master(ld):
     return style, cell, details
 
 
-def print_routetable(md, linerefs=None, networkname=None, platformidx=2):
+# Distance in meters from the route shape above which a platform is
+# reported as off-route, or the shape tolerance of the mode, if larger
+platform_radius = 50.0
+
+def platform_position_details(md, ld, dirindex, hsli):
+    """
+    Return a tuple (details, count) with a details string and the number
+    of OSM and provider platforms of direction dirindex of line dict ld
+    which are off-route or out of order on the OSM route shape.
+
+    The OSM platforms, and the provider platforms of pattern hsli if it is
+    not None, are projected to the OSM shape with spatial.line_positions().
+    The check is skipped for routes with gaps or without a shape.
+    """
+    shape = ld["osmshapes"][dirindex]
+    if ld["osmgaps"][dirindex] or len(shape) < 2:
+        return "", 0
+    radius = max(platform_radius, md["shapetol"])
+    sources = [ ("OSM", ld["osmplatforms"][dirindex]) ]
+    if hsli is not None and ld["hslplatforms"][hsli]:
+        sources.append((md["agency"], ld["hslplatforms"][hsli]))
+    positions = spatial.line_positions(shape,
+        [ [ (p[0], p[1]) for p in plats ] for _, plats in sources ], radius)
+    lines = []
+    for (src, plats), plist in zip(sources, positions):
+        for i, (p, (dist, pos, ordered)) in enumerate(zip(plats, plist)):
+            problems = []
+            if dist > radius:
+                problems.append("'''{:.0f} m''' from the route".format(dist))
+            if not ordered:
+                problems.append("'''out of order''' along the route")
+            if problems:
+                lines.append("{} platform {} {} ''{}'' at {:.2f} km is {}."\
+                  .format(src, i + 1, p[2], p[3], pos / 1000.0,
+                    " and ".join(problems)))
+    if not lines:
+        return "", 0
+    return "'''Platform positions:'''\n\n" + "\n\n".join(lines) + "\n\n", \
+      len(lines)
+
+
+def routeline_cells(md, ld, networkname, platformidx):
+    """
+    Return a tuple (cells, matchok) for a line dict ld in modedict md.
+
+    The cells are (style, content) tuples for the route table, starting
+    with a placeholder for the line cell. If matchok is False, the OSM
+    routes could not be matched to provider patterns and cells end after
+    the match cell. Details on differences are written to ld["details"].
+    """
+    line = ld["lineref"]
+    cells = []
+    ld["details"] = ""
+    # Line, add a placeholder, edited later
+    cells.append(("", ""))
+    # Master
+    rm_style, rm_cell, rm_details = cell_route_master(ld)
+    if rm_details:
+        ld["details"] += rm_details
+    cells.append((rm_style, rm_cell))
+    # Match
+    relids = [r.id for r in ld["rels"]]
+    codes = ld["codes"]
+    osm2hsl = ld["osm2hsl"]
+    hsl2osm = ld["hsl2osm"]
+    if len(ld["rels"]) == len(codes) and all(x is not None for x in osm2hsl):
+        cells.append((style_ok, "Uniq."))
+    elif len(ld["rels"]) > 2:
+        ld["details"] += "More than 2 matching OSM routes found: %s.\n" % \
+          (", ".join("[%s %d]" % (osm.relid2url(rid), rid) for rid in relids))
+        cells.append((style_problem, "[[#{} | no]]".format(line)))
+        return cells, False
+    elif len(codes) != 2:
+        ld["details"] += "%d route pattern(s) in %s data, matching may be wrong.\n" \
+          % (len(codes), md["agency"])
+        for i in range(len(relids)):
+            ld["details"] += " %s -> %s\n" % \
+              (relids[i], "None" if osm2hsl[i] is None else codes[osm2hsl[i]])
+        for i in range(len(codes)):
+            ld["details"] += " %s -> %s\n" % \
+              (codes[i], "None" if hsl2osm[i] is None else relids[hsl2osm[i]])
+        cells.append((style_maybe, "[[#{} | maybe]]".format(line)))
+    else:
+        cells.append((style_ok, "Uniq."))
+    # Directions / OSM relations
+    id2hslindex = ld["id2hslindex"]
+    htags = ld["htags"]
+    dirindex = 0
+    for rel in ld["rels"]:
+        dirdetails = ""
+        # OSM
+        cells.append((style_relstart, "[%s %s]" % (osm.relid2url(rel.id), rel.id)))
+        # HSL
+        hsli = id2hslindex[rel.id]
+        if hsli is not None:
+            cells.append(("", "[%s %s]" % (pattern2url(codes[hsli]),  codes[hsli])))
+        else:
+            cells.append(("", "N/A"))
+        # Tags
+        tdetlist = []
+        # name-tag gets a special treatment
+        tdetlist.append(test_hsl_routename(rel.tags, htags["shortName"],  htags["longName"]))
+        tdetlist.append(test_tag(rel.tags, "network", networkname))
+        tdetlist.append(test_tag(rel.tags, "from"))
+        tdetlist.append(test_tag(rel.tags, "to"))
+#            if md["modecolors"][mode]:
+#                tdetlist.append(test_tag(rel.tags, "colour", md["modecolors"][mode]))
+        tdetlist.append(test_tag(rel.tags, "color", badtag=True))
+        if hsli is not None and md["interval_tags"]:
+            itags = ld["hslitags"][hsli]
+            for k in sorted(itags.keys()):
+                tdetlist.append(test_tag(rel.tags, k, itags[k]))
+
+        if any(tdetlist):
+            dirdetails += "'''Tags:'''\n\n" + "\n\n".join([s for s in tdetlist if s]) + "\n\n"
+            cells.append((style_problem, "[[#{} | diffs]]".format(line)))
+        else:
+            cells.append((style_ok, "OK"))
+        ptv1 = any(mem.role in ('forward', 'backward') for mem in rel.members)
+        # Shape
+        sdetlist = []
+        if hsli is not None:
+            if ptv1:
+                sdetlist.append("Route [%s %s] has ways with 'forward' and 'backward' roles (PTv1)." \
+                  % (osm.relid2url(rel.id), rel.id))
+                cells.append((style_problem, "PTv1"))
+            elif len(ld["hslshapes"][hsli]) <= len(ld["hslplatforms"][hsli]):
+                cells.append((style_maybe, "N/A"))
+            else:
+                tol = md["shapetol"]
+                shape = ld["osmshapes"][dirindex]
+                gaps = ld["osmgaps"][dirindex]
+                ovl = test_shape_overlap(shape, ld["hslshapes"][hsli], tol=tol)
+                if gaps:
+                    sdetlist.append("Route has '''gaps'''!")
+                    sdetlist.append("Route [%s %s] overlap (tolerance %d m) with %s pattern [%s %s] is '''%1.0f %%'''." \
+                      % (osm.relid2url(rel.id), rel.id, tol, md["agency"], pattern2url(codes[hsli]),  codes[hsli], ovl*100.0))
+                    cells.append((style_problem, "[[#{} | gaps]]".format(line)))
+                elif ovl <= 0.90:
+                    sdetlist.append("Route [%s %s] overlap (tolerance %d m) with %s pattern [%s %s] is '''%1.0f %%'''." \
+                      % (osm.relid2url(rel.id), rel.id, tol, md["agency"], pattern2url(codes[hsli]),  codes[hsli], ovl*100.0))
+                    cells.append((style_problem, "%1.0f%%" % (ovl*100.0)))
+                elif ovl <= 0.95:
+                    cells.append((style_maybe, "%1.0f%%" % (ovl*100.0)))
+                else:
+                    cells.append((style_ok, "%1.0f%%" % (ovl*100.0)))
+        else:
+            sdetlist.append(f"Shape for route {rel.id} not available from provider.\n")
+            cells.append((style_problem, "[[#{} | N/A]]".format(line)))
+        if any(sdetlist):
+            dirdetails += "'''Shape:'''\n\n" + "\n\n".join(sdetlist) + "\n\n"
+        # Platforms
+        hsli = id2hslindex[rel.id]
+        hslplatforms = ld["hslplatforms"]
+        if hsli is not None:
+            osmplatform = ld["osmplatforms"][dirindex]
+            are_stops = osmplatform and all(p[4].startswith('stop') for p in osmplatform)
+            hslplatform = hslplatforms[hsli]
+            # FIXME: Add stop names to unified diffs after diffing, somehow
+            if md["agency"] == 'HSL' and platformidx == 2:
+                osmp = [re.sub(r"^([0-9]{4,4})$", r"H\1", p[2]) + "\n"\
+                  for p in osmplatform]
+                hslp = [re.sub(r"^([0-9]{4,4})$", r"H\1", p[2]) + "\n"\
+                  for p in hslplatform]
+            else:
+                osmp = [p[platformidx]+"\n" for p in osmplatform]
+                hslp = [p[platformidx]+"\n" for p in hslplatform]
+            diff = list(difflib.unified_diff(osmp, hslp, "OSM", md["agency"]))
+            if not osmp or diff or are_stops:
+                dirdetails += "'''Platforms:'''\n\n"
+            if are_stops:
+                dirdetails += "This route has platforms marked with role 'stop', role 'platform' is recommended.\n\n"
+            if not osmp:
+                dirdetails += "{}/{} platforms in OSM / {}.\n\n".format(len(osmp), len(hslp), md["agency"])
+                cells.append((style_problem, "[[#{} | {}/{}]]".format(line, len(osmp), len(hslp))))
+            elif diff:
+                dirdetails += "{}/{} platforms in OSM / {}.\n".format(len(osmp), len(hslp), md["agency"])
+                dirdetails += " " + diff[0]
+                dirdetails += " " + diff[1]
+                ins = 0
+                rem = 0
+                for d in diff[2:]:
+                    dirdetails += " " + d
+                    if d[0] == '+':
+                        ins += 1
+                    elif d[0] == '-':
+                        rem += 1
+                cells.append((style_problem, "[[#{} | +{} -{}{}]]"\
+                  .format(line, ins, rem, "(s)" if are_stops else "")))
+            elif are_stops:
+                cells.append((style_maybe, "[[#{} | {}/{}(s)]]".format(line, len(osmp), len(hslp))))
+            else:
+                cells.append((style_ok, "{}/{}".format(len(osmp), len(hslp))))
+        else:
+            dirdetails += "'''Platforms:'''\n\n"
+            dirdetails += "Platforms could not be compared.\n\n"
+            cells.append((style_problem, "[[#{} | N/A]]".format(line)))
+        if not ptv1:
+            pdetails, npos = platform_position_details(md, ld, dirindex, hsli)
+            dirdetails += pdetails
+            if npos and cells[-1][0] == style_ok:
+                cells[-1] = (style_maybe, "[[#{} | {}]]".format(line, cells[-1][1]))
+        # Add per direction details
+        if dirdetails:
+            if hsli is not None:
+                ld["details"] += \
+                  "'''Direction {}''', route [{} {}], [{} {}]\n\n"\
+                    .format(dirindex, osm.relid2url(rel.id), rel.id,\
+                      pattern2url(codes[hsli]),  codes[hsli]) + dirdetails
+            else:
+                ld["details"] += \
+                  "'''Direction {}''', route [{} {}], <No HSL route>\n\n"\
+                    .format(dirindex, osm.relid2url(rel.id), rel.id) + dirdetails
+        dirindex += 1
+    return cells, True
+
+
+def print_routetable(w, md, linerefs=None, networkname=None, platformidx=2,
+  fps=None):
     """
     Print a route table and details on differences from modedict for
     refs given in linerefs arg (by default all).
 
+    If fps (a RowFingerprints instance) is given, only lines which have
+    changed are included.
+
     If the name of the network differs from agency/provider name, it can
     be given in the networkname arg.
 
@@ -380,243 +759,109 @@ def print_routetable(md, linerefs=None, networkname=None, platformidx=2):
     footer = "|}"
 
     def print_cells(cells, linecounter, statcounter, lines_w_probs):
-        if (zerocodepat.match(line) and linecounter > 9) or linecounter > 30:
-            wr(subheader)
+        if zerocodepat.match(line) \
+          and table_page_break(w, line, footer, header, subheader):
+            linecounter = 0
+        elif (zerocodepat.match(line) and linecounter > 9) or linecounter > 30:
+            w.wr(subheader)
             linecounter = 0
         linecounter += 1
         statcounter += 1
-        wr("|-")
+        w.wr("|-")
         if any(c[0] == style_problem for c in cells):
             cells[0] = (style_problem, "[[#{} | {}]]".format(line, line))
             lines_w_probs += 1
         else:
             cells[0] = (style_ok, str(line))
         for style, content in cells:
-            wr('| style="{}" | {}'.format(style, content))
+            w.wr('| style="{}" | {}'.format(style, content))
         return (linecounter, statcounter, lines_w_probs)
 
     mode = md["mode"]
     if not networkname:
         networkname = md["agency"]
-    wr("= {} {} lines in OSM =\n".format(networkname, mode))
-    wr("This table compares {} {} routes with OSM routes.".format(networkname, mode))
-    wr("The checker uses [[Proposed_features/Refined_Public_Transport | Refined public transport schema]]")
-    wr("as a reference.")
-    wr("")
-    wr(header)
-    wr(subheader)
+    w.wr("= {} {} lines in OSM =\n".format(networkname, mode))
+    w.wr("This table compares {} {} routes with OSM routes.".format(networkname, mode))
+    w.wr("The checker uses [[Proposed_features/Refined_Public_Transport | Refined public transport schema]]")
+    w.wr("as a reference.")
+    w.wr("")
+    w.wr(header)
+    w.wr(subheader)
     linecounter = 0
     statcounter = 0
     lines_w_probs = 0
 
-    if not linerefs:
+    if linerefs is None:
         linerefs = [ e['lineref'] for e in md["lines"].values() ]
 
+    shown = []
     for line in linerefs:
-        cells = []
         ld = md["lines"][line]
         if not "rels" in ld.keys():
             continue
-        ld["details"] = ""
-        # Line, add a placeholder, edited later
-        cells.append(("", ""))
-        # Master
-        rm_style, rm_cell, rm_details = cell_route_master(ld)
-        if rm_details:
-            ld["details"] += rm_details
-        cells.append((rm_style, rm_cell))
-        # Match
-        relids = [r.id for r in ld["rels"]]
-        codes = ld["codes"]
-        osm2hsl = ld["osm2hsl"]
-        hsl2osm = ld["hsl2osm"]
-        if len(ld["rels"]) == len(codes) and all(x is not None for x in osm2hsl):
-            cells.append((style_ok, "Uniq."))
-        elif len(ld["rels"]) > 2:
-            ld["details"] += "More than 2 matching OSM routes found: %s.\n" % \
-              (", ".join("[%s %d]" % (osm.relid2url(rid), rid) for rid in relids))
-            cells.append((style_problem, "[[#{} | no]]".format(line)))
-            (linecounter, statcounter, lines_w_probs) = print_cells(cells, linecounter, statcounter, lines_w_probs)
-            wr('| colspan=10 | Matching problem, see details')
+        if fps and not fps.changed("line/{}/{}".format(md["mode"], line),
+          line_row_data(ld), networkname, platformidx, md["shapetol"],
+          md["interval_tags"]):
             continue
-        elif len(codes) != 2:
-            ld["details"] += "%d route pattern(s) in %s data, matching may be wrong.\n" \
-              % (len(codes), md["agency"])
-            for i in range(len(relids)):
-                ld["details"] += " %s -> %s\n" % \
-                  (relids[i], "None" if osm2hsl[i] is None else codes[osm2hsl[i]])
-            for i in range(len(codes)):
-                ld["details"] += " %s -> %s\n" % \
-                  (codes[i], "None" if hsl2osm[i] is None else relids[hsl2osm[i]])
-            cells.append((style_maybe, "[[#{} | maybe]]".format(line)))
-        else:
-            cells.append((style_ok, "Uniq."))
-        # Directions / OSM relations
-        id2hslindex = ld["id2hslindex"]
-        htags = ld["htags"]
-        dirindex = 0
-        for rel in ld["rels"]:
-            dirdetails = ""
-            # OSM
-            cells.append((style_relstart, "[%s %s]" % (osm.relid2url(rel.id), rel.id)))
-            # HSL
-            hsli = id2hslindex[rel.id]
-            if hsli is not None:
-                cells.append(("", "[%s %s]" % (pattern2url(codes[hsli]),  codes[hsli])))
-            else:
-                cells.append(("", "N/A"))
-            # Tags
-            tdetlist = []
-            # name-tag gets a special treatment
-            tdetlist.append(test_hsl_routename(rel.tags, htags["shortName"],  htags["longName"]))
-            tdetlist.append(test_tag(rel.tags, "network", networkname))
-            tdetlist.append(test_tag(rel.tags, "from"))
-            tdetlist.append(test_tag(rel.tags, "to"))
-#            if md["modecolors"][mode]:
-#                tdetlist.append(test_tag(rel.tags, "colour", md["modecolors"][mode]))
-            tdetlist.append(test_tag(rel.tags, "color", badtag=True))
-            if hsli is not None and md["interval_tags"]:
-                itags = ld["hslitags"][hsli]
-                for k in sorted(itags.keys()):
-                    tdetlist.append(test_tag(rel.tags, k, itags[k]))
-
-            if any(tdetlist):
-                dirdetails += "'''Tags:'''\n\n" + "\n\n".join([s for s in tdetlist if s]) + "\n\n"
-                cells.append((style_problem, "[[#{} | diffs]]".format(line)))
-            else:
-                cells.append((style_ok, "OK"))
-            ptv1 = any(mem.role in ('forward', 'backward') for mem in rel.members)
-            # Shape
-            sdetlist = []
-            if hsli is not None:
-                if ptv1:
-                    sdetlist.append("Route [%s %s] has ways with 'forward' and 'backward' roles (PTv1)." \
-                      % (osm.relid2url(rel.id), rel.id))
-                    cells.append((style_problem, "PTv1"))
-                elif len(ld["hslshapes"][hsli]) <= len(ld["hslplatforms"][hsli]):
-                    cells.append((style_maybe, "N/A"))
-                else:
-                    tol = md["shapetol"]
-                    (shape, gaps) = osm.route_shape(rel)
-                    ovl = test_shape_overlap(shape, ld["hslshapes"][hsli], tol=tol)
-                    if gaps:
-                        sdetlist.append("Route has '''gaps'''!")
-                        sdetlist.append("Route [%s %s] overlap (tolerance %d m) with %s pattern [%s %s] is '''%1.0f %%'''." \
-                          % (osm.relid2url(rel.id), rel.id, tol, md["agency"], pattern2url(codes[hsli]),  codes[hsli], ovl*100.0))
-                        cells.append((style_problem, "[[#{} | gaps]]".format(line)))
-                    elif ovl <= 0.90:
-                        sdetlist.append("Route [%s %s] overlap (tolerance %d m) with %s pattern [%s %s] is '''%1.0f %%'''." \
-                          % (osm.relid2url(rel.id), rel.id, tol, md["agency"], pattern2url(codes[hsli]),  codes[hsli], ovl*100.0))
-                        cells.append((style_problem, "%1.0f%%" % (ovl*100.0)))
-                    elif ovl <= 0.95:
-                        cells.append((style_maybe, "%1.0f%%" % (ovl*100.0)))
-                    else:
-                        cells.append((style_ok, "%1.0f%%" % (ovl*100.0)))
-            else:
-                sdetlist.append(f"Shape for route {rel.id} not available from provider.\n")
-                cells.append((style_problem, "[[#{} | N/A]]".format(line)))
-            if any(sdetlist):
-                dirdetails += "'''Shape:'''\n\n" + "\n\n".join(sdetlist) + "\n\n"
-            # Platforms
-            hsli = id2hslindex[rel.id]
-            hslplatforms = ld["hslplatforms"]
-            if hsli is not None:
-                osmplatform = osm.route_platforms_or_stops(rel)
-                are_stops = osmplatform and all(p[4].startswith('stop') for p in osmplatform)
-                hslplatform = hslplatforms[hsli]
-                # FIXME: Add stop names to unified diffs after diffing, somehow
-                if md["agency"] == 'HSL' and platformidx == 2:
-                    osmp = [re.sub(r"^([0-9]{4,4})$", r"H\1", p[2]) + "\n"\
-                      for p in osmplatform]
-                    hslp = [re.sub(r"^([0-9]{4,4})$", r"H\1", p[2]) + "\n"\
-                      for p in hslplatform]
-                else:
-                    osmp = [p[platformidx]+"\n" for p in osmplatform]
-                    hslp = [p[platformidx]+"\n" for p in hslplatform]
-                diff = list(difflib.unified_diff(osmp, hslp, "OSM", md["agency"]))
-                if not osmp or diff or are_stops:
-                    dirdetails += "'''Platforms:'''\n\n"
-                if are_stops:
-                    dirdetails += "This route has platforms marked with role 'stop', role 'platform' is recommended.\n\n"
-                if not osmp:
-                    dirdetails += "{}/{} platforms in OSM / {}.\n\n".format(len(osmp), len(hslp), md["agency"])
-                    cells.append((style_problem, "[[#{} | {}/{}]]".format(line, len(osmp), len(hslp))))
-                elif diff:
-                    dirdetails += "{}/{} platforms in OSM / {}.\n".format(len(osmp), len(hslp), md["agency"])
-                    dirdetails += " " + diff[0]
-                    dirdetails += " " + diff[1]
-                    ins = 0
-                    rem = 0
-                    for d in diff[2:]:
-                        dirdetails += " " + d
-                        if d[0] == '+':
-                            ins += 1
-                        elif d[0] == '-':
-                            rem += 1
-                    cells.append((style_problem, "[[#{} | +{} -{}{}]]"\
-                      .format(line, ins, rem, "(s)" if are_stops else "")))
-                elif are_stops:
-                    cells.append((style_maybe, "[[#{} | {}/{}(s)]]".format(line, len(osmp), len(hslp))))
-                else:
-                    cells.append((style_ok, "{}/{}".format(len(osmp), len(hslp))))
-            else:
-                dirdetails += "'''Platforms:'''\n\n"
-                dirdetails += "Platforms could not be compared.\n\n"
-                cells.append((style_problem, "[[#{} | N/A]]".format(line)))
-            # Add per direction details
-            if dirdetails:
-                if hsli is not None:
-                    ld["details"] += \
-                      "'''Direction {}''', route [{} {}], [{} {}]\n\n"\
-                        .format(dirindex, osm.relid2url(rel.id), rel.id,\
-                          pattern2url(codes[hsli]),  codes[hsli]) + dirdetails
-                else:
-                    ld["details"] += \
-                      "'''Direction {}''', route [{} {}], <No HSL route>\n\n"\
-                        .format(dirindex, osm.relid2url(rel.id), rel.id) + dirdetails
-            dirindex += 1
-            # end 'for rel in rels'
+        shown.append(line)
+        cells, matchok = routeline_cells(md, ld, networkname, platformidx)
         (linecounter, statcounter, lines_w_probs) = print_cells(cells, linecounter, statcounter, lines_w_probs)
+        if not matchok:
+            w.wr('| colspan=10 | Matching problem, see details')
 
-    wr(footer)
-    wr("")
-    wr("{} lines total.\n".format(statcounter))
-    wr("{} lines with differences.".format(lines_w_probs))
+    w.wr(footer)
+    w.wr("")
+    w.wr("{} lines total.\n".format(statcounter))
+    w.wr("{} lines with differences.".format(lines_w_probs))
 
     # details
-    if any(ld.get("details", None) for ld in md["lines"].values()):
+    if any(md["lines"][ref].get("details", None) for ref in shown):
         pass
         # No separate subheader for differences any more
-        #wr("= Details on differences =\n")
+        #w.wr("= Details on differences =\n")
     else:
         return
-    for ld in [ md["lines"][ref] for ref in linerefs ]:
+    for ld in [ md["lines"][ref] for ref in shown ]:
         if ld.get("details", None):
-            wr("== {} ==".format(ld["lineref"]))
-            wr(ld["details"])
-
-
-def report_routes(md):
-    """Write a mediawiki report page on routes with summary and line table."""
-    print_abstract(md)
-    print_summary(md)
-    if md["mode"] == "bus":
-        print_localbus(md)
-    print_oldlines(md)
+            if zerocodepat.match(ld["lineref"]) and w.page_full():
+                w.new_page(ld["lineref"])
+            w.wr("== {} ==".format(ld["lineref"]))
+            w.wr(ld["details"])
+
+
+def route_tables(md, linerefs=None):
+    """Return a list of (linerefs, networkname, platformidx) tuples, with
+    arguments for print_routetable() for each route table in a report of
+    all lines or the lines in linerefs."""
+    if linerefs is None:
+        linerefs = list(md["lines"].keys())
     if md["agency"] == "HSL" and md["mode"] == "ferry":
-        linerefs = [ e['lineref'] for e in md["lines"].values() \
+        lds = [ md["lines"][ref] for ref in linerefs ]
+        HSL_lines = [ e['lineref'] for e in lds \
             if "htags" in e.keys() and not e["htags"]['gtfsId'].startswith('HSLlautta') ]
-        print_routetable(md, linerefs)
-        HSL_lautat = [ e['lineref'] for e in md["lines"].values() \
+        HSL_lautat = [ e['lineref'] for e in lds \
             if "htags" in e.keys() and e["htags"]['gtfsId'].startswith('HSLlautta') ]
-        print_routetable(md, HSL_lautat, "Saaristoliikenne", 3)
+        return [ (HSL_lines, None, 2), (HSL_lautat, "Saaristoliikenne", 3) ]
     else:
-        print_routetable(md)
+        return [ (linerefs, None, 2) ]
+
+
+def report_routes(w, md, linerefs=None, fps=None):
+    """Write a mediawiki report page on routes with summary and line table,
+    with all lines or the lines in linerefs, and only changed lines if
+    fps (a RowFingerprints instance) is given."""
+    print_abstract(w, md)
+    print_summary(w, md)
+    if md["mode"] == "bus":
+        print_localbus(w, md)
+    print_oldlines(w, md)
+    for refs, networkname, platformidx in route_tables(md, linerefs):
+        print_routetable(w, md, refs, networkname, platformidx, fps=fps)
 
 
 def check_mode(os, ps):
     """Return a (style, text, details) tuple on mode related OSM tags."""
-    modelist = osm.stoptags2mode(os)
+    modelist = osm.stopmodes(os)
     pmode = ps["mode"]
     if not modelist:
         details = "No mode found, provider has mode '{}'."\
@@ -651,12 +896,34 @@ def check_type(os, _=None):
     return type2style[osmtype], text
 
 
+def add_distances(pairs):
+    """Compute the distances of (os, ps) pairs of OSM and provider objects
+    in one vectorized call. The distance in km is stored to ps["x:dist"],
+    and the type and id of os to ps["x:distto"], to be used by
+    check_dist()."""
+    pairs = [ (os, ps) for os, ps in pairs
+        if os.get("x:latlon", None) and ps.get("latlon", None) ]
+    if not pairs:
+        return
+    dists = spatial.haversine_array([ os["x:latlon"] for os, _ in pairs ],
+        [ ps["latlon"] for _, ps in pairs ])
+    for (os, ps), dist in zip(pairs, dists.tolist()):
+        ps["x:dist"] = dist
+        ps["x:distto"] = (os["x:type"], os["x:id"])
+
+
 def check_dist(os, ps):
-    """Return a (style, text) tuple for distance between OSM and provider stops."""
+    """Return a (style, text) tuple for distance between OSM and provider
+    stops, as stored by add_distances(), if available."""
     op = os.get("x:latlon", None)
     pp = ps.get("latlon", None)
-    if op and pp:
+    if ps.get("x:distto", None) == (os.get("x:type", None), os.get("x:id", None)):
+        dist = ps["x:dist"]
+    elif op and pp:
         dist = haversine(op, pp)
+    else:
+        dist = None
+    if dist is not None:
         if dist > 0.999:
             return style_problem, "{0:.1f} km".format(dist)
         elif dist > 0.050:
@@ -688,10 +955,9 @@ def check_name(os, ps):
                 return (style_problem, cn, details)
             else:
                 return (style_ok, cn, "")
+        elif hsl.names_match(on, pn):
+            return (style_ok, shorten(on), "")
         else:
-            for abbr, repl in hsl.synonyms:
-                if on.replace(repl, abbr) == pn:
-                    return (style_ok, shorten(on), "")
             details = "'''name''' set to '{}', should be '{}'."\
               .format(on, pn)
             return (style_problem, cn, details)
@@ -702,19 +968,13 @@ def check_name(os, ps):
 
 def check_findr(os, ps):
     """Return (style, text, details) tuple for ref:findr tag in OSM.
-    Compares value to Digiroad data."""
-    # FIXME: Should also compare by position, useless as it is now
+    Compares value to the nearest Digiroad stop with the same name, or
+    the nearest stop, within digiroad.findr_radius. The Digiroad stops
+    near os are looked up beforehand by add_digiroad_stops()."""
     findr = os.get("ref:findr", None)
-    import digiroad
-    dlist = digiroad.stops_by_name.get(ps["name"], [])
-    drid = None
-    mindist = 1e6;
-    olatlon = os["x:latlon"]
-    for d in dlist:
-        dist = haversine(olatlon, (float(d['stop_lat']), float(d['stop_lon'])))
-        if dist < mindist:
-            mindist = dist
-            drid = d["stop_id"]
+    near = os.get("x:digiroad", [])
+    named = [ s for s in near if s["stop_name"] == ps["name"] ]
+    drid = (named or near)[0]["stop_id"] if near else None
     if findr:
         if drid:
             if findr == drid:
@@ -795,56 +1055,133 @@ def check_wheelchair(os, ps):
         return (style_problem, "err")
 
 
-def print_stopline(oslist, ps, cols):
-    """Print a line to stop table, return (nlines, isok)."""
+def check_cells(checks, os, ps):
+    """Return a list of (name, style, text, details) tuples from running
+    the (name, check function) pairs in checks on OSM object os and
+    provider object ps."""
+    cells = []
+    for name, f in checks:
+        tt = f(os, ps)
+        cells.append((name, tt[0], tt[1], tt[2] if len(tt) > 2 else ""))
+    return cells
+
+
+# Checks in the columns of the stop table
+stop_checks = [
+    ("name", check_name),
+    ("mode", check_mode),
+    ("type", check_type),
+    ("delta", check_dist),
+    ("zone", check_zone),
+#    ("findr", check_findr),
+    ("wheelchair", check_wheelchair),
+]
+
+
+def stop_osmlist(oslist, ps):
+    """Return OSM stops in oslist matching provider stop ps."""
     ref = ps["code"]
     # Prefer exact ref matches (i.e. Hnnnn), if there are none, use all
     flist = [ e for e in oslist if e.get("ref", None) == ref ]
-    oslist = flist if flist else oslist
+    return flist if flist else oslist
+
+
+# Default maximum distance in meters of suggested OSM stops without ref
+# for stops missing from OSM
+suggestion_radius = 50.0
+
+def stop_suggestions(sd, stops, radius=suggestion_radius, k=8):
+    """
+    Return a dict of suggested OSM stops for provider stops missing from
+    OSM.
+
+    Stops in the list stops without a matching ref in OSM are matched one
+    to one to OSM stops without ref (sd["rst"]) of the same mode within
+    radius meters, scored by distance and name similarity. The dict has
+    the code of the provider stop as a key and a dict with keys "os" for
+    the OSM stop, "dist" for the distance in meters and "score" as value.
+    """
+    ost = sd["ost"]
+    missing = [ ps for ps in stops if not ost.get(ps["code"], None) ]
+    rst = list(sd["rst"].values())
+    if not missing or not rst:
+        return {}
+
+    def score(i, j, dist):
+        ps = missing[i]
+        os = rst[j]
+        if ps["mode"] not in osm.stopmodes(os):
+            return None
+        return 0.5 * (1.0 - dist / radius) \
+          + 0.5 * name_similarity(os.get("name", None), hsl.get_stopname(ps))
+
+    mlist = spatial.match_nearby([ ps["latlon"] for ps in missing ],
+        [ os["x:latlon"] for os in rst ], radius, k, score)
+    return { ps["code"]: { "os": rst[m[0]], "dist": m[1], "score": m[2] }
+        for ps, m in zip(missing, mlist) if m }
+
+
+def add_digiroad_stops(oslist):
+    """Add a list of Digiroad stops near each OSM stop in oslist for
+    check_findr(), looked up with a single query."""
+    import digiroad
+    nears = digiroad.stops_near([ os["x:latlon"] for os in oslist ])
+    for os, near in zip(oslist, nears):
+        os["x:digiroad"] = [ s for _, s in near ]
+
+
+def add_stop_distances(sd, stops):
+    """Precompute the distances of provider stops in list stops to their
+    matching OSM stops with add_distances(), and the Digiroad stops near
+    the OSM stops if stop_checks has check_findr."""
+    ost = sd["ost"]
+    pairs = []
+    for ps in stops:
+        oslist = stop_osmlist(ost.get(ps["code"], []), ps)
+        if len(oslist) == 1:
+            pairs.append((oslist[0], ps))
+    add_distances(pairs)
+    if any(f is check_findr for _, f in stop_checks):
+        add_digiroad_stops([ os for os, _ in pairs ])
+
+
+def print_stopline(w, oslist, ps, cols, suggestion=None):
+    """Print a line to stop table, return (nlines, isok). A suggested OSM
+    stop from stop_suggestions() is shown for a stop missing from OSM."""
+    ref = ps["code"]
+    oslist = stop_osmlist(oslist, ps)
     linecounter = 1
     detlist = []
-    wr("|-")
-    wr("| [https://reittiopas.hsl.fi/pysakit/{} {}]"\
+    w.wr("|-")
+    w.wr("| [https://reittiopas.hsl.fi/pysakit/{} {}]"\
       .format(ps["gtfsId"], ref))
     isok = True
     if len(oslist) == 1:
-        def wr_cell(f, o, p):
-            tt = f(o, p)
-            st = tt[0]
-            txt = tt[1]
-            if len(tt) > 2 and tt[2]:
-                detlist.append(tt[2])
-            wr('| style="{}" | {}'.format(st, txt))
-            return st != style_problem
-
-        os = oslist[0]
-        isok &= wr_cell(check_name, os, ps)
-        isok &= wr_cell(check_mode, os, ps)
-        isok &= wr_cell(check_type, os, ps)
-        isok &= wr_cell(check_dist, os, ps)
-        isok &= wr_cell(check_zone, os, ps)
-#        isok &= wr_cell(check_findr, os, ps)
-        isok &= wr_cell(check_wheelchair, os, ps)
+        for _, st, txt, det in check_cells(stop_checks, oslist[0], ps):
+            isok &= st != style_problem
+            if det:
+                detlist.append(det)
+            w.wr('| style="{}" | {}'.format(st, txt))
         if detlist:
             isok = False
             linecounter += len(detlist)
-            wr('|-')
-            wr('| colspan={} style="{}" | {}'.format(cols, style_details, "\n".join(detlist)))
+            w.wr('|-')
+            w.wr('| colspan={} style="{}" | {}'.format(cols, style_details, "\n".join(detlist)))
     elif len(oslist) > 1:
         isok = False
         (lat, lon) = ps["latlon"]
-        wr('| colspan={} style="{}" | More than one stop with the same ref in OSM'.format(cols-1, style_problem))
-        wr('|-')
+        w.wr('| colspan={} style="{}" | More than one stop with the same ref in OSM'.format(cols-1, style_problem))
+        w.wr('|-')
         desc = "\nMatching stops in OSM: {}.".format(", ".join(\
           [ "[https://www.openstreetmap.org/{}/{} {}]"\
           .format(osm.xtype2osm[e["x:type"]], e["x:id"], e["x:id"]) for e in oslist ]))
-        wr('| colspan={} style="{}" | {}'.format(cols, style_details, desc))
+        w.wr('| colspan={} style="{}" | {}'.format(cols, style_details, desc))
         linecounter += 1
     else:
         isok = False
         (lat, lon) = ps["latlon"]
-        wr('| colspan={} style="{}" | missing from [https://www.openstreetmap.org/#map=19/{}/{} OSM]'.format(cols-1, style_problem, lat, lon))
-        wr('|-')
+        w.wr('| colspan={} style="{}" | missing from [https://www.openstreetmap.org/#map=19/{}/{} OSM]'.format(cols-1, style_problem, lat, lon))
+        w.wr('|-')
         taglist = []
         taglist.append("'''name'''='{}'".format(hsl.get_stopname(ps)))
         pz = ps.get("zoneId", None)
@@ -857,12 +1194,17 @@ def print_stopline(oslist, ps, cols):
             taglist.append("'''wheelchair'''='no'")
         desc = "Mode is {}. ".format(ps["mode"])
         desc += "Tags from provider: " + ", ".join(taglist) + "."
-        wr('| colspan={} style="{}" | {}'.format(cols, style_details, desc))
+        if suggestion:
+            so = suggestion["os"]
+            desc += "\nPossible match without ref in OSM: [{} {}] '{}', {:.0f} m away."\
+              .format(osm.obj2url(so), so["x:id"], so.get("name", "<no name>"),
+                suggestion["dist"])
+        w.wr('| colspan={} style="{}" | {}'.format(cols, style_details, desc))
         linecounter += 1
     return linecounter, isok
 
 
-def print_stoptable_cluster(sd, refs=None):
+def print_stoptable_cluster(w, sd, refs=None):
     """Print a stoptable grouped by clusters, for clusters which contain
     at least one stop from refs."""
     cols = 6
@@ -877,7 +1219,8 @@ def print_stoptable_cluster(sd, refs=None):
     footer = "|}"
 
     ost = sd["ost"]
-    pst = sd["pst"] # data from provider
+    # data from provider, by code
+    pst = { k: ps for mdict in sd["pst"].values() for k, ps in mdict.items() }
     pcl = sd["pcl"]
 
     if refs:
@@ -890,11 +1233,11 @@ def print_stoptable_cluster(sd, refs=None):
     linecounter = 0
     stopcounter = 0
     probcounter = 0
-    wr(header)
-    wr(subheader)
+    w.wr(header)
+    w.wr(subheader)
     for k in kk:
         if linecounter > 15:
-            wr(subheader)
+            w.wr(subheader)
             linecounter = 0
         s = wc.get(k, None)
         if not s:
@@ -903,24 +1246,26 @@ def print_stoptable_cluster(sd, refs=None):
         clist = list(set(pcl[c["gtfsId"]]))
         clist.sort()
         linecounter += 1
-        wr("|-")
-        wr("|colspan={} | {}".format(cols, c["name"]))
+        w.wr("|-")
+        w.wr("|colspan={} | {}".format(cols, c["name"]))
         for ref in clist:
             oslist = wc.pop(ref, [])
             ps = pst[ref]
-            nlines, isok = print_stopline(oslist, ps, cols)
+            nlines, isok = print_stopline(w, oslist, ps, cols)
             linecounter += nlines
             stopcounter += 1
             probcounter += 0 if isok else 1
-    wr(footer)
-    wr("")
-    wr("{} stops.\n".format(stopcounter))
-    wr("{} stops with differences.\n".format(probcounter))
-    wr("")
+    w.wr(footer)
+    w.wr("")
+    w.wr("{} stops.\n".format(stopcounter))
+    w.wr("{} stops with differences.\n".format(probcounter))
+    w.wr("")
 
 
-def print_stoptable(sd, stops=None):
-    """Print a stoptable for stops."""
+def print_stoptable(w, sd, stops=None, fps=None, suggestions=None):
+    """Print a stoptable for stops, only changed stops if fps (a
+    RowFingerprints instance) is given. Suggested OSM stops for stops
+    missing from OSM can be given in a dict from stop_suggestions()."""
     cols = 7
     header = '{| class="wikitable"'
     subheader = """|-
@@ -943,69 +1288,222 @@ def print_stoptable(sd, stops=None):
     linecounter = 0
     stopcounter = 0
     probcounter = 0
-    wr(header)
-    wr(subheader)
+    w.wr(header)
+    w.wr(subheader)
     for ps in stops:
         ref = ps["code"]
-        if (zerocodepat.match(ref) and linecounter > 9) or linecounter > 30:
-            wr(subheader)
-            linecounter = 0
         oslist = ost.get(ref, [])
-        nlines, isok = print_stopline(oslist, ps, cols)
+        suggestion = suggestions.get(ref, None) if suggestions else None
+        # Skip before page breaks, so that pages start with a printed row
+        if fps and not fps.changed("stop/" + ref, oslist, ps, suggestion):
+            continue
+        if zerocodepat.match(ref) \
+          and table_page_break(w, ref, footer, header, subheader):
+            linecounter = 0
+        elif (zerocodepat.match(ref) and linecounter > 9) or linecounter > 30:
+            w.wr(subheader)
+            linecounter = 0
+        nlines, isok = print_stopline(w, oslist, ps, cols, suggestion)
         #linecounter += nlines
         linecounter += 1 # Makes diffs more stable
         stopcounter += 1
         probcounter += 0 if isok else 1
-    wr(footer)
-    wr("")
-    wr("{} stops.\n".format(stopcounter))
-    wr("{} stops with differences.\n".format(probcounter))
+    w.wr(footer)
+    w.wr("")
+    w.wr("{} stops.\n".format(stopcounter))
+    w.wr("{} stops with differences.\n".format(probcounter))
 
 
-def report_stoptable_cluster(sd, city):
-    prefixes = hsl.city2prefixes[city]
-    pattern = re.compile("^(" + "|".join(prefixes) + ")[0-9]{4,4}$")
-    pst = sd["pst"]
-    refs = [ k for k in pst.keys() if pattern.match(k) ]
-    print_stoptable_cluster(sd, refs)
+def report_stoptable_cluster(w, sd, city):
+    # Temporary stops with 'X' before the code prefix are not included
+    refs = [ k for mdict in sd["pst"].values() for k, ps in mdict.items()
+        if not k.startswith("X") and stop_city(ps, k) == city ]
+    print_stoptable_cluster(w, sd, refs)
 
 
-def report_stops(sd, mode=None, city=None):
-    """Output a report on stops. Either all, or limited by mode, city or both."""
-    header = "= {} stops".format(sd["agency"]) if not mode \
-      else "= {} {} stops".format(sd["agency"], mode)
-    header += " =\n" if not city else " in {} =\n".format(city)
-    wr("__FORCETOC__")
-    wr("This is a comparison of OSM public transit stop data with [https://www.hsl.fi/ HSL] data (via [http://digitransit.fi digitransit.fi]) generated by a [https://github.com/tpikonen/taival script].\n")
-    wr(header)
+# Maximum distance in meters between OSM stops reported as duplicates
+duplicate_radius = 20.0
+
+def stop_kind(os):
+    """Return a tuple of the tags which give the kind of an OSM stop."""
+    return tuple(os.get(k, None)
+        for k in ("highway", "railway", "amenity", "public_transport"))
 
-    ost = sd["ost"]
-    pst = sd["pst"]
 
+def is_duplicate(s1, s2):
+    """Return True if OSM stops s1 and s2, which are close to each other,
+    are probably duplicates, i.e. they are of the same kind and have the
+    same ref, or the same name and not two different refs."""
+    if stop_kind(s1) != stop_kind(s2):
+        return False
+    r1 = s1.get("ref", None)
+    r2 = s2.get("ref", None)
+    if r1 and r2:
+        return r1 == r2
+    n1 = s1.get("name", None)
+    return bool(n1) and n1 == s2.get("name", None)
+
+
+def duplicate_stops(sd, modes=None, radius=duplicate_radius):
+    """
+    Return a dict of lists of possibly duplicated OSM stops, by mode.
+
+    The OSM stops with and without ref in sd of each mode in modes (by
+    default all) are joined with spatial.close_pairs() to find stops
+    within radius meters of each other. Stops which are duplicates by
+    is_duplicate() are grouped to clusters, which are lists of stop
+    dicts. The clusters of each mode are sorted by their first ref or name.
+    """
+    allstops = [ s for vl in sd["ost"].values() for s in vl ] \
+      + list(sd["rst"].values())
+    if modes is None:
+        modes = list(osm.stoptags.keys())
+    out = {}
+    for m in modes:
+        stops = [ s for s in allstops if m in osm.stopmodes(s) ]
+        parent = list(range(len(stops)))
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+        for i, j, _ in spatial.close_pairs([ s["x:latlon"] for s in stops ], radius):
+            if is_duplicate(stops[i], stops[j]):
+                parent[find(i)] = find(j)
+        clusters = defaultdict(list)
+        for i in range(len(stops)):
+            clusters[find(i)].append(stops[i])
+        out[m] = sorted((c for c in clusters.values() if len(c) > 1),
+            key=lambda c: [ s.get("ref", "") or s.get("name", "") for s in c ])
+    return out
+
+
+def select_duplicates(dups, mode=None, city=None):
+    """Return a list of clusters from duplicate_stops() output dups, of
+    mode, or of all modes, and with a stop with a ref in city, if given."""
     if mode:
-        stops = list(pst[mode].values())
-        orefs = ( r for r, vl in ost.items() if mode in (m for v in vl for m in osm.stoptags2mode(v)) )
+        clusters = dups.get(mode, [])
     else:
-        stops = [ v for m in pst.keys() for v in pst[m].values() ]
-        orefs = ost.keys()
+        seen = set()
+        clusters = []
+        for m in sorted(dups.keys()):
+            for c in dups[m]:
+                ids = frozenset((s["x:type"], s["x:id"]) for s in c)
+                if ids not in seen:
+                    seen.add(ids)
+                    clusters.append(c)
     if city:
-        prefixes = hsl.city2prefixes[city]
-        # temporary(?) stops to be added to "Stops not in HSL" section
-        prefixes.extend([ "X" + p for p in prefixes])
-        pattern = re.compile("^(" + "|".join(prefixes) + ")[0-9]{4,4}$")
-        stops = [ s for s in stops if pattern.match(s["code"]) ]
-        orefs = (r for r in orefs if pattern.match(r))
+        clusters = [ c for c in clusters
+            if any(stop_city(s, s.get("ref", "")) == city for s in c) ]
+    return clusters
+
+
+def print_duplicates(w, clusters, radius=duplicate_radius):
+    """Print a list of clusters of possibly duplicated OSM stops."""
+    w.wr("= Possible duplicate stops in OSM =\n")
+    w.wr("{} groups of stops of the same kind within {:.0f} m with the same ref or name:\n"\
+      .format(len(clusters), radius))
+    for c in clusters:
+        w.wr("* " + ", ".join("[{} {}] {}'{}'".format(osm.obj2url(s), s["x:id"],
+          s["ref"] + " " if s.get("ref", None) else "", s.get("name", ""))
+          for s in c))
+    w.wr("")
+
+
+def stop_city(s, code):
+    """Return the city of stop dict s, which has code or ref code. The
+    city is 'x:city' from the location of the stop, if set when collecting,
+    or from the code prefix (see hsl.stopcode_city())."""
+    return s.get("x:city", None) or hsl.stopcode_city(code)
+
+
+def stop_index(sd):
+    """Return an index of stops by mode and city, to be given to
+    report_stops() when making several reports from the same data.
+
+    The index is a dict with keys "pst", with a (mode, city) -> provider
+    stop list dict, and "orefs", with a (mode, city) -> set of OSM stop refs
+    dict. Mode and/or city are None in keys of stops in any mode or city.
+    Key "duplicates" has possibly duplicated OSM stops by mode, as returned
+    by duplicate_stops()."""
+    pst = defaultdict(list)
+    orefs = defaultdict(set)
+    for m, mdict in sd["pst"].items():
+        for ps in mdict.values():
+            c = stop_city(ps, ps["code"])
+            for key in [(None, None), (m, None)] \
+              + ([(None, c), (m, c)] if c else []):
+                pst[key].append(ps)
+    for r, vl in sd["ost"].items():
+        cities = set(stop_city(v, r) for v in vl).difference([None])
+        modes = set(m for v in vl for m in osm.stopmodes(v))
+        for m in [None] + list(modes):
+            orefs[(m, None)].add(r)
+            for c in cities:
+                orefs[(m, c)].add(r)
+    return { "pst": pst, "orefs": orefs, "duplicates": duplicate_stops(sd) }
+
+
+def select_stops(sd, mode=None, city=None, index=None):
+    """Return a tuple (stops, extras) with a list of provider stops, sorted
+    by code, and a sorted list of refs of OSM stops not in provider data,
+    either all, or limited by mode, city or both. Stops are looked up from
+    index (see stop_index()), if given."""
+    ost = sd["ost"]
+    pst = sd["pst"]
+
+    if index:
+        stops = list(index["pst"].get((mode, city), []))
+        orefs = index["orefs"].get((mode, city), set())
+    else:
+        if mode:
+            stops = list(pst[mode].values())
+            orefs = ( r for r, vl in ost.items() if any(mode in osm.stopmodes(v) for v in vl) )
+        else:
+            stops = [ v for m in pst.keys() for v in pst[m].values() ]
+            orefs = ost.keys()
+        if city:
+            stops = [ s for s in stops if stop_city(s, s["code"]) == city ]
+            orefs = (r for r in orefs
+                if any(stop_city(v, r) == city for v in ost[r]))
     stops.sort(key=keykey("code"))
-    print_stoptable(sd, stops)
     orefs = set(orefs)
     pstops = set(ps["code"] for ps in stops)
     extras = orefs.difference(pstops)
     hslpat = re.compile(r"^[^0-9]*[0-9]{4,4}$")
     extras = [ r for r in extras if hslpat.match(r) ]
     extras.sort()
-    wr("= Stops not in HSL data =\n")
-    wr("{} stops not in HSL:\n".format(len(extras)))
-    wr(" " + " ".join(osm.stoplist2links(ost[ref]) for ref in extras))
+    return stops, extras
+
+
+def report_stops(w, sd, mode=None, city=None, index=None, fps=None,
+  radius=suggestion_radius):
+    """Output a report on stops. Either all, or limited by mode, city or both.
+    Stops are looked up from index (see stop_index()), if given. Only
+    changed stops are included in the table if fps is given. OSM stops
+    without ref within radius meters are suggested for missing stops, if
+    radius is not zero."""
+    header = "= {} stops".format(sd["agency"]) if not mode \
+      else "= {} {} stops".format(sd["agency"], mode)
+    header += " =\n" if not city else " in {} =\n".format(city)
+    w.wr("__FORCETOC__")
+    w.wr("This is a comparison of OSM public transit stop data with [https://www.hsl.fi/ HSL] data (via [http://digitransit.fi digitransit.fi]) generated by a [https://github.com/tpikonen/taival script].\n")
+    w.wr(header)
+
+    ost = sd["ost"]
+    stops, extras = select_stops(sd, mode, city, index)
+    add_stop_distances(sd, stops)
+    suggestions = stop_suggestions(sd, stops, radius) if radius else {}
+    print_stoptable(w, sd, stops, fps, suggestions)
+    w.wr("= Stops not in HSL data =\n")
+    w.wr("{} stops not in HSL:\n".format(len(extras)))
+    w.wr(" " + " ".join(osm.stoplist2links(ost[ref]) for ref in extras))
+    w.wr("")
+    if index:
+        dups = index["duplicates"]
+    else:
+        dups = duplicate_stops(sd, [mode] if mode else None)
+    print_duplicates(w, select_duplicates(dups, mode, city))
 
 
 def check_stationname(os, ps):
@@ -1025,47 +1523,78 @@ def check_stationname(os, ps):
         return (style_problem, "<no name in OSM>", "")
 
 
-def print_stationline(os, ps, cols):
-    def wr_cell(f, o, p):
-        tt = f(o, p)
-        st = tt[0]
-        txt = tt[1]
-        if len(tt) > 2 and tt[2]:
-            detlist.append(tt[2])
-        wr('| style="{}" | {}'.format(st, txt))
-        return st != style_problem
+# Checks in the columns of the station table
+station_checks = [
+    ("name", check_stationname),
+    ("mode", check_mode),
+    ("type", check_type),
+]
 
-    op = os.get("x:latlon", None)
-    pp = ps.get("latlon", None)
-    dist = haversine(op, pp)
-    oname = os.get("name", "<no name>")
+
+# Maximum distance in meters between matching OSM and provider stations
+station_radius = 200.0
+
+def match_stations(sd, mode, radius=station_radius, k=4):
+    """
+    Return a tuple (matches, unmatched) for 'mode' stations.
+
+    The matches list has a dict for each provider station, sorted by
+    name, with keys "ps" for the provider station, "os" for the matching
+    OSM station or None and "dist" for the distance between them in
+    meters. The unmatched list has the OSM stations without a match.
+
+    Stations are matched one to one, in order of increasing distance,
+    from the k nearest OSM stations within radius of each provider
+    station (see spatial.match_nearby()).
+    """
+    stations = sorted(sd["pstat"][mode], key=keykey('name'))
+    ostats = sd["ostat"][mode]
+    mlist = spatial.match_nearby([ ps["latlon"] for ps in stations ],
+        [ e["x:latlon"] for e in ostats ], radius, k)
+    matches = []
+    used = set()
+    for ps, m in zip(stations, mlist):
+        if m:
+            matches.append({ "ps": ps, "os": ostats[m[0]], "dist": m[1] })
+            used.add(m[0])
+        else:
+            matches.append({ "ps": ps, "os": None, "dist": None })
+    unmatched = [ os for i, os in enumerate(ostats) if i not in used ]
+    return matches, unmatched
+
+
+def print_stationline(w, m, cols):
+    """Print a line to station table for a match m from match_stations(),
+    return (nlines, isok)."""
+    ps = m["ps"]
+    os = m["os"]
     linecounter = 1
     isok = True
     detlist = []
-    wr("|-")
-    wr("| [{} {}]".format(terminalid2url(ps["gtfsId"]), ps["name"]))
-    if dist > 0.200:
+    w.wr("|-")
+    w.wr("| [{} {}]".format(terminalid2url(ps["gtfsId"]), ps["name"]))
+    if os is None:
         isok = False
         (lat, lon) = ps["latlon"]
-        wr('| colspan={} style="{}" | Station not found in [https://www.openstreetmap.org/#map=19/{}/{} OSM]'.format(cols-1, style_problem, lat, lon))
+        w.wr('| colspan={} style="{}" | Station not found in [https://www.openstreetmap.org/#map=19/{}/{} OSM]'.format(cols-1, style_problem, lat, lon))
     else:
-        os["x:matched"] = True
-        isok &= wr_cell(check_stationname, os, ps)
-        isok &= wr_cell(check_mode, os, ps)
-        isok &= wr_cell(check_type, os, ps)
-        wr("| {0:.0f} m".format(dist*1000))
+        for _, st, txt, det in check_cells(station_checks, os, ps):
+            isok &= st != style_problem
+            if det:
+                detlist.append(det)
+            w.wr('| style="{}" | {}'.format(st, txt))
+        w.wr("| {0:.0f} m".format(m["dist"]))
     if detlist:
         isok = False
         linecounter += len(detlist)
-        wr('|-')
-        wr('| colspan={} style="{}" | {}'.format(cols, style_details, "\n".join(detlist)))
+        w.wr('|-')
+        w.wr('| colspan={} style="{}" | {}'.format(cols, style_details, "\n".join(detlist)))
     return linecounter, isok
 
 
-def print_stationtable(sd, mode):
-    """Print a table of 'mode' stations."""
-    import numpy as np
-    from pykdtree.kdtree import KDTree
+def print_stationtable(w, sd, mode, fps=None):
+    """Print a table of 'mode' stations, only changed stations if fps (a
+    RowFingerprints instance) is given."""
     cols = 5
     header = '{| class="wikitable"'
     subheader = """|-
@@ -1076,58 +1605,51 @@ def print_stationtable(sd, mode):
 ! delta"""
     footer = "|}"
 
-    ost = sd["ostat"]
-    pst = sd["pstat"] # data from provider
-
-    stations = pst[mode]
-    stations.sort(key=keykey('name'))
-    ostats = ost[mode]
-    kd_tree = KDTree(np.array([e["x:latlon"] for e in ostats]))
+    matches, unmatched = match_stations(sd, mode)
 
     linecounter = 0
     statcounter = 0
     probcounter = 0
-    wr(header)
-    wr(subheader)
-    for ind in range(len(stations)):
+    w.wr(header)
+    w.wr(subheader)
+    for m in matches:
         if linecounter > 19:
-            wr(subheader)
+            w.wr(subheader)
             linecounter = 0
-        ps = stations[ind]
-        darr, iarr = kd_tree.query(np.array(ps["latlon"], ndmin=2))
-        oind = iarr[0]
-        os = ostats[oind]
-        nlines, isok = print_stationline(os, ps, cols)
+        if fps and not fps.changed("station/" + m["ps"]["gtfsId"],
+          m["os"], m["ps"]):
+            continue
+        nlines, isok = print_stationline(w, m, cols)
         #linecounter += nlines
         linecounter += 1 # Makes diffs more stable
         statcounter += 1
         probcounter += 0 if isok else 1
-    wr(footer)
-    wr("")
-    wr("{} stations.\n".format(statcounter))
-    wr("{} stations with differences.\n".format(probcounter))
-    not_in = [ s for s in ostats if not "x:matched" in s.keys() ]
-    if not_in:
-        not_in.sort(key=keykey("name"))
-        wr("'''{} stations not in HSL'''\n".format(mode.capitalize()))
+    w.wr(footer)
+    w.wr("")
+    w.wr("{} stations.\n".format(statcounter))
+    w.wr("{} stations with differences.\n".format(probcounter))
+    if unmatched:
+        not_in = sorted(unmatched, key=keykey("name"))
+        w.wr("'''{} stations not in HSL'''\n".format(mode.capitalize()))
         sgen = ("[{} {}]".format(osm.obj2url(s), s.get("name", "<no name in OSM>")) for s in not_in)
-        wr(" {}\n".format(", ".join(sgen)))
+        w.wr(" {}\n".format(", ".join(sgen)))
 
 
-def report_stations(sd, mode=None):
-    """Output a report on stations. Either all, or limited by mode."""
+def report_stations(w, sd, mode=None, fps=None):
+    """Output a report on stations. Either all, or limited by mode. Only
+    changed stations are included if fps is given."""
     ostat = sd["ostat"]
     pstat = sd["pstat"]
-    wr("This is a comparison of OSM public transit station data with [https://www.hsl.fi/ HSL] data (via [http://digitransit.fi digitransit.fi]) generated by a [https://github.com/tpikonen/taival script].\n")
+    w.wr("This is a comparison of OSM public transit station data with [https://www.hsl.fi/ HSL] data (via [http://digitransit.fi digitransit.fi]) generated by a [https://github.com/tpikonen/taival script].\n")
     if mode:
         modelist = [mode]
     else:
         modelist = list(pstat.keys())
-        wr("= Stations in HSL =\n")
+        w.wr("= Stations in HSL =\n")
     modelist.sort()
     for m in modelist:
-        wr("== {} stations ==".format(m.capitalize()))
-        print_stationtable(sd, m)
+        w.wr("== {} stations ==".format(m.capitalize()))
+        print_stationtable(w, sd, m, fps)
 
 
 def check_cbname(os, ps):
@@ -1148,7 +1670,7 @@ def check_cbname(os, ps):
             continue
         if onorig:
             on = onorig.replace(stext, "")
-            if on == pn or any(pn.replace(repl, abbr) == on for repl, abbr in hsl.synonyms):
+            if hsl.names_match(on, pn):
                 isok &= True
             else:
                 detlist.append(f"'''name{tagext}''' set to '{onorig}', should be '{pn}{stext}'.")
@@ -1161,7 +1683,7 @@ def check_cbname(os, ps):
 
     on = os.get("name", "").replace(" kaupunkipyöräasema", "")
     pn = ps["name"]
-    if on == pn or any(pn.replace(repl, abbr) == on for repl, abbr in hsl.synonyms):
+    if hsl.names_match(on, pn):
         goodname = on
     else:
         goodname = pn
@@ -1189,51 +1711,95 @@ def check_capacity(os, ps):
         return (style_problem, cell, "")
 
 
-def print_citybikeline(oslist, ps, cols):
-    """Print a line to citybike table, return (nlines, isok)."""
+# Checks in the columns of the citybike table
+citybike_checks = [
+    ("name", check_cbname),
+    ("type", check_type),
+    ("delta", check_dist),
+    ("capacity", check_capacity),
+]
+
+
+# Maximum distance in meters of OSM citybike stations without ref
+# proposed for provider stations
+citybike_radius = 50.0
+
+def add_citybike_distances(sd):
+    """Precompute the distances of provider citybike stations to their
+    matching OSM stations with add_distances()."""
+    ost = sd["ocbs"]
+    add_distances([ (ost[ref][0], ps) for ref, ps in sd["pcbs"].items()
+        if len(ost.get(ref, [])) == 1 ])
+
+
+def citybike_suggestions(sd, radius=citybike_radius, k=4):
+    """
+    Return a dict of proposed ref assignments for OSM citybike stations
+    without ref.
+
+    Provider stations in the reports (see reported_citybike()) without a
+    matching ref in OSM are matched one to one to the OSM stations without
+    ref (sd["orest"]) within radius meters, scored by distance and name
+    similarity. The dict has the provider
+    station ref as a key and a dict with keys "os" for the OSM station,
+    "dist" for the distance in meters and "score" as value.
+    """
+    ost = sd["ocbs"]
+    missing = [ ps for ref, ps in sd["pcbs"].items()
+        if reported_citybike(ps) and not ost.get(ref, None) ]
+    orest = list(sd["orest"].values())
+    if not missing or not orest:
+        return {}
+
+    def score(i, j, dist):
+        on = orest[j].get("name", "").replace(" kaupunkipyöräasema", "")
+        return 0.5 * (1.0 - dist / radius) \
+          + 0.5 * name_similarity(on, missing[i]["name"])
+
+    mlist = spatial.match_nearby([ ps["latlon"] for ps in missing ],
+        [ os["x:latlon"] for os in orest ], radius, k, score)
+    return { ps["stationId"]: { "os": orest[m[0]], "dist": m[1], "score": m[2] }
+        for ps, m in zip(missing, mlist) if m }
+
+
+def print_citybikeline(w, oslist, ps, cols, suggestion=None):
+    """Print a line to citybike table, return (nlines, isok). A proposed
+    OSM station from citybike_suggestions() is shown for a station missing
+    from OSM."""
     ref = ps["stationId"]
     linecounter = 1
     detlist = []
-    wr("|-")
-    wr("| [{} {}]".format(citybike2url(ref), ref))
+    w.wr("|-")
+    w.wr("| [{} {}]".format(citybike2url(ref), ref))
     isok = True
     if len(oslist) == 1:
-        def wr_cell(f, o, p):
-            tt = f(o, p)
-            st = tt[0]
-            txt = tt[1]
-            if len(tt) > 2 and tt[2]:
-                detlist.append(tt[2])
-            wr('| style="{}" | {}'.format(st, txt))
-            return st != style_problem
-
-        os = oslist[0]
-        isok &= wr_cell(check_cbname, os, ps)
-        isok &= wr_cell(check_type, os, ps)
-        isok &= wr_cell(check_dist, os, ps)
-        isok &= wr_cell(check_capacity, os, ps)
+        for _, st, txt, det in check_cells(citybike_checks, oslist[0], ps):
+            isok &= st != style_problem
+            if det:
+                detlist.append(det)
+            w.wr('| style="{}" | {}'.format(st, txt))
         if detlist:
             isok = False
             linecounter += len(detlist)
-            wr('|-')
-            wr('| colspan={} style="{}" | {}'.format(cols, style_details, "\n".join(detlist)))
+            w.wr('|-')
+            w.wr('| colspan={} style="{}" | {}'.format(cols, style_details, "\n".join(detlist)))
     elif len(oslist) > 1:
         isok = False
-        wr('| {}'.format(ps["name"]))
+        w.wr('| {}'.format(ps["name"]))
         (lat, lon) = ps["latlon"]
-        wr('| colspan={} style="{}" | More than one station with the same ref in OSM'.format(cols-2, style_problem))
-        wr('|-')
+        w.wr('| colspan={} style="{}" | More than one station with the same ref in OSM'.format(cols-2, style_problem))
+        w.wr('|-')
         desc = "\nMatching stations in OSM: {}.".format(", ".join(\
           [ "[https://www.openstreetmap.org/{}/{} {}]"\
           .format(osm.xtype2osm[e["x:type"]], e["x:id"], e["x:id"]) for e in oslist ]))
-        wr('| colspan={} style="{}" | {}'.format(cols, style_details, desc))
+        w.wr('| colspan={} style="{}" | {}'.format(cols, style_details, desc))
         linecounter += 1
     else:
         isok = False
-        wr('| {}'.format(ps["name"]))
+        w.wr('| {}'.format(ps["name"]))
         (lat, lon) = ps["latlon"]
-        wr('| colspan={} style="{}" | missing from [https://www.openstreetmap.org/#map=19/{}/{} OSM]'.format(cols-2, style_problem, lat, lon))
-        wr('|-')
+        w.wr('| colspan={} style="{}" | missing from [https://www.openstreetmap.org/#map=19/{}/{} OSM]'.format(cols-2, style_problem, lat, lon))
+        w.wr('|-')
         taglist = []
         taglist.append("'''name'''='{}'".format(ps["name"]))
 #        if ps["state"] == 'Station on':
@@ -1242,13 +1808,20 @@ def print_citybikeline(oslist, ps, cols):
 #        if "total_slots" in ps.keys():
 #            taglist.append("'''capacity'''='{}'".format(ps["total_slots"]))
         desc = "Tags from HSL: " + ", ".join(taglist) + "."
-        wr('| colspan={} style="{}" | {}'.format(cols, style_details, desc))
+        if suggestion:
+            so = suggestion["os"]
+            desc += "\nPossible match without ref in OSM: [{} {}] '{}', {:.0f} m away."\
+              .format(osm.obj2url(so), so["x:id"], so.get("name", "<no name>"),
+                suggestion["dist"])
+        w.wr('| colspan={} style="{}" | {}'.format(cols, style_details, desc))
         linecounter += 1
     return linecounter, isok
 
 
-def print_citybiketable(sd, refs=None):
-    """Print a table of citybike stations."""
+def print_citybiketable(w, sd, refs=None, fps=None, suggestions=None):
+    """Print a table of citybike stations, only changed stations if fps (a
+    RowFingerprints instance) is given. Proposed OSM stations for stations
+    missing from OSM can be given in a dict from citybike_suggestions()."""
     cols = 6
     header = '{| class="wikitable"'
     subheader = """|-
@@ -1268,49 +1841,83 @@ def print_citybiketable(sd, refs=None):
     linecounter = 0
     statcounter = 0
     probcounter = 0
-    wr(header)
-    wr(subheader)
+    w.wr(header)
+    w.wr(subheader)
     for ref in refs:
-        if (zerocodepat.match(ref) and linecounter > 9) or linecounter > 30:
-            wr(subheader)
-            linecounter = 0
         ps = pst[ref]
-        if not ps["networks"][0] in ["vantaa", "smoove"]: continue
+        if not reported_citybike(ps): continue
         oslist = ost.pop(ref, [])
-        nlines, isok = print_citybikeline(oslist, ps, cols)
+        suggestion = suggestions.get(ref, None) if suggestions else None
+        # Skip before page breaks, so that pages start with a printed row
+        if fps and not fps.changed("citybike/" + ref, oslist, ps, suggestion):
+            continue
+        if zerocodepat.match(ref) \
+          and table_page_break(w, ref, footer, header, subheader):
+            linecounter = 0
+        elif (zerocodepat.match(ref) and linecounter > 9) or linecounter > 30:
+            w.wr(subheader)
+            linecounter = 0
+        nlines, isok = print_citybikeline(w, oslist, ps, cols, suggestion)
         #linecounter += nlines
         linecounter += 1 # Makes diffs more stable
         statcounter += 1
         probcounter += 0 if isok else 1
-    wr(footer)
-    wr("")
-    wr("{} citybike stations.\n".format(statcounter))
-    wr("{} citybike stations with differences.\n".format(probcounter))
+    w.wr(footer)
+    w.wr("")
+    w.wr("{} citybike stations.\n".format(statcounter))
+    w.wr("{} citybike stations with differences.\n".format(probcounter))
+
 
+# Networks of provider citybike stations included in the reports
+citybike_networks = ["vantaa", "smoove"]
 
-def report_citybikes(sd):
-    """Output a report on citybike stations."""
+def reported_citybike(ps):
+    """Return True if provider citybike station ps is in the reports."""
+    return ps["networks"][0] in citybike_networks
+
+
+def citybike_refs(sd):
+    """Return a tuple (active_refs, inactive_refs) of provider citybike
+    station refs."""
+    pst = sd["pcbs"]
+    active_refs = [ v["stationId"] for v in pst.values() if v["state"] == "Station on" ]
+    inactive_refs = [ v["stationId"] for v in pst.values() if v["state"] != "Station on" ]
+    return active_refs, inactive_refs
+
+
+def report_citybikes(w, sd, fps=None):
+    """Output a report on citybike stations. Only changed stations are
+    included in the tables if fps is given."""
     ost = sd["ocbs"]
     pst = sd["pcbs"]
-    wr("__FORCETOC__")
-    wr("This is a comparison of OSM citybike station data with [https://www.hsl.fi/ HSL] data (via [http://digitransit.fi digitransit.fi]) generated by a [https://github.com/tpikonen/taival script].\n")
-    #wr("= Citybike stations in HSL =\n")
+    w.wr("__FORCETOC__")
+    w.wr("This is a comparison of OSM citybike station data with [https://www.hsl.fi/ HSL] data (via [http://digitransit.fi digitransit.fi]) generated by a [https://github.com/tpikonen/taival script].\n")
+    #w.wr("= Citybike stations in HSL =\n")
 
-    wr("== Active citybike stations ==\n")
-    active_refs = [ v["stationId"] for v in pst.values() if v["state"] == "Station on" ]
-    print_citybiketable(sd, active_refs)
+    w.wr("== Active citybike stations ==\n")
+    active_refs, inactive_refs = citybike_refs(sd)
+    add_citybike_distances(sd)
+    suggestions = citybike_suggestions(sd)
+    print_citybiketable(w, sd, active_refs, fps, suggestions)
 
-    wr("== Citybike stations not in use ==\n")
-    inactive_refs = [ v["stationId"] for v in pst.values() if v["state"] != "Station on" ]
-    print_citybiketable(sd, inactive_refs)
+    w.wr("== Citybike stations not in use ==\n")
+    print_citybiketable(w, sd, inactive_refs, fps, suggestions)
 
-    wr("== Other citybike stations ==\n")
+    w.wr("== Other citybike stations ==\n")
     printedset = set(active_refs + inactive_refs)
     rest_w_ref = [ e for l in ost.values() for e in l if not e["ref"] in printedset ]
     rest_w_ref.sort(key=lambda x: linesortkey(keykey("ref")(x)))
     orest = list(sd["orest"].values())
     orest.sort(key=keykey("name"))
-    wr("{} citybike stations not in {}:\n".format(len(rest_w_ref) + len(orest), sd["agency"]))
+    w.wr("{} citybike stations not in {}:\n".format(len(rest_w_ref) + len(orest), sd["agency"]))
     rlist = ["[{} {}]".format(osm.obj2url(s), s.get("ref", "<no ref in OSM>")) for s in rest_w_ref]
     olist = ["[{} {}]".format(osm.obj2url(s), s.get("name", "<no name in OSM>")) for s in orest]
-    wr(" {}\n".format(", ".join(rlist + olist)))
+    w.wr(" {}\n".format(", ".join(rlist + olist)))
+    if suggestions:
+        w.wr("Proposed refs for citybike stations without ref in OSM:\n")
+        for ref in sorted(suggestions.keys(), key=linesortkey):
+            so = suggestions[ref]["os"]
+            w.wr("* [{} {}] '{}': '''ref'''='{}' ({:.0f} m)".format(osm.obj2url(so),
+              so["x:id"], so.get("name", "<no name in OSM>"), ref,
+              suggestions[ref]["dist"]))
+        w.wr("")
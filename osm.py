@@ -5,7 +5,8 @@
 # terms of the GNU Affero General Public License version 3 as published by the
 # Free Software Foundation. See the file COPYING for license text.
 
-import overpy, logging, time
+import overpy, logging, time, os, json, re, hashlib
+import requests
 from collections import defaultdict
 from util import ldist2
 
@@ -28,10 +29,227 @@ def apiquery(query):
     log.error("Giving up on Overpass requests")
     raise overpy.exception.OverpassTooManyRequests("Giving up")
 
-# Areas must be initialized by e.g. hsl.overpass_area before queries
+
+# Timeouts in seconds for connecting to Overpass and for reading the
+# response, which is longer than the longest query timeout
+request_timeout = (30, 3660)
+
+
+def apiquery_response(query, stream=False):
+    """Make an Overpass query, return a requests.Response."""
+    waittimes = [2,3,4,8] # min
+    for t in waittimes:
+        r = requests.post(api.url, data=query.encode("utf-8"), stream=stream,
+            timeout=request_timeout)
+        if r.status_code in (429, 504):
+            r.close()
+            tsec = t * 60
+            log.info(f"Overpass server is busy (HTTP {r.status_code}), waiting {tsec} seconds.")
+            time.sleep(tsec)
+            continue
+        r.raise_for_status()
+        return r
+    log.error("Giving up on Overpass requests")
+    raise overpy.exception.OverpassTooManyRequests("Giving up")
+
+
+def check_remark(remark):
+    """Raise OverpassRuntimeError if remark from an Overpass response
+    reports a runtime error, e.g. a timeout, which truncates the
+    response."""
+    if remark and "runtime error" in remark:
+        raise overpy.exception.OverpassRuntimeError(msg=remark)
+
+
+def apiquery_json(query):
+    """Make an Overpass query and return the JSON response as a dict."""
+    data = apiquery_response(query).json()
+    check_remark(data.get("remark", None))
+    return data
+
+
+def apiquery_elements(query):
+    """Make an Overpass query with JSON output and iterate over the element
+    dicts in the response while it is being downloaded. The response is
+    parsed incrementally with ijson if it is installed. A runtime error
+    reported after the elements raises OverpassRuntimeError."""
+    with apiquery_response(query, stream=True) as r:
+        r.raw.decode_content = True
+        try:
+            import ijson
+        except ImportError:
+            log.debug("ijson not found, reading the whole response")
+            data = json.load(r.raw)
+            check_remark(data.get("remark", None))
+            yield from data.get("elements", [])
+            return
+        remarks = []
+        def events():
+            for prefix, event, value in ijson.parse(r.raw, use_float=True):
+                if prefix == "remark" and event == "string":
+                    remarks.append(value)
+                yield (prefix, event, value)
+        yield from ijson.items(events(), "elements.item")
+        check_remark(remarks[0] if remarks else None)
+
+# Local OSM store (an osmdb.OSMDB instance). If set, route and stop queries
+# are answered from the store instead of Overpass.
+store = None
+
+
+def storequery(tfilters, types=("node", "way", "relation"), recurse=False):
+    """Return an overpy.Result with elements in area matching the tag
+    filters (see osmdb.tags_match()) from the local store."""
+    return store.result(tfilters, types, recurse, bbox=area_bbox(area), api=api)
+
+# Areas must be initialized by e.g. hsl.overpass_area before queries.
+# An area is given as a sequence of (name, ref) tuples of municipalities,
+# i.e. administrative areas with admin_level=8.
 area = None
 stopref_area = None
 
+# Persistent cache of Overpass area ids and bounding boxes
+area_cache_file = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "taival", "overpass_areas.json")
+area_cache = None
+
+
+def load_area_cache():
+    """Return the area cache dict, read from area_cache_file if needed."""
+    global area_cache
+    if area_cache is None:
+        try:
+            with open(area_cache_file, "r") as f:
+                area_cache = json.load(f)
+        except (OSError, ValueError):
+            area_cache = {}
+    return area_cache
+
+
+def save_area_cache():
+    os.makedirs(os.path.dirname(area_cache_file), exist_ok=True)
+    with open(area_cache_file, "w") as f:
+        json.dump(area_cache, f, indent=1, sort_keys=True)
+
+
+def resolve_adminarea(name, ref):
+    """Return a dict with the Overpass area id and bounding box
+    [south, west, north, east] of an administrative area with admin_level=8,
+    from cache or from an Overpass query."""
+    cache = load_area_cache()
+    key = f"{name}|{ref}"
+    if key in cache:
+        return cache[key]
+    q = '[out:json][timeout:120];rel[boundary=administrative][admin_level=8][name="%s"][ref="%s"];out ids;>;out skel qt;' % (name, ref)
+    log.debug(q)
+    rr = apiquery(q)
+    if not rr.relations or not rr.nodes:
+        raise ValueError(f"Administrative area '{name}' with ref '{ref}' not found")
+    if len(rr.relations) > 1:
+        log.warning(f"More than one administrative area with name '{name}' and ref '{ref}'")
+    # Overpass area id of a relation is the relation id + 3600000000
+    areaid = 3600000000 + rr.relations[0].id
+    lats = [ float(n.lat) for n in rr.nodes ]
+    lons = [ float(n.lon) for n in rr.nodes ]
+    cache[key] = {
+        "areaid": areaid,
+        "bbox": [min(lats), min(lons), max(lats), max(lons)],
+    }
+    save_area_cache()
+    return cache[key]
+
+
+# Persistent cache of municipality boundaries
+boundary_cache_file = os.path.join(os.path.dirname(area_cache_file),
+    "boundaries.json")
+boundary_cache = None
+
+
+def assemble_rings(segments):
+    """Return a list of rings, lists of points, joined from the point
+    lists in segments by their end points. Segments which do not form a
+    closed ring are returned joined as far as possible."""
+    segs = [ list(s) for s in segments if len(s) > 1 ]
+    rings = []
+    while segs:
+        ring = segs.pop(0)
+        while ring[0] != ring[-1]:
+            for i, s in enumerate(segs):
+                if s[0] == ring[-1]:
+                    ring.extend(s[1:])
+                    break
+                elif s[-1] == ring[-1]:
+                    ring.extend(reversed(s[:-1]))
+                    break
+            else:
+                log.warning("Boundary ring is not closed")
+                break
+            segs.pop(i)
+        rings.append(ring)
+    return rings
+
+
+def city_boundary(name, ref):
+    """Return the boundary of an administrative area with admin_level=8 as
+    a list of rings of (lat, lon) points, outer and inner, from cache or
+    from an Overpass query."""
+    global boundary_cache
+    if boundary_cache is None:
+        try:
+            with open(boundary_cache_file, "r") as f:
+                boundary_cache = json.load(f)
+        except (OSError, ValueError):
+            boundary_cache = {}
+    key = f"{name}|{ref}"
+    if key not in boundary_cache:
+        q = '[out:json][timeout:120];rel[boundary=administrative][admin_level=8][name="%s"][ref="%s"];out geom;' % (name, ref)
+        log.debug(q)
+        rels = [ e for e in apiquery_json(q).get("elements", [])
+            if e["type"] == "relation" ]
+        if not rels:
+            raise ValueError(f"Administrative area '{name}' with ref '{ref}' not found")
+        segments = [ [ (p["lat"], p["lon"]) for p in m["geometry"] ]
+            for m in rels[0]["members"]
+            if m["type"] == "way" and m.get("role", "") in ("outer", "inner")
+              and m.get("geometry", None) ]
+        boundary_cache[key] = assemble_rings(segments)
+        os.makedirs(os.path.dirname(boundary_cache_file), exist_ok=True)
+        with open(boundary_cache_file, "w") as f:
+            json.dump(boundary_cache, f)
+    return [ [ tuple(p) for p in ring ] for ring in boundary_cache[key] ]
+
+
+def city_boundaries(adminareas):
+    """Return a dict of name -> boundary rings (see city_boundary()) of
+    adminareas, a sequence of (name, ref) tuples."""
+    return { n: city_boundary(n, r) for n, r in adminareas }
+
+
+def area_bbox(adminareas):
+    """Return bounding box [south, west, north, east] of all adminareas."""
+    bboxes = [ resolve_adminarea(n, r)["bbox"] for n, r in adminareas ]
+    return [ min(b[0] for b in bboxes), min(b[1] for b in bboxes),
+             max(b[2] for b in bboxes), max(b[3] for b in bboxes) ]
+
+
+def query_head(timeout=None, adminareas=None, bbox=False):
+    """Return Overpass query settings and a statement setting the area set
+    '.hel' to adminareas (by default 'area'), with area ids resolved
+    beforehand. If bbox is True, the area bounding box is set as a global
+    bbox filter. The global bbox also drops elements outside it from
+    recursions, so it must only be used in queries which do not recurse
+    to members, like the stop and station queries."""
+    adminareas = area if adminareas is None else adminareas
+    ids = [ str(resolve_adminarea(n, r)["areaid"]) for n, r in adminareas ]
+    settings = "[out:json]"
+    if timeout:
+        settings += f"[timeout:{timeout}]"
+    if bbox:
+        settings += "[bbox:{:.6f},{:.6f},{:.6f},{:.6f}]".format(
+            *area_bbox(adminareas))
+    return "{};\narea(id:{})->.hel;".format(settings, ",".join(ids))
+
 stoptags = {
     "train": [
         { "railway": "station" },
@@ -123,20 +341,157 @@ def ndist2(n1, n2):
 
 # route relations
 
-overpy_route_cache = { k: None for k in list(stoptags.keys()) + ["minibus"] }
+class RouteIndex:
+    """Compact records of route relations and the elements they reference,
+    built from a stream of element dicts in Overpass JSON format.
 
-def get_route_rr(mode="bus"):
+    Nodes are stored as (lat, lon, tags) tuples, ways as (node ids, tags)
+    tuples and relations as (tags, members) tuples, where members is a
+    tuple of (type, ref, role) tuples. Tags are None for untagged elements.
     """
-    Return a (possibly cached) overpy.Result object with all the routes
-    for mode in area.
+
+    def __init__(self, elements=()):
+        self.nodes = {}
+        self.ways = {}
+        self.relations = {}
+        for e in elements:
+            self.add(e)
+        self.prune()
+
+    def add(self, e):
+        tags = e.get("tags", None) or None
+        etype = e["type"]
+        if etype == "node":
+            self.nodes[e["id"]] = (float(e["lat"]), float(e["lon"]), tags)
+        elif etype == "way":
+            self.ways[e["id"]] = (tuple(e["nodes"]), tags)
+        elif etype == "relation":
+            self.relations[e["id"]] = (tags, tuple((m["type"], m["ref"], m["role"])
+                for m in e["members"]))
+
+    def prune(self):
+        """Drop ways and nodes not referenced by any relation."""
+        wayids = set()
+        nodeids = set()
+        for _, members in self.relations.values():
+            for mtype, ref, _ in members:
+                if mtype == "way":
+                    wayids.add(ref)
+                elif mtype == "node":
+                    nodeids.add(ref)
+        self.ways = { k: v for k, v in self.ways.items() if k in wayids }
+        for nodes, _ in self.ways.values():
+            nodeids.update(nodes)
+        self.nodes = { k: v for k, v in self.nodes.items() if k in nodeids }
+
+    def tags(self, relid):
+        return self.relations[relid][0] or {}
+
+    def elements(self, relids):
+        """Return a list of element dicts for relations in relids and all
+        elements they reference, recursively."""
+        out = []
+        seen = set()
+        stack = [ ("relation", r) for r in reversed(relids) ]
+        while stack:
+            key = stack.pop()
+            if key in seen:
+                continue
+            seen.add(key)
+            etype, eid = key
+            if etype == "node" and eid in self.nodes:
+                lat, lon, tags = self.nodes[eid]
+                e = { "type": etype, "id": eid, "lat": lat, "lon": lon }
+            elif etype == "way" and eid in self.ways:
+                nodes, tags = self.ways[eid]
+                e = { "type": etype, "id": eid, "nodes": list(nodes) }
+                stack.extend(("node", n) for n in reversed(nodes))
+            elif etype == "relation" and eid in self.relations:
+                tags, members = self.relations[eid]
+                e = { "type": etype, "id": eid, "members": [
+                    { "type": t, "ref": r, "role": role }
+                    for t, r, role in members ] }
+                stack.extend((t, r) for t, r, _ in reversed(members))
+            else:
+                continue
+            if tags:
+                e["tags"] = tags
+            out.append(e)
+        return out
+
+    def fingerprint(self, relids):
+        """Return a hex digest of the relations in relids and all the
+        elements they reference, which changes if any of them changes."""
+        h = hashlib.sha1()
+        for e in self.elements(relids):
+            h.update(json.dumps(e, sort_keys=True).encode("utf-8"))
+        return h.hexdigest()
+
+    def result(self, relids):
+        """Return an overpy.Result with relations in relids and their
+        members."""
+        return overpy.Result.from_json(
+            { "elements": self.elements(relids) }, api=api)
+
+
+route_index_cache = {}
+
+# If set to a list of line refs, route indexes only contain routes with
+# these refs, which are fetched with a targeted query.
+route_refs = None
+
+def get_route_index(mode="bus"):
     """
-    if overpy_route_cache.get(mode, None):
-        return overpy_route_cache[mode]
-    q = '[out:json][timeout:600];%s\nrel(area.hel)[type=route][route="%s"][ref];(._;>;>;);out body;' % (area, mode)
-    log.debug(q)
-    rr = apiquery(q)
-    overpy_route_cache[mode] = rr
-    return rr
+    Return a (possibly cached) RouteIndex with all the routes with a ref
+    (or a ref in route_refs) for mode in area.
+    """
+    key = (mode, tuple(route_refs) if route_refs else None)
+    if route_index_cache.get(key, None):
+        return route_index_cache[key]
+    if store:
+        refval = re.compile("^(" + "|".join(re.escape(r) for r in route_refs)
+            + ")$") if route_refs else True
+        elems = store.elements([{ "type": "route", "route": mode, "ref": refval }],
+            ("relation",), recurse=True, bbox=area_bbox(area))
+    else:
+        if route_refs:
+            rq = "(\n" + "\n".join('rel(area.hel)[type=route][route="%s"][ref="%s"];'
+                % (mode, r) for r in route_refs) + "\n);"
+        else:
+            rq = 'rel(area.hel)[type=route][route="%s"][ref];' % mode
+        q = '%s\n%s(._;>;>;);out body;' % (query_head(600), rq)
+        log.debug(q)
+        elems = apiquery_elements(q)
+    ri = RouteIndex(elems)
+    log.debug(f"Route index for {mode}: {len(ri.relations)} relations, {len(ri.ways)} ways, {len(ri.nodes)} nodes")
+    route_index_cache[key] = ri
+    return ri
+
+
+def free_route_index(mode=None):
+    """Remove route indexes for mode, or all modes, from cache."""
+    for key in list(route_index_cache.keys()):
+        if mode is None or key[0] == mode:
+            route_index_cache.pop(key)
+
+
+def route_tags(mode="bus"):
+    """Return a relid -> tags dict of all routes with a ref for mode in
+    area. Uses the route index if all routes are in it, otherwise makes
+    a query for tags only."""
+    ri = route_index_cache.get((mode, None), None)
+    if ri is None and not route_refs:
+        ri = get_route_index(mode)
+    if ri:
+        return { relid: ri.tags(relid) for relid in ri.relations.keys() }
+    if store:
+        elems = store.elements([{ "type": "route", "route": mode, "ref": True }],
+            ("relation",), recurse=False, bbox=area_bbox(area))
+    else:
+        q = '%s\nrel(area.hel)[type=route][route="%s"][ref];out tags;' % (query_head(300), mode)
+        log.debug(q)
+        elems = apiquery_elements(q)
+    return { e["id"]: e.get("tags", {}) for e in elems if e["type"] == "relation" }
 
 
 def all_linerefs(mode, networks):
@@ -145,12 +500,11 @@ def all_linerefs(mode, networks):
     "network" tag one of the values in networks list, or no network.
     URLs points to the relations in OSM.
     """
-    rr = get_route_rr(mode)
     refs = defaultdict(list)
-    for r in rr.relations:
-        if "ref" in r.tags.keys() and \
-          (not "network" in r.tags.keys() or r.tags["network"] in networks):
-            refs[r.tags["ref"]].append(relid2url(r.id))
+    for relid, tags in route_tags(mode).items():
+        if "ref" in tags.keys() and \
+          (not "network" in tags.keys() or tags["network"] in networks):
+            refs[tags["ref"]].append(relid2url(relid))
     return refs
 
 
@@ -158,7 +512,7 @@ def rels_query(lineref, mode="bus"):
     """Get public transport routes corresponding to lineref in area from
     a direct query.
     """
-    q = '%s\nrel(area.hel)[route="%s"][ref="%s"];(._;>;>;);out body;' % (area, mode, lineref)
+    q = '%s\nrel(area.hel)[route="%s"][ref="%s"];(._;>;>;);out body;' % (query_head(), mode, lineref)
     log.debug(q)
     rr = apiquery(q)
     return rr.relations
@@ -168,21 +522,46 @@ def rels_refless(mode):
     """
     Get routes for mode which do not have a ref tag.
     """
-    q = '[out:json][timeout:300];%s\nrel(area.hel)[type=route][route="%s"][!ref];(._;);out tags;' % (area, mode)
+    if store:
+        return storequery([{ "type": "route", "route": mode, "ref": None }],
+            ("relation",)).relations
+    q = '%s\nrel(area.hel)[type=route][route="%s"][!ref];(._;);out tags;' % (query_head(300), mode)
     log.debug(q)
     rr = apiquery(q)
     return rr.relations
 
 
+def line_relids(lineref, mode="bus", networks=None):
+    """Return ids of route relations for lineref and mode in area."""
+    ri = get_route_index(mode)
+    relids = [ r for r in ri.relations.keys()
+        if ri.tags(r).get("ref", None) == lineref ]
+    if networks:
+        relids = [ r for r in relids
+            if ri.tags(r).get("network", None) in networks ]
+    return relids
+
+
+def rels_fingerprint(lineref, mode="bus", networks=None):
+    """Return a fingerprint of the OSM data of the routes returned by
+    rels() with the same arguments."""
+    return get_route_index(mode).fingerprint(
+        line_relids(lineref, mode, networks))
+
+
 def rels(lineref, mode="bus", networks=None):
     """
     Get all lines corresponding to lineref and mode in area.
+
+    The relations are returned in an overpy.Result containing only them
+    and their members.
     """
-    rr = get_route_rr(mode)
-    retval = [ r for r in rr.relations if r.tags.get("ref", None) == lineref ]
-    if networks:
-        retval = [ r for r in retval if r.tags.get("network", None) in networks ]
-    return retval
+    ri = get_route_index(mode)
+    relids = line_relids(lineref, mode, networks)
+    if not relids:
+        return []
+    rr = ri.result(relids)
+    return [ rr.get_relation(r) for r in relids ]
 
 
 def rel_members_w_role(rel, rstart):
@@ -342,14 +721,35 @@ def route_shape(rel):
     latlon = [[float(n.lat), float(n.lon)] for n in nodes]
     return (latlon, gaps)
 
+
+def route_member_values(rels):
+    """Return a dict with the values derived from members of route
+    relations in rels, which are stored with collected lines, so that
+    reports can be made without network access."""
+    shapegaps = [route_shape(rel) for rel in rels]
+    return {
+        "osmshapes": [shape for shape, _ in shapegaps],
+        "osmgaps": [gaps for _, gaps in shapegaps],
+        "osmplatforms": [route_platforms_or_stops(rel) for rel in rels],
+        "osmstopcounts": [ (len([m for m in rel.members if m.role == "stop"]),
+            len([m for m in rel.members if m.role == "platform"]))
+            for rel in rels ],
+    }
+
 # Former routes
 
+old_networks_re = re.compile("HSL|Helsinki|Espoo|Vantaa")
+
 def was_routes(mode="bus"):
     """Return a lineref:[urllist] dict of all was:route=<mode> routes in
     Helsinki region. URLs points to the relations in OSM."""
-    q = '[out:json][timeout:300];%s\nrel(area.hel)[type="was:route"]["was:route"="%s"][network~"HSL|Helsinki|Espoo|Vantaa"];out tags;' % (area, mode)
-    log.debug(q)
-    rr = apiquery(q)
+    if store:
+        rr = storequery([{ "type": "was:route", "was:route": mode,
+            "network": old_networks_re }], ("relation",))
+    else:
+        q = '%s\nrel(area.hel)[type="was:route"]["was:route"="%s"][network~"HSL|Helsinki|Espoo|Vantaa"];out tags;' % (query_head(300), mode)
+        log.debug(q)
+        rr = apiquery(q)
     refs = defaultdict(list)
     for r in rr.relations:
         if "ref" in r.tags.keys():
@@ -360,9 +760,13 @@ def was_routes(mode="bus"):
 def disused_routes(mode="bus"):
     """Return a lineref:[urllist] dict of all disused:route=<mode> routes in
     Helsinki region. URLs points to the relations in OSM."""
-    q = '[out:json][timeout:300];%s\nrel(area.hel)[type="disused:route"]["disused:route"="%s"][network~"HSL|Helsinki|Espoo|Vantaa"];out tags;' % (area, mode)
-    log.debug(q)
-    rr = apiquery(q)
+    if store:
+        rr = storequery([{ "type": "disused:route", "disused:route": mode,
+            "network": old_networks_re }], ("relation",))
+    else:
+        q = '%s\nrel(area.hel)[type="disused:route"]["disused:route"="%s"][network~"HSL|Helsinki|Espoo|Vantaa"];out tags;' % (query_head(300), mode)
+        log.debug(q)
+        rr = apiquery(q)
     refs = defaultdict(list)
     for r in rr.relations:
         if "ref" in r.tags.keys():
@@ -377,13 +781,20 @@ overpy_route_master_dict = { k: None for k in list(stoptags.keys()) + ["minibus"
 def get_route_master_dict(mode, agency):
     """
     Return a (possibly cached) ref->route_master rel dict with all
-    route_master relations for mode and network (i.e. agency) with a ref.
+    route_master relations for mode and network (i.e. agency) with a ref,
+    which have member routes in area.
     """
     if overpy_route_master_dict.get(mode, None):
         return overpy_route_master_dict[mode]
-    q = '[out:json][timeout:300];rel[type=route_master][route_master="%s"][network="%s"];(._;>;>;);out body;' % (mode, agency)
-    log.debug(q)
-    rr = apiquery(q)
+    # Find route_masters as parents of routes in area, members are not
+    # recursed, since only member ids and tags are used.
+    if store:
+        rr = storequery([{ "type": "route_master", "route_master": mode,
+            "network": agency }], ("relation",))
+    else:
+        q = '%s\nrel(area.hel)[type=route][route="%s"];rel(br)[type=route_master][route_master="%s"][network="%s"];out body;' % (query_head(300), mode, mode, agency)
+        log.debug(q)
+        rr = apiquery(q)
     rmd = defaultdict(list)
     for rel in rr.relations:
         ref = rel.tags.get("ref", None)
@@ -407,30 +818,87 @@ def route_master(route_ids):
 
 # Stops
 
+def compile_modetags(modetags):
+    """Compile a mode -> [tag dict] template (like stoptags) into a matcher
+    tuple (modes, index) for tags2modemask().
+
+    Bit i of the mode mask corresponds to modes[i]. The index is a two-level
+    dict key -> value -> [(modebit, required, absent)], keyed by the first
+    tag in the template with a value. The remaining tags of the template are
+    given in 'required' as (key, value) pairs and keys which must not be
+    present (value None in the template) in 'absent'.
+    """
+    modes = list(modetags.keys())
+    index = defaultdict(lambda: defaultdict(list))
+    for bit, mode in enumerate(modes):
+        for mtags in modetags[mode]:
+            required = [ (k, v) for k, v in mtags.items() if v is not None ]
+            absent = tuple(k for k, v in mtags.items() if v is None)
+            if not required:
+                continue
+            k0, v0 = required[0]
+            index[k0][v0].append((1 << bit, tuple(required[1:]), absent))
+    return (modes, { k: dict(v) for k, v in index.items() })
+
+
+stopmatcher = compile_modetags(stoptags)
+stationmatcher = compile_modetags(stationtags)
+
+_train_bit = 1 << stopmatcher[0].index("train")
+_not_train_bits = (1 << stopmatcher[0].index("subway")) \
+  | (1 << stopmatcher[0].index("monorail"))
+
+
+def tags2modemask(otags, matcher=stopmatcher):
+    """Return a bitmask of the modes in compiled matcher which match the
+    tags in otags."""
+    index = matcher[1]
+    mask = 0
+    for k, vdict in index.items():
+        v = otags.get(k, None)
+        if v is None:
+            continue
+        for bit, required, absent in vdict.get(v, ()):
+            if mask & bit:
+                continue
+            if all(otags.get(rk, None) == rv for rk, rv in required) \
+              and not any(ak in otags for ak in absent):
+                mask |= bit
+    if matcher is stopmatcher and (mask & _not_train_bits):
+        # train always matches also subway and monorail tags
+        mask &= ~_train_bit
+    return mask
+
+
+def modemask2modes(mask, matcher=stopmatcher):
+    """Return a list of mode strings corresponding to bits set in mask."""
+    return [ m for i, m in enumerate(matcher[0]) if mask & (1 << i) ]
+
+
 def stoptags2mode(otags):
     """Return a list of mode strings which correspond to OSM tags."""
-    outl = []
-    for mode, mtaglist in stoptags.items():
-        match = False
-        for mtags in mtaglist:
-            so_far_ok = True
-            for k, v in mtags.items():
-                if (not k in otags.keys()) or otags[k] != v:
-                    so_far_ok = False
-                    break
-            if so_far_ok:
-                match = True
-                break
-        if match:
-            outl.append(mode)
-    # train always matches also subway and monorail tags
-    if "train" in outl and ("subway" in outl or "monorail" in outl):
-        outl.remove("train")
-    return outl
+    return modemask2modes(tags2modemask(otags))
+
+
+def stationtags2mode(otags):
+    """Return a list of station mode strings which correspond to OSM tags."""
+    return modemask2modes(tags2modemask(otags, stationmatcher), stationmatcher)
+
 
+def stopmodes(s):
+    """Return the list of modes of a stop dict, as stored in 'x:modes' by
+    stops() and stations(), or from the tags for older data."""
+    modes = s.get("x:modes", None)
+    return modes if modes is not None else stoptags2mode(s)
+
+
+_ovptags_cache = {}
 
 def mode2ovptags(mode, modetags=stoptags):
     """Return a list of Overpass tag filters."""
+    ckey = (id(modetags), mode)
+    if ckey in _ovptags_cache:
+        return _ovptags_cache[ckey]
     tlist = modetags[mode]
     out = []
     for tags in tlist:
@@ -442,28 +910,68 @@ def mode2ovptags(mode, modetags=stoptags):
                 ovp += '[!"{}"]'.format(k)
         if ovp:
             out.append(ovp)
+    _ovptags_cache[ckey] = out
     return out
 
 
-def stops_by_refs(refs, mode="bus"):
-    """Return a list of OSM node ids which have one of the 'ref' tag values in
-    a given refs list."""
+def stopref_index(refstops, mode=None):
+    """Return a ref -> [(type, id)] dict for looking up OSM stop objects by
+    ref, built from a ref -> [stop dict] dict like the one returned by
+    stops() (and stored as 'ost' by 'collect stops').
+
+    Objects are indexed both under the refstops key and their 'ref' tag.
+    If mode is given, only stops with that mode are included.
+    """
+    index = defaultdict(list)
+    for key, slist in refstops.items():
+        for s in slist:
+            if mode and mode not in stopmodes(s):
+                continue
+            oid = (xtype2osm[s["x:type"]], s["x:id"])
+            for ref in set((key, s.get("ref", key))):
+                if oid not in index[ref]:
+                    index[ref].append(oid)
+    return index
+
+
+def stops_by_refs_query(refs, mode="bus"):
+    """Return a ref -> [(type, id)] dict of OSM objects which have one of the
+    'ref' tag values in a given refs list, from an exact match Overpass
+    query."""
     stoptags = mode2ovptags(mode)
-    refpat = "|".join(str(r) for r in refs)
-    q = stopref_area + "(\n"
-    for st in stoptags:
-        q += 'node(area.hel){}[ref~"({})"];\n'.format(st, refpat)
-        q += 'way(area.hel){}[ref~"({})"];\n'.format(st, refpat)
-        q += 'rel(area.hel){}[ref~"({})"];\n'.format(st, refpat)
+    q = query_head(None, stopref_area, bbox=True) + "\n(\n"
+    for ref in refs:
+        for st in stoptags:
+            q += 'node(area.hel){}["ref"="{}"];\n'.format(st, ref)
+            q += 'way(area.hel){}["ref"="{}"];\n'.format(st, ref)
+            q += 'rel(area.hel){}["ref"="{}"];\n'.format(st, ref)
     q += "); out tags;"
     log.debug(q)
     rr = apiquery(q)
+    found = defaultdict(list)
+    for etype, elist in (("node", rr.nodes), ("way", rr.ways),
+      ("relation", rr.relations)):
+        for e in elist:
+            found[e.tags["ref"]].append((etype, e.id))
+    return found
+
+
+def stops_by_refs(refs, mode="bus", index=None):
+    """Return a list of OSM (type, id) tuples which have one of the 'ref' tag
+    values in a given refs list.
+
+    Refs are first looked up from index, as returned by stopref_index(),
+    refs not in the index are queried from Overpass."""
+    index = index if index is not None else {}
+    unknown = [ r for r in set(refs) if not index.get(r, None) ]
+    if unknown:
+        log.debug(f"Querying {len(unknown)} stop refs not in index from Overpass")
+        found = stops_by_refs_query(unknown, mode)
+    else:
+        found = {}
     stopids = []
     for ref in refs:
-        ids = []
-        ids.extend(("node", e.id) for e in rr.nodes if e.tags["ref"] == ref)
-        ids.extend(("way", e.id) for e in rr.ways if e.tags["ref"] == ref)
-        ids.extend(("relation", e.id) for e in rr.relations if e.tags["ref"] == ref)
+        ids = index.get(ref, None) or found.get(ref, [])
         if not ids:
             log.warning(f"OSM stop object not found for ref '{ref}'")
         elif len(ids) > 1:
@@ -483,22 +991,28 @@ def stops(mode="bus"):
     x:type  type if the object as a string of length 1 ('n', 'w', or 'r')
     x:latlon (latitude, longitude) tuple of the object, as calculated
             by osm.member_coord()
+    x:modes list of modes matching the tags, as given by stoptags2mode()
 """
     qtempl = "node(area.hel){};\nway(area.hel){};\nrel(area.hel){};"
     if isinstance(mode, list):
         qlist = [ e for m in mode for e in mode2ovptags(m) ]
     else:
         qlist = mode2ovptags(mode)
-    q = "[out:json][timeout:120];\n" + area + "\n(\n" \
-      + "\n".join([ qtempl.format(t, t, t) for t in qlist ]) + "\n);out body;"
-    log.debug(q)
-    rr = apiquery(q)
+    if store:
+        modes = mode if isinstance(mode, list) else [mode]
+        rr = storequery([ t for m in modes for t in stoptags[m] ])
+    else:
+        q = query_head(120, bbox=True) + "\n(\n" \
+          + "\n".join([ qtempl.format(t, t, t) for t in qlist ]) + "\n);out body;"
+        log.debug(q)
+        rr = apiquery(q)
     def sanitize_add(sd, rd, elist, etype):
         for e in elist:
             dd =  { \
                 "x:id": e.id,
                 "x:type": etype,
                 "x:latlon": member_coord(e),
+                "x:modes": stoptags2mode(e.tags),
             }
             dd.update(e.tags)
             ref = e.tags.get("ref", None)
@@ -530,22 +1044,28 @@ def stations(mode="bus"):
     x:type  type if the object as a string of length 1 ('n', 'w', or 'r')
     x:latlon (latitude, longitude) tuple of the object, as calculated
             by osm.member_coord()
+    x:modes list of modes matching the tags, as given by stationtags2mode()
 """
     qtempl = "node(area.hel){};\nway(area.hel){};\nrel(area.hel){};"
     if isinstance(mode, list):
         qlist = [ e for m in mode for e in mode2ovptags(m, stationtags) ]
     else:
         qlist = mode2ovptags(mode, stationtags)
-    q = "[out:json][timeout:120];\n" + area + "\n(\n" \
-      + "\n".join([ qtempl.format(t, t, t) for t in qlist ]) + "\n);out body;"
-    log.debug(q)
-    rr = apiquery(q)
+    if store:
+        modes = mode if isinstance(mode, list) else [mode]
+        rr = storequery([ t for m in modes for t in stationtags[m] ])
+    else:
+        q = query_head(120, bbox=True) + "\n(\n" \
+          + "\n".join([ qtempl.format(t, t, t) for t in qlist ]) + "\n);out body;"
+        log.debug(q)
+        rr = apiquery(q)
     def sanitize_addlist(sl, elist, etype):
         for e in elist:
             dd =  { \
                 "x:id": e.id,
                 "x:type": etype,
                 "x:latlon": member_coord(e),
+                "x:modes": stationtags2mode(e.tags),
             }
             dd.update(e.tags)
             sl.append(dd)
@@ -565,10 +1085,13 @@ def citybikes():
     qlist = []
     for tags in citybiketags:
         qlist.append(''.join([ '["{}"="{}"]'.format(k, v) for k, v in tags.items() ]))
-    q = "[out:json][timeout:120];\n" + area + "\n(\n" \
-      + "\n".join([ qtempl.format(t, t, t) for t in qlist ]) + "\n);out body;"
-    log.debug(q)
-    rr = apiquery(q)
+    if store:
+        rr = storequery(citybiketags)
+    else:
+        q = query_head(120, bbox=True) + "\n(\n" \
+          + "\n".join([ qtempl.format(t, t, t) for t in qlist ]) + "\n);out body;"
+        log.debug(q)
+        rr = apiquery(q)
     def sanitize_add(sd, rd, elist, etype):
         for e in elist:
             dd =  { \
@@ -594,3 +1117,30 @@ def citybikes():
     sanitize_add(refstops, rest, rr.relations, "r")
     return refstops, rest
 
+
+def store_tfilters():
+    """Return a list of tag filters for stops, stations and citybike
+    stations, which are kept in a local store in addition to routes and
+    their members."""
+    return [ t for tl in stoptags.values() for t in tl ] \
+      + [ t for tl in stationtags.values() for t in tl ] + citybiketags
+
+
+def store_seed_query():
+    """Return an Overpass query for seeding a local store with the data
+    needed by collects in area, i.e. routes, their route_masters, former
+    routes, stops, stations and citybike stations with all their members."""
+    qtempl = "node(area.hel){};\nway(area.hel){};\nrel(area.hel){};"
+    tlist = [ t for m in stoptags.keys() for t in mode2ovptags(m) ]
+    tlist += [ t for m in stationtags.keys()
+        for t in mode2ovptags(m, stationtags) ]
+    tlist += [ ''.join('["{}"="{}"]'.format(k, v) for k, v in tags.items())
+        for tags in citybiketags ]
+    tlist = sorted(set(tlist))
+    q = query_head(3600) + "\n" \
+      + "rel(area.hel)[type=route]->.routes;\n(\n.routes;\n" \
+      + "rel(br.routes)[type=route_master];\n" \
+      + 'rel(area.hel)[type~"^(was|disused):route$"];\n' \
+      + "\n".join([ qtempl.format(t, t, t) for t in tlist ]) \
+      + "\n);\n(._;>;>;);\nout meta;"
+    return q
@@ -0,0 +1,491 @@
+# Copyright (C) 2018-2021 Teemu Ikonen <tpikonen@gmail.com>
+
+# This file is part of Taival.
+# Taival is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License version 3 as published by the
+# Free Software Foundation. See the file COPYING for license text.
+
+# Local OSM data store for an area, kept up to date by applying OSM change
+# files (osmChange or Overpass augmented diffs) from a replication server.
+
+import datetime, gzip, io, json, logging, sqlite3
+import xml.etree.ElementTree as ET
+import overpy
+import requests
+
+log = logging.getLogger(__name__)
+
+default_replication_url = "https://planet.openstreetmap.org/replication/minute/"
+
+# Timeout in seconds for replication server requests
+request_timeout = 60
+
+schema = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS node (id INTEGER PRIMARY KEY, version INTEGER,
+    lat REAL, lon REAL, tags TEXT);
+CREATE TABLE IF NOT EXISTS way (id INTEGER PRIMARY KEY, version INTEGER,
+    nodes TEXT, tags TEXT);
+CREATE TABLE IF NOT EXISTS relation (id INTEGER PRIMARY KEY, version INTEGER,
+    members TEXT, tags TEXT);
+CREATE TABLE IF NOT EXISTS tag (type TEXT, id INTEGER, k TEXT, v TEXT);
+CREATE INDEX IF NOT EXISTS tag_kv ON tag (k, v);
+CREATE INDEX IF NOT EXISTS tag_elem ON tag (type, id);
+"""
+
+etypes = ("node", "way", "relation")
+# Element types in Overpass queries
+ovptypes = { "node": "node", "way": "way", "relation": "rel" }
+
+
+def tags_match(tags, tfilter):
+    """Return True if tags dict matches the tag filter dict tfilter.
+
+    A filter value can be a string (tag must have this value), None (tag
+    must not be present), True (tag must be present with any value) or a
+    compiled regular expression (tag value must match with search())."""
+    for k, v in tfilter.items():
+        tv = tags.get(k, None)
+        if v is None:
+            if tv is not None:
+                return False
+        elif tv is None:
+            return False
+        elif v is True:
+            continue
+        elif isinstance(v, str):
+            if tv != v:
+                return False
+        elif not v.search(tv):
+            return False
+    return True
+
+
+def seqpath(seq):
+    """Return replication file path 'AAA/BBB/CCC' for a sequence number."""
+    s = "{:09d}".format(seq)
+    return "/".join((s[0:3], s[3:6], s[6:9]))
+
+
+def parse_state(text):
+    """Return (sequence, timestamp) tuple from replication state.txt text."""
+    state = {}
+    for line in text.splitlines():
+        if "=" in line and not line.startswith("#"):
+            k, v = line.split("=", 1)
+            state[k.strip()] = v.strip().replace("\\", "")
+    ts = datetime.datetime.strptime(state["timestamp"], "%Y-%m-%dT%H:%M:%SZ")
+    return (int(state["sequenceNumber"]), ts)
+
+
+def open_maybe_gzip(fname):
+    """Open a binary file for reading, decompressing gzip files."""
+    f = open(fname, "rb")
+    magic = f.read(2)
+    f.seek(0)
+    return gzip.GzipFile(fileobj=f) if magic == b"\x1f\x8b" else f
+
+
+def xml2element(x):
+    """Return an Overpass JSON style element dict from an XML element."""
+    etype = x.tag
+    e = { "type": etype, "id": int(x.get("id")) }
+    if x.get("version"):
+        e["version"] = int(x.get("version"))
+    tags = { t.get("k"): t.get("v") for t in x.findall("tag") }
+    if tags:
+        e["tags"] = tags
+    if etype == "node":
+        if x.get("lat") is not None:
+            e["lat"] = float(x.get("lat"))
+            e["lon"] = float(x.get("lon"))
+    elif etype == "way":
+        e["nodes"] = [ int(n.get("ref")) for n in x.findall("nd") ]
+    elif etype == "relation":
+        e["members"] = [ { "type": m.get("type"), "ref": int(m.get("ref")),
+            "role": m.get("role", "") } for m in x.findall("member") ]
+    return e
+
+
+def iter_changes(f):
+    """Iterate over (action, element) tuples from a file object f containing
+    an osmChange file or an Overpass augmented diff. Action is one of
+    'create', 'modify' or 'delete'."""
+    for _, x in ET.iterparse(f, events=("end",)):
+        if x.tag in ("create", "modify", "delete"):
+            # osmChange
+            for c in x:
+                if c.tag in etypes:
+                    yield (x.tag, xml2element(c))
+            x.clear()
+        elif x.tag == "action":
+            # Augmented diff, created elements are direct children of
+            # <action>, others are in <old> and <new>.
+            action = x.get("type")
+            src = x.find("old") if action == "delete" else x.find("new")
+            src = x if src is None else src
+            for c in src:
+                if c.tag in etypes:
+                    yield (action, xml2element(c))
+            x.clear()
+
+
+class MissingElementsError(ValueError):
+    """Raised when elements referenced by a change can not be added to
+    the store."""
+    pass
+
+
+class OSMDB:
+    """OSM elements of an area stored in an SQLite database.
+
+    Elements which are referenced by changes, but are not in the store,
+    are fetched with fetch, a function which takes an Overpass query and
+    returns the JSON response as a dict. New ways matching any of the tag
+    filters in tfilters (see tags_match()) are also fetched with their
+    nodes, if they are inside the store bbox."""
+
+    def __init__(self, fname, fetch=None, tfilters=()):
+        self.fname = fname
+        self.fetch = fetch
+        self.tfilters = tfilters
+        self.conn = sqlite3.connect(fname)
+        self.conn.executescript(schema)
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def get_meta(self, key, default=None):
+        row = self.conn.execute("SELECT value FROM meta WHERE key=?",
+            (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+            (key, json.dumps(value)))
+
+    def version(self, etype, eid):
+        """Return the stored version of an element (0 if the version is not
+        known), or None if the element is not in the store."""
+        row = self.conn.execute(f"SELECT version FROM {etype} WHERE id=?",
+            (eid,)).fetchone()
+        return None if row is None else (row[0] or 0)
+
+    def put(self, e):
+        """Store element dict e in Overpass JSON format."""
+        etype = e["type"]
+        eid = e["id"]
+        tags = e.get("tags", None)
+        tagstr = json.dumps(tags) if tags else None
+        if etype == "node":
+            self.conn.execute("INSERT OR REPLACE INTO node VALUES (?, ?, ?, ?, ?)",
+                (eid, e.get("version"), e["lat"], e["lon"], tagstr))
+        elif etype == "way":
+            self.conn.execute("INSERT OR REPLACE INTO way VALUES (?, ?, ?, ?)",
+                (eid, e.get("version"), json.dumps(e["nodes"]), tagstr))
+        elif etype == "relation":
+            members = [ (m["type"], m["ref"], m["role"]) for m in e["members"] ]
+            self.conn.execute("INSERT OR REPLACE INTO relation VALUES (?, ?, ?, ?)",
+                (eid, e.get("version"), json.dumps(members), tagstr))
+        else:
+            return
+        self.conn.execute("DELETE FROM tag WHERE type=? AND id=?", (etype, eid))
+        if tags:
+            self.conn.executemany("INSERT INTO tag VALUES (?, ?, ?, ?)",
+                ((etype, eid, k, v) for k, v in tags.items()))
+
+    def delete(self, etype, eid):
+        self.conn.execute(f"DELETE FROM {etype} WHERE id=?", (eid,))
+        self.conn.execute("DELETE FROM tag WHERE type=? AND id=?", (etype, eid))
+
+    def get(self, etype, eid):
+        """Return an element dict in Overpass JSON format, or None."""
+        if etype == "node":
+            row = self.conn.execute("SELECT lat, lon, tags FROM node WHERE id=?",
+                (eid,)).fetchone()
+            if not row:
+                return None
+            e = { "type": etype, "id": eid, "lat": row[0], "lon": row[1] }
+            tags = row[2]
+        elif etype == "way":
+            row = self.conn.execute("SELECT nodes, tags FROM way WHERE id=?",
+                (eid,)).fetchone()
+            if not row:
+                return None
+            e = { "type": etype, "id": eid, "nodes": json.loads(row[0]) }
+            tags = row[1]
+        else:
+            row = self.conn.execute("SELECT members, tags FROM relation WHERE id=?",
+                (eid,)).fetchone()
+            if not row:
+                return None
+            e = { "type": etype, "id": eid, "members": [
+                { "type": t, "ref": r, "role": role }
+                for t, r, role in json.loads(row[0]) ] }
+            tags = row[1]
+        if tags:
+            e["tags"] = json.loads(tags)
+        return e
+
+    def load(self, elements):
+        """Store elements from an iterable of element dicts, replacing
+        existing ones."""
+        n = 0
+        for e in elements:
+            self.put(e)
+            n += 1
+        self.conn.commit()
+        return n
+
+    def find(self, tfilters, types=etypes):
+        """Return a list of element dicts of given types which match any of
+        the tag filters in tfilters list, see tags_match()."""
+        out = []
+        seen = set()
+        for tf in tfilters:
+            kvs = [ (k, v) for k, v in tf.items() if isinstance(v, str) ]
+            if kvs:
+                rows = self.conn.execute(
+                    "SELECT type, id FROM tag WHERE k=? AND v=?", kvs[0])
+            else:
+                k = next(k for k, v in tf.items() if v is not None)
+                rows = self.conn.execute(
+                    "SELECT type, id FROM tag WHERE k=?", (k,))
+            for etype, eid in rows.fetchall():
+                if etype not in types or (etype, eid) in seen:
+                    continue
+                e = self.get(etype, eid)
+                if e and tags_match(e.get("tags", {}), tf):
+                    seen.add((etype, eid))
+                    out.append(e)
+        return out
+
+    def recurse_down(self, elements):
+        """Return elements and all their members and nodes, recursively,
+        as a list of element dicts. Missing members are skipped."""
+        out = []
+        seen = set()
+        stack = list(reversed(elements))
+        while stack:
+            e = stack.pop()
+            key = (e["type"], e["id"])
+            if key in seen:
+                continue
+            seen.add(key)
+            out.append(e)
+            if e["type"] == "way":
+                refs = [ ("node", n) for n in e["nodes"] ]
+            elif e["type"] == "relation":
+                refs = [ (m["type"], m["ref"]) for m in e["members"] ]
+            else:
+                refs = []
+            for r in refs:
+                if r not in seen:
+                    m = self.get(*r)
+                    if m:
+                        stack.append(m)
+        return out
+
+    def in_bbox(self, e, bbox):
+        """Return True if node e, the first node of way e or the first
+        stored node or way member of relation e is inside bbox
+        [south, west, north, east]. Relations with only relation members
+        (e.g. route_masters) are always inside."""
+        if e["type"] == "relation":
+            mlist = [ m for m in e["members"] if m["type"] in ("node", "way") ]
+            if not mlist:
+                return True
+            members = ( self.get(m["type"], m["ref"]) for m in mlist )
+            e = next((m for m in members if m), None)
+            if not e:
+                return False
+        if e["type"] == "way":
+            e = self.get("node", e["nodes"][0]) if e["nodes"] else None
+            if not e:
+                return False
+        return bbox[0] <= e["lat"] <= bbox[2] and bbox[1] <= e["lon"] <= bbox[3]
+
+    def elements(self, tfilters, types=etypes, recurse=False, bbox=None):
+        """Return a list of element dicts matching tfilters, see find().
+        If recurse is True, members of the matching elements are included."""
+        elems = self.find(tfilters, types)
+        if bbox:
+            elems = [ e for e in elems if self.in_bbox(e, bbox) ]
+        if recurse:
+            elems = self.recurse_down(elems)
+        return elems
+
+    def result(self, tfilters, types=etypes, recurse=False, bbox=None, api=None):
+        """Return an overpy.Result with elements from elements()."""
+        elems = self.elements(tfilters, types, recurse, bbox)
+        return overpy.Result.from_json({ "elements": elems }, api=api)
+
+    def is_relevant(self, e):
+        """Return True if a new element from a change file should be added
+        to the store, i.e. if it is a node inside the store bbox, a way with
+        nodes in the store, or a relation with members in the store."""
+        if e["type"] == "node":
+            bbox = self.get_meta("bbox")
+            return bbox is not None and "lat" in e and self.in_bbox(e, bbox)
+        elif e["type"] == "way":
+            refs = [ ("node", n) for n in e["nodes"] ]
+        else:
+            refs = [ (m["type"], m["ref"]) for m in e["members"] ]
+        for etype in etypes:
+            ids = [ r for t, r in refs if t == etype ]
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i+500]
+                q = "SELECT 1 FROM {} WHERE id IN ({}) LIMIT 1".format(etype,
+                    ",".join("?" * len(chunk)))
+                if self.conn.execute(q, chunk).fetchone():
+                    return True
+        return False
+
+    def missing(self, elements):
+        """Return a set of (type, id) tuples of nodes of ways and members
+        of relations in elements, which are not in the store."""
+        refs = set()
+        for e in elements:
+            if e["type"] == "way":
+                refs.update(("node", n) for n in e["nodes"])
+            elif e["type"] == "relation":
+                refs.update((m["type"], m["ref"]) for m in e["members"])
+        out = set()
+        for etype in etypes:
+            ids = [ r for t, r in refs if t == etype ]
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i+500]
+                q = "SELECT id FROM {} WHERE id IN ({})".format(etype,
+                    ",".join("?" * len(chunk)))
+                found = { row[0] for row in self.conn.execute(q, chunk) }
+                out.update((etype, r) for r in chunk if r not in found)
+        return out
+
+    def fetch_query(self, missing, wayids):
+        """Return an Overpass query for elements in missing, a set of
+        (type, id) tuples, and ways with ids in wayids inside the store
+        bbox, with all their members and nodes."""
+        ids = { etype: sorted(r for t, r in missing if t == etype)
+            for etype in etypes }
+        sets = [ "{}(id:{});".format(ovptypes[t],
+            ",".join(str(i) for i in ids[t])) for t in etypes if ids[t] ]
+        if wayids:
+            bbox = ",".join(str(c) for c in self.get_meta("bbox"))
+            sets.append("way(id:{})({});".format(
+                ",".join(str(i) for i in sorted(wayids)), bbox))
+        return "[out:json][timeout:600];\n(\n" + "\n".join(sets) \
+          + "\n);\n(._;>;>;);\nout meta;"
+
+    def fetch_missing(self, missing, wayids):
+        """Fetch and store elements in missing and ways in wayids, see
+        fetch_query(). Return the number of stored elements."""
+        if self.fetch is None:
+            raise MissingElementsError(f"{len(missing)} elements referenced by changes are not in the OSM store '{self.fname}', seed it again with 'osmdb init'")
+        q = self.fetch_query(missing, wayids)
+        log.debug(q)
+        n = 0
+        for e in self.fetch(q).get("elements", []):
+            oldv = self.version(e["type"], e["id"])
+            if oldv is None or (e.get("version") or 0) >= oldv:
+                self.put(e)
+                n += 1
+        return n
+
+    def apply_change(self, f):
+        """Apply an osmChange file or an Overpass augmented diff from file
+        object f. Return a (created/modified, deleted) count tuple.
+
+        Members of created or modified ways and relations, which are not in
+        the store, are fetched afterwards. MissingElementsError is raised
+        if they can not be fetched."""
+        nmod = 0
+        ndel = 0
+        changed = {}
+        wayids = set()
+        for action, e in iter_changes(f):
+            key = (e["type"], e["id"])
+            oldv = self.version(*key)
+            newv = e.get("version", None)
+            if oldv is not None and newv is not None and oldv > newv:
+                continue
+            if action == "delete":
+                changed.pop(key, None)
+                if e["type"] == "way":
+                    wayids.discard(e["id"])
+                if oldv is not None:
+                    self.delete(*key)
+                    ndel += 1
+            elif oldv is not None or self.is_relevant(e):
+                if e["type"] == "node" and "lat" not in e:
+                    continue
+                self.put(e)
+                changed[key] = e
+                nmod += 1
+            elif e["type"] == "way" and any(tags_match(e.get("tags", {}), tf)
+                for tf in self.tfilters):
+                # A new platform or station with nodes not in the store
+                wayids.add(e["id"])
+        missing = self.missing(changed.values())
+        if missing or wayids:
+            nfetched = self.fetch_missing(missing, wayids)
+            log.info(f"Fetched {nfetched} elements missing from the OSM store")
+            nmod += nfetched
+            # Ways outside the bbox are not fetched
+            ways = [ w for w in (self.get("way", i) for i in wayids) if w ]
+            if self.missing(list(changed.values()) + ways):
+                raise MissingElementsError(f"Elements referenced by changes could not be fetched to the OSM store '{self.fname}', seed it again with 'osmdb init'")
+        return (nmod, ndel)
+
+    def apply_change_file(self, fname):
+        with open_maybe_gzip(fname) as f:
+            counts = self.apply_change(f)
+        self.conn.commit()
+        log.info(f"Applied '{fname}': {counts[0]} elements added or modified, {counts[1]} deleted")
+        return counts
+
+    def update(self, replication_url=None, maxfiles=None):
+        """Apply change files from a replication server since the stored
+        sequence number. Return the number of applied change files."""
+        url = replication_url or self.get_meta("replication_url",
+            default_replication_url)
+        url = url if url.endswith("/") else url + "/"
+        seq = self.get_meta("sequence")
+        if seq is None:
+            raise ValueError("Sequence number not set in OSM store")
+        r = requests.get(url + "state.txt", timeout=request_timeout)
+        r.raise_for_status()
+        (lastseq, _) = parse_state(r.text)
+        nfiles = 0
+        while seq < lastseq and (maxfiles is None or nfiles < maxfiles):
+            seq += 1
+            log.debug(f"Applying change file {seq}/{lastseq}")
+            r = requests.get(url + seqpath(seq) + ".osc.gz", timeout=request_timeout)
+            r.raise_for_status()
+            with gzip.GzipFile(fileobj=io.BytesIO(r.content)) as f:
+                self.apply_change(f)
+            self.set_meta("sequence", seq)
+            self.conn.commit()
+            nfiles += 1
+        self.set_meta("replication_url", url)
+        self.conn.commit()
+        log.info(f"OSM store at sequence {seq}, {nfiles} change files applied")
+        return nfiles
+
+
+def sequence_for_timestamp(url, ts):
+    """Return the latest replication sequence number at url with a
+    timestamp not later than ts (a datetime)."""
+    url = url if url.endswith("/") else url + "/"
+    r = requests.get(url + "state.txt", timeout=request_timeout)
+    r.raise_for_status()
+    (seq, seqts) = parse_state(r.text)
+    interval = 60.0
+    while seqts > ts and seq > 0:
+        # Estimate from a minutely interval, then walk back
+        step = max(1, int((seqts - ts).total_seconds() / interval))
+        seq = max(0, seq - step)
+        r = requests.get(url + seqpath(seq) + ".state.txt", timeout=request_timeout)
+        r.raise_for_status()
+        (seq, seqts) = parse_state(r.text)
+    return seq
@@ -0,0 +1,271 @@
+# Copyright (C) 2018-2021 Teemu Ikonen <tpikonen@gmail.com>
+
+# This file is part of Taival.
+# Taival is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License version 3 as published by the
+# Free Software Foundation. See the file COPYING for license text.
+
+# Report check results as streamed records.
+#
+# Instead of a mediawiki page, a report can be written as JSON lines or CSV
+# with one record per route line, stop, station or citybike station. The
+# records have the same check results as the cells in the report tables,
+# and are written as they are produced from the collected data.
+
+import csv, json, logging, re
+import osm
+import mediawiki as mw
+from util import *
+
+log = logging.getLogger(__name__)
+
+formats = ["jsonl", "csv"]
+
+style2status = {
+    mw.style_ok: "ok",
+    mw.style_maybe: "maybe",
+    mw.style_problem: "problem",
+}
+
+wikilink_re = re.compile(r"\[\[#[^|\]]*\|\s*([^\]]*?)\s*\]\]")
+extlink_re = re.compile(r"\[[a-z]+://[^ \]]* ([^\]]*)\]")
+
+
+def plain(text):
+    """Return cell text with wiki links replaced by their labels."""
+    return extlink_re.sub(r"\1", wikilink_re.sub(r"\1", str(text)))
+
+
+def row_status(styles, details=""):
+    """Return the status of a row with cell styles and details."""
+    if details or mw.style_problem in styles:
+        return "problem"
+    elif mw.style_maybe in styles:
+        return "maybe"
+    else:
+        return "ok"
+
+
+def check_fields(checks):
+    """Return record field names for (name, check function) pairs."""
+    return [ f for name, _ in checks for f in (name, name + ":status") ]
+
+
+def add_cells(rec, cells):
+    """Add (name, style, text, details) cells to record rec, with details
+    and the status of the row."""
+    details = "\n".join(c[3] for c in cells if c[3])
+    for name, style, text, _ in cells:
+        rec[name] = plain(text)
+        rec[name + ":status"] = style2status.get(style, "")
+    rec["status"] = row_status([c[1] for c in cells], details)
+    rec["details"] = details
+    return rec
+
+
+def osm_ids(oslist):
+    """Return a string with 'type/id' of OSM objects in oslist."""
+    return " ".join("{}/{}".format(osm.xtype2osm[e["x:type"]], e["x:id"])
+        for e in oslist)
+
+
+class JsonlWriter:
+    """Write records as JSON lines to a ReportWriter."""
+
+    def __init__(self, w, fields):
+        self.w = w
+
+    def write(self, rec):
+        self.w.wr(json.dumps(rec, ensure_ascii=False))
+
+
+class CsvWriter:
+    """Write records with given fields as CSV rows to a ReportWriter."""
+
+    def __init__(self, w, fields):
+        self.writer = csv.DictWriter(w, fields, extrasaction="ignore",
+            lineterminator="\n")
+        self.writer.writeheader()
+
+    def write(self, rec):
+        self.writer.writerow(rec)
+
+
+writers = {
+    "jsonl": JsonlWriter,
+    "csv": CsvWriter,
+}
+
+
+def write_records(w, fmt, fields, records):
+    """Write records from iterable records with fields to ReportWriter w
+    in format fmt. Return the number of records written."""
+    writer = writers[fmt](w, fields)
+    count = 0
+    for rec in records:
+        writer.write(rec)
+        count += 1
+    return count
+
+
+route_cells = [ "master", "match" ] \
+  + [ "dir{}:{}".format(d, c) for d in (0, 1)
+      for c in ("osm", "provider", "tags", "shape", "platforms") ]
+
+route_fields = [ "line", "mode", "network", "status" ] \
+  + [ f for c in route_cells
+      for f in ([c] if c.endswith(("osm", "provider")) else [c, c + ":status"]) ] \
+  + [ "details" ]
+
+
+def route_records(md, linerefs=None, fps=None):
+    """Iterate records of the route table cells of all lines or the lines
+    in linerefs, only changed lines if fps is given."""
+    for refs, networkname, platformidx in mw.route_tables(md, linerefs):
+        if not networkname:
+            networkname = md["agency"]
+        for line in refs:
+            ld = md["lines"][line]
+            if not "rels" in ld.keys():
+                continue
+            if fps and not fps.changed("line/{}/{}".format(md["mode"], line),
+              mw.line_row_data(ld), networkname, platformidx, md["shapetol"],
+              md["interval_tags"]):
+                continue
+            cells, matchok = mw.routeline_cells(md, ld, networkname, platformidx)
+            rec = { "line": line, "mode": md["mode"], "network": networkname }
+            for name, (style, text) in zip(route_cells, cells[1:]):
+                rec[name] = plain(text)
+                if name + ":status" in route_fields:
+                    rec[name + ":status"] = style2status.get(style, "")
+            rec["status"] = row_status([c[0] for c in cells]) if matchok \
+              else "problem"
+            rec["details"] = ld["details"]
+            yield rec
+
+
+stop_fields = [ "ref", "gtfsId", "provider_mode", "match", "status", "osm" ] \
+  + check_fields(mw.stop_checks) + [ "details", "suggestion", "suggestion:distance" ]
+
+
+def stop_records(sd, mode=None, city=None, index=None, fps=None,
+  radius=mw.suggestion_radius):
+    """Iterate records of stops, either all, or limited by mode, city or
+    both, followed by OSM stops not in provider data and groups of
+    possibly duplicated OSM stops. Only changed stops
+    are included if fps is given. Missing stops have suggested OSM stops
+    without ref within radius meters, if radius is not zero."""
+    ost = sd["ost"]
+    stops, extras = mw.select_stops(sd, mode, city, index)
+    mw.add_stop_distances(sd, stops)
+    suggestions = mw.stop_suggestions(sd, stops, radius) if radius else {}
+    for ps in stops:
+        ref = ps["code"]
+        oslist = ost.get(ref, [])
+        suggestion = suggestions.get(ref, None)
+        if fps and not fps.changed("stop/" + ref, oslist, ps, suggestion):
+            continue
+        oslist = mw.stop_osmlist(oslist, ps)
+        rec = { "ref": ref, "gtfsId": ps["gtfsId"], "provider_mode": ps["mode"],
+            "osm": osm_ids(oslist) }
+        if len(oslist) == 1:
+            rec["match"] = "ok"
+            add_cells(rec, mw.check_cells(mw.stop_checks, oslist[0], ps))
+        else:
+            rec["match"] = "multiple" if oslist else "missing"
+            rec["status"] = "problem"
+            if suggestion:
+                rec["suggestion"] = osm_ids([suggestion["os"]])
+                rec["suggestion:distance"] = round(suggestion["dist"])
+        yield rec
+    for ref in extras:
+        yield { "ref": ref, "match": "extra", "status": "problem",
+            "osm": osm_ids(ost[ref]) }
+    if index:
+        dups = index["duplicates"]
+    else:
+        dups = mw.duplicate_stops(sd, [mode] if mode else None)
+    for c in mw.select_duplicates(dups, mode, city):
+        yield { "ref": " ".join(sorted(set(s["ref"] for s in c if s.get("ref", None)))),
+            "match": "duplicate", "status": "problem", "osm": osm_ids(c) }
+
+
+station_fields = [ "provider_name", "osm_name", "gtfsId", "provider_mode", "match",
+    "status", "osm", "distance" ] + check_fields(mw.station_checks) + [ "details" ]
+
+
+def station_records(sd, mode=None, fps=None):
+    """Iterate records of stations, either all or limited by mode, followed
+    by OSM stations not in provider data. Only changed stations are
+    included if fps is given."""
+    modelist = [mode] if mode else sorted(sd["pstat"].keys())
+    for m in modelist:
+        matches, unmatched = mw.match_stations(sd, m)
+        for match in matches:
+            ps = match["ps"]
+            os = match["os"]
+            if fps and not fps.changed("station/" + ps["gtfsId"], os, ps):
+                continue
+            rec = { "provider_name": ps["name"], "gtfsId": ps["gtfsId"],
+                "provider_mode": m }
+            if os is None:
+                rec["match"] = "missing"
+                rec["status"] = "problem"
+            else:
+                rec["match"] = "ok"
+                rec["osm_name"] = os.get("name", "")
+                rec["osm"] = osm_ids([os])
+                rec["distance"] = round(match["dist"])
+                add_cells(rec, mw.check_cells(mw.station_checks, os, ps))
+            yield rec
+        for os in unmatched:
+            yield { "osm_name": os.get("name", ""), "provider_mode": m,
+                "match": "extra", "status": "problem",
+                "osm": osm_ids([os]) }
+
+
+citybike_fields = [ "ref", "provider_name", "osm_name", "state", "match", "status",
+    "osm" ] \
+  + check_fields(mw.citybike_checks) + [ "details", "suggestion", "suggestion:distance" ]
+
+
+def citybike_records(sd, fps=None):
+    """Iterate records of citybike stations, followed by OSM citybike
+    stations not in provider data. Only changed stations are included if
+    fps is given."""
+    ost = sd["ocbs"]
+    pst = sd["pcbs"]
+    active_refs, inactive_refs = mw.citybike_refs(sd)
+    mw.add_citybike_distances(sd)
+    suggestions = mw.citybike_suggestions(sd)
+    for refs in (active_refs, inactive_refs):
+        refs.sort(key=linesortkey)
+        for ref in refs:
+            ps = pst[ref]
+            if not mw.reported_citybike(ps): continue
+            oslist = ost.get(ref, [])
+            suggestion = suggestions.get(ref, None)
+            if fps and not fps.changed("citybike/" + ref, oslist, ps, suggestion):
+                continue
+            rec = { "ref": ref, "provider_name": ps["name"], "state": ps["state"],
+                "osm": osm_ids(oslist) }
+            if len(oslist) == 1:
+                rec["match"] = "ok"
+                rec["osm_name"] = oslist[0].get("name", "")
+                add_cells(rec, mw.check_cells(mw.citybike_checks, oslist[0], ps))
+            else:
+                rec["match"] = "multiple" if oslist else "missing"
+                rec["status"] = "problem"
+                if suggestion:
+                    rec["suggestion"] = osm_ids([suggestion["os"]])
+                    rec["suggestion:distance"] = round(suggestion["dist"])
+            yield rec
+    printedset = set(active_refs + inactive_refs)
+    for ref in sorted((r for r in ost.keys() if r not in printedset),
+      key=linesortkey):
+        yield { "ref": ref, "match": "extra", "status": "problem",
+            "osm_name": "; ".join(os.get("name", "") for os in ost[ref]),
+            "osm": osm_ids(ost[ref]) }
+    for os in sd["orest"].values():
+        yield { "osm_name": os.get("name", ""), "match": "extra",
+            "status": "problem", "osm": osm_ids([os]) }
@@ -0,0 +1,289 @@
+# Copyright (C) 2018-2021 Teemu Ikonen <tpikonen@gmail.com>
+
+# This file is part of Taival.
+# Taival is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License version 3 as published by the
+# Free Software Foundation. See the file COPYING for license text.
+
+# Spatial index of lat/lon points with batch nearest neighbour queries,
+# point in polygon lookup and projection of points to lines.
+#
+# Points are projected to a local equirectangular projection with
+# coordinates in meters, which is accurate to well under one percent over
+# an area the size of a city. numpy and pykdtree are imported only when
+# they are used.
+
+import logging
+from collections import defaultdict
+from math import cos, pi, radians, sqrt
+
+log = logging.getLogger(__name__)
+
+earth_radius = 6371000.0 # meters
+# Default latitude of the projection, Helsinki
+ref_lat = 60.2
+
+
+def project(latlons, lat0=ref_lat):
+    """Return an (n, 2) numpy array of (x, y) coordinates in meters of
+    (lat, lon) points in latlons, in an equirectangular projection with
+    true scale at latitude lat0."""
+    import numpy as np
+    a = np.asarray(latlons, dtype=np.float64).reshape(-1, 2)
+    k = earth_radius * pi / 180.0
+    return np.column_stack((a[:, 1] * k * cos(radians(lat0)), a[:, 0] * k))
+
+
+def haversine_array(p1s, p2s):
+    """Return a numpy array of great circle distances in kilometers
+    between (lat, lon) points in p1s and p2s, like util.haversine()."""
+    import numpy as np
+    a1 = np.radians(np.asarray(p1s, dtype=np.float64).reshape(-1, 2))
+    a2 = np.radians(np.asarray(p2s, dtype=np.float64).reshape(-1, 2))
+    dlat = a2[:, 0] - a1[:, 0]
+    dlon = a2[:, 1] - a1[:, 1]
+    a = np.sin(dlat/2)**2 + np.cos(a1[:, 0]) * np.cos(a2[:, 0]) * np.sin(dlon/2)**2
+    return 2 * np.arcsin(np.sqrt(a)) * (earth_radius / 1000.0)
+
+
+class PointIndex:
+    """KD-tree of (lat, lon) points, built on the first query."""
+
+    def __init__(self, latlons, lat0=ref_lat):
+        self.latlons = latlons
+        self.lat0 = lat0
+        self._tree = None
+
+    def __len__(self):
+        return len(self.latlons)
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            from pykdtree.kdtree import KDTree
+            self._tree = KDTree(project(self.latlons, self.lat0))
+        return self._tree
+
+    def nearest(self, latlons, k=1, radius=None):
+        """Return a tuple (dist, ind) of numpy arrays with distances in
+        meters and indices of the k nearest points to each point in
+        latlons. The arrays have shape (n,) if k is 1, (n, k) otherwise.
+        Neighbours farther than radius meters, if given, have index -1
+        and distance inf."""
+        import numpy as np
+        q = project(latlons, self.lat0)
+        shape = (len(q),) if k == 1 else (len(q), k)
+        if len(self) == 0 or len(q) == 0:
+            return np.full(shape, np.inf), np.full(shape, -1, dtype=np.int64)
+        kk = min(k, len(self))
+        if radius is None:
+            dist, ind = self.tree.query(q, k=kk)
+        else:
+            dist, ind = self.tree.query(q, k=kk, distance_upper_bound=radius)
+        dist = np.asarray(dist, dtype=np.float64).reshape(len(q), kk)
+        ind = np.asarray(ind, dtype=np.int64).reshape(len(q), kk)
+        ind[~np.isfinite(dist)] = -1
+        if kk < k:
+            dist = np.hstack((dist, np.full((len(q), k - kk), np.inf)))
+            ind = np.hstack((ind, np.full((len(q), k - kk), -1, dtype=np.int64)))
+        return dist.reshape(shape), ind.reshape(shape)
+
+    def within(self, latlons, radius, k=8):
+        """Return a list with a list of (dist, index) tuples of at most k
+        points within radius meters, nearest first, for each point in
+        latlons."""
+        dist, ind = self.nearest(latlons, k=k, radius=radius)
+        dist = dist.reshape(len(ind), k)
+        ind = ind.reshape(len(ind), k)
+        return [ [ (float(d), int(i)) for d, i in zip(drow, irow) if i >= 0 ]
+            for drow, irow in zip(dist, ind) ]
+
+
+def match_nearby(points, candidates, radius, k=4, score=None):
+    """
+    Match (lat, lon) points one to one to candidate (lat, lon) points
+    within radius meters.
+
+    Return a list with a (candidate index, distance, score) tuple or None
+    for each point. Pairs are formed from the k nearest candidates of each
+    point and assigned in order of decreasing score. The score(i, j, dist)
+    function, if given, returns the score of point i and candidate j at
+    distance dist, or None if they can not match. By default the score is
+    1 - dist/radius, so that pairs are assigned in order of increasing
+    distance and points which are nearest to each other always match.
+    """
+    dist, ind = PointIndex(candidates).nearest(points, k=k, radius=radius)
+    dist = dist.reshape(len(points), -1)
+    ind = ind.reshape(len(points), -1)
+    pairs = []
+    for i in range(len(points)):
+        for d, j in zip(dist[i], ind[i]):
+            if j < 0:
+                break
+            d = float(d)
+            s = score(i, int(j), d) if score else 1.0 - d / radius
+            if s is not None:
+                pairs.append((s, i, int(j), d))
+    pairs.sort(key=lambda p: -p[0])
+    matches = [ None ] * len(points)
+    used = set()
+    for s, i, j, d in pairs:
+        if matches[i] is None and j not in used:
+            matches[i] = (j, d, s)
+            used.add(j)
+    return matches
+
+
+def close_pairs(latlons, radius, lat0=ref_lat):
+    """Return a list of (i, j, dist) tuples of indices i < j of (lat, lon)
+    points in latlons closer than radius meters to each other, and their
+    distance in meters. Points are hashed to a grid of cells of size
+    radius, and only points in the same or adjacent cells are compared."""
+    import numpy as np
+    if len(latlons) == 0:
+        return []
+    xy = project(latlons, lat0).tolist()
+    cells = defaultdict(list)
+    for i, (x, y) in enumerate(xy):
+        cells[(int(x // radius), int(y // radius))].append(i)
+    r2 = radius * radius
+    pairs = []
+    # Each pair of adjacent cells is visited once
+    for (cx, cy), members in cells.items():
+        for dx, dy in ((0, 0), (1, -1), (1, 0), (1, 1), (0, 1)):
+            other = cells.get((cx + dx, cy + dy), None)
+            if not other:
+                continue
+            for a in members:
+                ax, ay = xy[a]
+                for b in other:
+                    if dx == 0 and dy == 0 and b <= a:
+                        continue
+                    d2 = (xy[b][0] - ax)**2 + (xy[b][1] - ay)**2
+                    if d2 < r2:
+                        pairs.append((min(a, b), max(a, b), sqrt(d2)))
+    return pairs
+
+
+class PolygonIndex:
+    """
+    Point in polygon lookup of named areas.
+
+    Areas are given as a dict of name -> list of rings of (lat, lon)
+    points, with outer and inner rings combined by the even-odd rule. The
+    edges of each area are sorted to latitude bands, so that a point is
+    only tested against the edges in its band.
+    """
+
+    def __init__(self, areas, nbands=256):
+        import numpy as np
+        self.areas = []
+        for name, rings in areas.items():
+            edges = [ (a[0], a[1], b[0], b[1]) for ring in rings
+                for a, b in zip(ring, ring[1:] + ring[:1]) if a != b ]
+            if not edges:
+                continue
+            e = np.array(edges, dtype=np.float64)
+            lat0 = min(e[:, 0].min(), e[:, 2].min())
+            lat1 = max(e[:, 0].max(), e[:, 2].max())
+            bbox = (lat0, lat1, min(e[:, 1].min(), e[:, 3].min()),
+                max(e[:, 1].max(), e[:, 3].max()))
+            scale = nbands / ((lat1 - lat0) or 1.0)
+            b0 = np.clip(((np.minimum(e[:, 0], e[:, 2]) - lat0) * scale).astype(int), 0, nbands - 1)
+            b1 = np.clip(((np.maximum(e[:, 0], e[:, 2]) - lat0) * scale).astype(int), 0, nbands - 1)
+            bands = defaultdict(list)
+            for i, (lo, hi) in enumerate(zip(b0.tolist(), b1.tolist())):
+                for b in range(lo, hi + 1):
+                    bands[b].append(i)
+            bands = { b: e[ind] for b, ind in bands.items() }
+            self.areas.append((name, bbox, lat0, scale, nbands, bands))
+
+    def locate(self, latlons):
+        """Return a list with the name of the area containing each (lat, lon)
+        point in latlons, or None if the point is not in any area."""
+        import numpy as np
+        pts = np.asarray(latlons, dtype=np.float64).reshape(-1, 2)
+        found = np.full(len(pts), -1, dtype=np.int64)
+        for ai, (name, bbox, lat0, scale, nbands, bands) in enumerate(self.areas):
+            cand = np.nonzero((found < 0)
+                & (pts[:, 0] >= bbox[0]) & (pts[:, 0] <= bbox[1])
+                & (pts[:, 1] >= bbox[2]) & (pts[:, 1] <= bbox[3]))[0]
+            if len(cand) == 0:
+                continue
+            pb = np.clip(((pts[cand, 0] - lat0) * scale).astype(int), 0, nbands - 1)
+            for b in np.unique(pb).tolist():
+                e = bands.get(b, None)
+                if e is None:
+                    continue
+                ind = cand[pb == b]
+                lat = pts[ind, 0][:, None]
+                lon = pts[ind, 1][:, None]
+                # Cast a ray to the east from each point and count crossings
+                crosses = (e[:, 0] > lat) != (e[:, 2] > lat)
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    xlon = e[:, 1] + (lat - e[:, 0]) * (e[:, 3] - e[:, 1]) / (e[:, 2] - e[:, 0])
+                inside = (np.count_nonzero(crosses & (lon < xlon), axis=1) % 2) == 1
+                found[ind[inside]] = ai
+        return [ self.areas[i][0] if i >= 0 else None for i in found.tolist() ]
+
+
+def line_positions(shape, sequences, radius):
+    """
+    Project sequences of (lat, lon) points to a line given by the list of
+    (lat, lon) points in shape.
+
+    Return a list with a list of (dist, pos, ordered) tuples for each
+    sequence, where dist is the distance in meters from each point to the
+    line, pos the position of the projected point along the line in
+    meters, and ordered is False if the point is more than radius meters
+    before the previous point of the sequence on the line.
+
+    The distances of all points to all segments of the line are computed
+    at once. Each point is projected to the nearest position on the first
+    pass of the line within radius meters which is not before the
+    previous point, so that a line which passes the same place twice is
+    followed in order, and otherwise to the nearest position on the line.
+    """
+    import numpy as np
+    points = [ p for seq in sequences for p in seq ]
+    if len(shape) < 2 or not points:
+        return [ [ (float("inf"), 0.0, True) for _ in seq ]
+            for seq in sequences ]
+    lat0 = shape[0][0]
+    xy = project(shape, lat0)
+    pxy = project(points, lat0)
+    # (points, segments) arrays of vectors from segment start to points
+    ax = pxy[:, 0:1] - xy[None, :-1, 0]
+    ay = pxy[:, 1:2] - xy[None, :-1, 1]
+    bx = xy[1:, 0] - xy[:-1, 0]
+    by = xy[1:, 1] - xy[:-1, 1]
+    l2 = bx * bx + by * by
+    with np.errstate(divide="ignore"):
+        inv_l2 = np.where(l2 > 0, 1.0 / l2, 0.0)
+    t = np.clip((ax * bx + ay * by) * inv_l2, 0.0, 1.0)
+    ax -= t * bx
+    ay -= t * by
+    dist = np.sqrt(ax * ax + ay * ay)
+    seglen = np.sqrt(l2)
+    pos = np.concatenate(([0.0], np.cumsum(seglen)[:-1])) + t * seglen
+    out = []
+    i = 0
+    for seq in sequences:
+        res = []
+        prev = -np.inf
+        for _ in seq:
+            cand = np.nonzero((dist[i] <= radius) & (pos[i] >= prev - radius))[0]
+            if len(cand):
+                # Consecutive segments within radius are one pass
+                breaks = np.nonzero(np.diff(cand) > 1)[0]
+                first = cand[:breaks[0] + 1] if len(breaks) else cand
+                j = int(first[np.argmin(dist[i, first])])
+            else:
+                j = int(np.argmin(dist[i]))
+            ordered = bool(pos[i, j] >= prev - radius)
+            if ordered and dist[i, j] <= radius:
+                prev = max(prev, pos[i, j])
+            res.append((float(dist[i, j]), float(pos[i, j]), ordered))
+            i += 1
+        out.append(res)
+    return out
@@ -8,15 +8,19 @@
 # Free Software Foundation. See the file COPYING for license text.
 
 import argparse
+import concurrent.futures
 import datetime
+import hashlib
+import json
 import logging
-import pickle
+import multiprocessing
 import os
+import resource
 import sys
 
 import gpxpy.gpx
 
-import digitransit, osm, hsl
+import collection, digitransit, osm, hsl, osmdb, records, spatial
 import mediawiki as mw
 from util import *
 from collections import defaultdict
@@ -88,17 +92,23 @@ def osm2gpx(lineref, mode="bus"):
         log.error("Line '{lineref}' not found in OSM.")
 
 
+def interval_tag_days():
+    """Return the days used in collect_interval_tags(), the next saturday,
+    sunday and monday, as 'YYYYMMDD' strings."""
+    today = datetime.date.today()
+    delta = (5 + 7 - today.weekday()) % 7 # Days to next saturday
+    return [ (today + datetime.timedelta(days=delta+i)).strftime("%Y%m%d")
+        for i in range(3) ]
+
+
 def collect_interval_tags(code):
     """Return interval tags for a pattern code determined from HSL data
     for peak and normal hours for weekdays (monday), saturday and sunday.
     Intervals are converted from arrival data."""
     # Get interval tags from API
-    today = datetime.date.today()
-    delta = (5 + 7 - today.weekday()) % 7 # Days to next saturday
     tags = {}
     daynames = ["saturday", "sunday", None] # weekdays (monday) is the default
-    for i in range(3):
-        day = (today + datetime.timedelta(days=delta+i)).strftime("%Y%m%d")
+    for i, day in enumerate(interval_tag_days()):
         log.debug("Calling pvd.arrivals_for_date()")
         (norm, peak, night) = arrivals2intervals(\
             pvd.arrivals_for_date(code, day), pvd.peakhours, pvd.nighthours)
@@ -245,14 +255,15 @@ def collect_line(lineref, mode, agency, networks, interval_tags=False):
     log.debug("Found HSL pattern codes: %s\n" %
         (", ".join("[%s %s]" % (digitransit.pattern2url(c), c) for c in codes)))
 
-    # FIXME: Duplicate call to osm.route_shape() in route checking loop.
-    osmshapes = [osm.route_shape(rel)[0] for rel in rels]
+    # Values derived from OSM members are computed here, so that reports
+    # can be made without network access.
+    ld.update(osm.route_member_values(rels))
+    osmshapes = ld["osmshapes"]
     hslshapes = [pvd.shape(c, mode)[1] for c in codes]
     (osm2hsl, hsl2osm) = match_shapes(osmshapes, hslshapes)
     id2hslindex = {}
     for i in range(len(relids)):
         id2hslindex[relids[i]] = osm2hsl[i]
-    ld["osmshapes"] = osmshapes
     ld["hslshapes"] = hslshapes
     ld["id2hslindex"] = id2hslindex
     ld["osm2hsl"] = osm2hsl
@@ -274,9 +285,40 @@ def collect_line(lineref, mode, agency, networks, interval_tags=False):
     return ld
 
 
-def collect_routes(mode="bus", interval_tags=False):
+def line_fingerprint(lineref, mode, agency, networks, interval_tags=False):
+    """Return a fingerprint of the OSM and provider data which collect_line
+    uses for a line."""
+    h = hashlib.sha1()
+    h.update(osm.rels_fingerprint(lineref, mode, networks).encode("utf-8"))
+    rmd = osm.get_route_master_dict(mode, agency)
+    for rel in rmd[lineref]:
+        h.update(json.dumps([rel.id, rel.tags, [m.ref for m in rel.members]],
+            sort_keys=True).encode("utf-8"))
+    h.update(pvd.route_fingerprint(lineref, mode).encode("utf-8"))
+    if interval_tags:
+        # Intervals are computed from arrivals in the next weekend
+        h.update(interval_tag_days()[0].encode("utf-8"))
+    return h.hexdigest()
+
+
+def collect_routes(mode="bus", interval_tags=False, previous=None,
+  checkpoint=None, linespec=None, start=None, stop=None):
     """Collect data for a given mode from APIs, call collect_line for
-    all discovered lines."""
+    all discovered lines, or lines selected by linespec, start and stop
+    (see util.select_lines()). OSM routes are only fetched for the selected
+    lines.
+
+    If previous is given, it is a collection file of the same mode from
+    an earlier run, and lines with the same fingerprint as in previous
+    are copied from it instead of collected again. Line fingerprints are
+    only computed, and stored in the "fingerprints" key, when previous is
+    given.
+
+    If checkpoint is given, it is a CollectionStore where each line is
+    written when it has been collected. Lines already in checkpoint are
+    not collected again. Lines which fail are retried after all the other
+    lines, and listed in the "failed" key of the returned dict if they
+    fail again."""
     md = {}
     md["mode"] = mode
     md["shapetol"] = pvd.shapetols[mode]
@@ -291,8 +333,14 @@ def collect_routes(mode="bus", interval_tags=False):
     networks = [agency] + hsl.cities + [None]
     if agency == 'HSL':
         networks.append("Saaristoliikenne")
-    osmdict = osm.all_linerefs(mode, networks)
     hsldict = pvd.all_linerefs(mode)
+    if linespec or start or stop:
+        hsllines = select_lines(hsldict.keys(), linespec, start, stop)
+        log.info("Collecting {} selected lines".format(len(hsllines)))
+        osm.route_refs = hsllines
+    else:
+        hsllines = sorted(hsldict.keys(), key=linesortkey)
+    osmdict = osm.all_linerefs(mode, networks)
     refless = osm.rels_refless(mode)
     refless = [ r for r in refless if r.tags.get("network", None) in networks ]
     wasroutes = osm.was_routes(mode)
@@ -310,24 +358,126 @@ def collect_routes(mode="bus", interval_tags=False):
         osm_minibusdict = osm.all_linerefs("minibus", agency)
         md["osm_minibusdict"] = osm_minibusdict
 
-    hsllines = set(hsldict)
-    hsllines = list(hsllines)
-    hsllines.sort(key=linesortkey)
+    prevlines = {}
+    prevfps = {}
+    pd = None
+    if previous:
+        pd = collection.load_collection(previous)
+        if pd.get("mode", None) != mode \
+          or pd.get("interval_tags", None) != interval_tags:
+            log.warning(f"'{previous}' has different mode or interval tags, collecting all lines")
+        elif "fingerprints" not in pd.keys() or not pd["fingerprints"]:
+            log.warning(f"'{previous}' has no line fingerprints, collecting all lines")
+        else:
+            prevlines = pd["lines"]
+            prevfps = pd["fingerprints"]
+
     lines = {}
-    for line in hsllines:
-        ld = collect_line(line, mode, agency, networks, interval_tags)
+    fingerprints = {}
+    reused = 0
+    done = set(checkpoint.keys("lines")) if checkpoint else set()
+    if done:
+        log.info(f"Resuming, {len(done)} lines already collected")
+
+    def process_line(line):
+        nonlocal reused
+        fp = None
+        fpkey = "fingerprint/" + line
+        if line in done:
+            ld = checkpoint.get("lines", line)
+            if checkpoint.has("checkpoint", fpkey):
+                fp = checkpoint.get("checkpoint", fpkey)
+        else:
+            # Fingerprints are only needed to compare with previous data
+            if previous:
+                try:
+                    fp = line_fingerprint(line, mode, agency, networks,
+                        interval_tags)
+                except Exception as e:
+                    log.warning(f"Fingerprint of line {line} failed, collecting it: {e!r}")
+            if fp is not None and prevfps.get(line, None) == fp \
+              and line in prevlines:
+                log.debug(f"Line {line} unchanged, using previous data")
+                ld = prevlines[line]
+                reused += 1
+            else:
+                ld = collect_line(line, mode, agency, networks, interval_tags)
+        if fp is not None:
+            fingerprints[line] = fp
         lines[line] = ld
-    md["lines"] = lines
+        if checkpoint and line not in done:
+            checkpoint.put("lines", line, ld)
+            if fp is not None:
+                checkpoint.put("checkpoint", fpkey, fp)
+            checkpoint.conn.commit()
+
+    failed = []
+    for line in hsllines:
+        try:
+            process_line(line)
+        except Exception as e:
+            log.warning(f"Collecting line {line} failed, retrying later: {e!r}")
+            failed.append(line)
+    if failed:
+        log.info(f"Retrying {len(failed)} failed lines")
+    md["failed"] = []
+    for line in failed:
+        try:
+            process_line(line)
+        except Exception as e:
+            log.error(f"Collecting line {line} failed: {e!r}")
+            md["failed"].append(line)
+    # Reused lines are loaded now
+    if pd is not None:
+        pd.close()
+    # Keep the line order of an uninterrupted run
+    md["lines"] = { line: lines[line] for line in hsllines if line in lines }
+    md["fingerprints"] = fingerprints
+    if previous:
+        log.info(f"{reused} lines reused from '{previous}', {len(lines) - reused} lines collected")
+    # Per-line data is extracted, free the route data for the whole area
+    osm.free_route_index()
+    osm.route_refs = None
     return md
 
 
-def collect_stops():
+def add_stop_cities(sd, boundaries):
+    """Set 'x:city' of OSM and provider stops in sd to the name of the city
+    containing the stop, from boundaries (see osm.city_boundaries())."""
+    stops = [ s for vl in sd["ost"].values() for s in vl ] \
+      + list(sd["rst"].values())
+    stops = [ s for s in stops if s.get("x:latlon", None) ]
+    pstops = [ ps for mdict in sd["pst"].values() for ps in mdict.values()
+        if ps.get("latlon", None) ]
+    index = spatial.PolygonIndex(boundaries)
+    cities = index.locate([ s["x:latlon"] for s in stops ]
+        + [ ps["latlon"] for ps in pstops ])
+    for s, c in zip(stops, cities[:len(stops)]):
+        s["x:city"] = c
+    for ps, c in zip(pstops, cities[len(stops):]):
+        ps["x:city"] = c
+
+
+def collect_stops(checkpoint=None):
+    """Collect stops from OSM and provider. If checkpoint is given, it is
+    a CollectionStore where the results of each query are written, and
+    read from instead of querying again, if already present."""
     ost = defaultdict(list)
     rst = {}
 
+    def checkpointed(key, fun, *args):
+        if checkpoint and checkpoint.has("checkpoint", key):
+            log.info(f"Using '{key}' from checkpoint")
+            return checkpoint.get("checkpoint", key)
+        val = fun(*args)
+        if checkpoint:
+            checkpoint.put("checkpoint", key, val)
+            checkpoint.conn.commit()
+        return val
+
     def collect_stops_mode(mode):
         log.debug('Calling osm.stops("{}")'.format(mode))
-        refstops, rest = osm.stops(mode)
+        refstops, rest = checkpointed("osm/" + mode, osm.stops, mode)
         ddl_uniq_key_merge(ost, refstops, "x:id")
         rst.update(rest)
 
@@ -349,17 +499,13 @@ def collect_stops():
     osm.area = hsl.overpass_area
 
     log.debug('Calling pvd.stops()')
-    (pst, pcl) = pvd.stops()
+    (pst, pcl) = checkpointed("provider", pvd.stops)
 
     hsl.normalize_helsinki_codes(ost)
     for pmode in pst.values():
         hsl.normalize_helsinki_codes(pmode, change_code=True)
 
-    for mdict in pst.values():
-        for ps in mdict.values():
-            namecount = len([True for d in pst.values()\
-              for s in d.values() if s["name"] == ps["name"]])
-            ps["namecount"] = namecount
+    hsl.add_namecounts(pst)
 
     sd = { "ost": ost,
         "rst": rst,
@@ -368,6 +514,11 @@ def collect_stops():
         "agency": pvd.agency,
     }
 
+    log.debug('Calling osm.city_boundaries()')
+    boundaries = checkpointed("boundaries", osm.city_boundaries,
+        hsl.overpass_stopref_area)
+    add_stop_cities(sd, boundaries)
+
     return sd
 
 
@@ -435,63 +586,232 @@ def sub_osmxml(args):
             ff.write(f"    <tag k='to' v='{stopnames[-1]}' />\n")
             ff.write("    <tag k='public_transport:version' v='2' />\n")
 
-    log.info("Processing line %s, mode '%s'" % (args.line, args.mode))
-    log.debug("Calling pvd.codes_query")
-    codes = pvd.codes_query(args.line, args.mode)
-    log.debug("Calling pvd.tags_query")
-    htags = pvd.tags_query(args.line, args.mode)
-    for c in codes:
-        log.debug("Pattern code %s" % c)
-        # reverse stops string if direction code is odd
-        reverse = (int(c.split(":")[2]) % 2) == 1
-        log.debug("   Calling pvd.platforms_query")
-        stops = [p[2] for p in pvd.platforms_query(c)]
-        fname = "%s_%s_%s.osm" % (args.line, pvd.agency, c)
-        log.debug("   Calling osm.stops_by_refs")
-        ids = osm.stops_by_refs(stops, args.mode)
-        write_xml(fname, ids, htags, args.mode, reverse)
-        print(fname)
-    if not codes:
-        print("Line '%s' not found in %s for mode %s." % args.line, pvd.agency, args.mode)
+    stopindex = None
+    if not args.input:
+        args.input = "{}_stops.db".format(pvd.agency)
+    if os.path.exists(args.input):
+        log.debug("Reading stop index from '{}'".format(args.input))
+        with collection.load_collection(args.input) as d:
+            if "ost" in d.keys():
+                stopindex = osm.stopref_index(d["ost"], args.mode)
+            else:
+                log.warning("Incompatible collection file '{}', stops will be queried from Overpass".format(args.input))
+    else:
+        log.info("Stops file '{}' not found, stops will be queried from Overpass".format(args.input))
+
+    for line in args.line.split(","):
+        log.info("Processing line %s, mode '%s'" % (line, args.mode))
+        log.debug("Calling pvd.codes_query")
+        codes = pvd.codes_query(line, args.mode)
+        log.debug("Calling pvd.tags_query")
+        htags = pvd.tags_query(line, args.mode)
+        for c in codes:
+            log.debug("Pattern code %s" % c)
+            # reverse stops string if direction code is odd
+            reverse = (int(c.split(":")[2]) % 2) == 1
+            log.debug("   Calling pvd.platforms_query")
+            stops = [p[2] for p in pvd.platforms_query(c)]
+            fname = "%s_%s_%s.osm" % (line, pvd.agency, c)
+            log.debug("   Calling osm.stops_by_refs")
+            ids = osm.stops_by_refs(stops, args.mode, stopindex)
+            write_xml(fname, ids, htags, args.mode, reverse)
+            print(fname)
+        if not codes:
+            print("Line '%s' not found in %s for mode %s." % (line, pvd.agency, args.mode))
+
+
+def sub_osmdb(args):
+    db = osmdb.OSMDB(args.file, fetch=osm.apiquery_json,
+        tfilters=osm.store_tfilters())
+    if args.command == 'init':
+        # Use the largest area used in collects
+        osm.area = hsl.overpass_stopref_area
+        url = args.replication_url or osmdb.default_replication_url
+        q = osm.store_seed_query()
+        log.debug(q)
+        log.info("Querying Overpass for OSM store data")
+        data = osm.apiquery_json(q)
+        ts = datetime.datetime.strptime(
+            data["osm3s"]["timestamp_osm_base"], "%Y-%m-%dT%H:%M:%SZ")
+        n = db.load(data["elements"])
+        db.set_meta("area", osm.area)
+        db.set_meta("bbox", osm.area_bbox(osm.area))
+        db.set_meta("replication_url", url)
+        db.set_meta("sequence", osmdb.sequence_for_timestamp(url, ts))
+        db.conn.commit()
+        log.info(f"Stored {n} elements to '{args.file}'")
+    elif args.command == 'update':
+        try:
+            if args.change_files:
+                for fname in args.change_files:
+                    db.apply_change_file(fname)
+            else:
+                db.update(args.replication_url)
+        except osmdb.MissingElementsError as e:
+            log.error(e)
+            sys.exit(2)
+    db.close()
 
 
 def get_output(args):
     if args.output == '-':
         out = sys.stdout
     else:
-        out = open(args.output, "wb")
+        out = open(args.output, "w", encoding="utf-8")
     return out
 
 
 def sub_collect(args):
+    if args.osmdb:
+        if not os.path.exists(args.osmdb):
+            log.error("OSM store '{}' not found".format(args.osmdb))
+            sys.exit(1)
+        osm.store = osmdb.OSMDB(args.osmdb)
     if not args.output:
-        args.output = "{}_{}.pickle".format(pvd.agency, args.mode)
+        args.output = "{}_{}.db".format(pvd.agency, args.mode)
+    if args.mode in ('stops', 'stations', 'citybikes'):
+        kind = args.mode
+        if args.incremental:
+            log.error("--incremental can only be used when collecting routes")
+            sys.exit(1)
+    elif args.mode in osm.stoptags.keys():
+        kind = "routes"
+        if args.incremental and not os.path.exists(args.incremental):
+            log.error("Previous collection '{}' not found".format(args.incremental))
+            sys.exit(1)
+    else:
+        log.error("mode/stops not recognized in 'collect'")
+        return
+    # Data is written to a checkpoint file while collecting, which
+    # replaces the output file when the collection is complete.
+    partfile = args.output + ".part"
+    # Options which change the collected data, a resumed collect must
+    # have the same options as the interrupted one
+    options = {
+        "interval_tags": args.interval_tags,
+        "lines": args.lines,
+        "start": args.start,
+        "stop": args.stop,
+        "incremental": os.path.abspath(args.incremental) if args.incremental else None,
+    }
+    if args.resume and os.path.exists(partfile):
+        checkpoint = collection.CollectionStore(partfile)
+        if checkpoint.kind != kind or checkpoint.get_meta("mode") != args.mode:
+            log.error("Checkpoint file '{}' is not from a '{}' collect".format(partfile, args.mode))
+            sys.exit(1)
+        prevopts = checkpoint.get_meta("options")
+        if prevopts != options:
+            log.error("Checkpoint file '{}' was collected with different options: {}".format(partfile,
+                ", ".join("{}={}".format(k, (prevopts or {}).get(k, None))
+                    for k in options.keys())))
+            sys.exit(1)
+        log.info("Resuming collect from '{}'".format(partfile))
+    else:
+        checkpoint = collection.CollectionStore(partfile, kind, create=True)
+        checkpoint.set_meta("mode", args.mode)
+        checkpoint.set_meta("options", options)
+        checkpoint.conn.commit()
     if args.mode == 'stops':
-        d = collect_stops()
+        d = collect_stops(checkpoint)
     elif args.mode == 'stations':
         d = collect_stations()
     elif args.mode == 'citybikes':
         d = collect_citybikes()
-    elif args.mode in osm.stoptags.keys():
-        d = collect_routes(mode=args.mode, interval_tags=args.interval_tags)
     else:
-        log.error("mode/stops not recognized in 'collect'")
+        d = collect_routes(mode=args.mode, interval_tags=args.interval_tags,
+            previous=args.incremental, checkpoint=checkpoint,
+            linespec=args.lines, start=args.start, stop=args.stop)
+    checkpoint.delete_section("checkpoint")
+    checkpoint.save(d)
+    checkpoint.close()
+    os.replace(partfile, args.output)
+    if d.get("failed", None):
+        log.error("Failed to collect lines: {}".format(", ".join(d["failed"])))
+    log.info("Peak RSS {:.0f} MB".format(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def get_writer(args):
+    """Return a report writer for args.output, which writes pages of at
+    most args.max_page_size characters, if given."""
+    if args.max_page_size:
+        if getattr(args, "format", "mediawiki") != "mediawiki":
+            log.error("--max-page-size can only be used with mediawiki format")
+            sys.exit(1)
+        if args.output == '-':
+            log.error("--max-page-size requires an output file")
+            sys.exit(1)
+        return mw.PagedReportWriter(os.path.splitext(args.output)[0],
+            args.max_page_size)
+    out = get_output(args)
+    return mw.ReportWriter(out, closefile=(out != sys.stdout))
+
+
+def get_fingerprints(args):
+    """Return RowFingerprints from args.fingerprints file, or None."""
+    if args.change_list and not args.fingerprints:
+        log.error("--change-list requires --fingerprints")
+        sys.exit(1)
+    if not args.fingerprints:
+        return None
+    return mw.RowFingerprints.load(args.fingerprints)
+
+
+def save_fingerprints(args, fps):
+    """Write fingerprints and the change list, if requested."""
+    if not fps:
         return
-    with open(args.output, "wb") as out:
-        pickle.dump(d, out)
+    fps.save(args.fingerprints)
+    changes = fps.changes()
+    log.info("{} rows added, {} changed, {} removed".format(
+        *(len(changes[k]) for k in ("added", "changed", "removed"))))
+    if args.change_list:
+        with open(args.change_list, "w", encoding="utf-8") as f:
+            json.dump(changes, f, indent=1)
+
+
+def sub_migrate(args):
+    if not args.output:
+        args.output = os.path.splitext(args.input)[0] + ".db"
+    try:
+        kind = collection.migrate(args.input, args.output)
+    except ValueError as e:
+        log.error(e)
+        sys.exit(2)
+    log.info("Converted {} data from '{}' to '{}'".format(
+        kind, args.input, args.output))
+
+
+def check_route_collection(d, fname, linerefs=None):
+    """Raise ValueError if route data d read from fname has lines, all or
+    those in linerefs, collected with an older version."""
+    if collection.stale_lines(d, linerefs):
+        raise ValueError("File '{}' was collected with an older version, collect the data again".format(fname))
 
 
 def sub_routes(args):
-    with open(args.file, 'rb') as f:
-        d = pickle.load(f)
-    if "mode" in d.keys():
-        out = get_output(args)
-        mw.outfile = out
-        mw.report_routes(d)
-        if out and out != sys.stdout:
-            out.close()
-    else:
-        log.error("Unrecognized route dictionary from pickle file.")
+    disable_network()
+    with collection.load_collection(args.file) as d:
+        if "mode" in d.keys():
+            linerefs = None
+            if args.lines or args.start or args.stop:
+                linerefs = select_lines(d["lines"].keys(), args.lines,
+                    args.start, args.stop)
+            try:
+                check_route_collection(d, args.file, linerefs)
+            except ValueError as e:
+                log.error(e)
+                sys.exit(2)
+            fps = get_fingerprints(args)
+            with get_writer(args) as w:
+                if args.format == "mediawiki":
+                    mw.report_routes(w, d, linerefs, fps=fps)
+                else:
+                    records.write_records(w, args.format, records.route_fields,
+                        records.route_records(d, linerefs, fps=fps))
+            save_fingerprints(args, fps)
+        else:
+            log.error("Unrecognized route dictionary in collection file.")
 
 
 def sub_stops(args):
@@ -515,22 +835,24 @@ def sub_stops(args):
         else:
             mode = args.filt2
 
+    disable_network()
     if not args.input:
-        args.input = "{}_stops.pickle".format(pvd.agency)
+        args.input = "{}_stops.db".format(pvd.agency)
     log.debug("Stops input: '{}', mode: {}, city {}".format(args.input, mode, city))
-    with open(args.input, 'rb') as f:
-        d = pickle.load(f)
-    if "ost" in d.keys() and "pst" in d.keys():
-        if args.output == '-':
-            out = sys.stdout
+    with collection.load_collection(args.input) as d:
+        if "ost" in d.keys() and "pst" in d.keys():
+            fps = get_fingerprints(args)
+            with get_writer(args) as w:
+                if args.format == "mediawiki":
+                    mw.report_stops(w, d, mode=mode, city=city, fps=fps,
+                        radius=args.suggest_radius)
+                else:
+                    records.write_records(w, args.format, records.stop_fields,
+                        records.stop_records(d, mode=mode, city=city, fps=fps,
+                            radius=args.suggest_radius))
+            save_fingerprints(args, fps)
         else:
-            out = open(args.output, "wb")
-        mw.outfile = out
-        mw.report_stops(d, mode=mode, city=city)
-        if out and out != sys.stdout:
-            out.close()
-    else:
-        log.error("Incompatible pickle file")
+            log.error("Incompatible collection file")
 
 
 def sub_stations(args):
@@ -542,45 +864,160 @@ def sub_stations(args):
         log.error("Unrecognized transport mode '{}'.".format(args.filt1))
         sys.exit(1)
 
+    disable_network()
     if not args.input:
-        args.input = "{}_stations.pickle".format(pvd.agency)
+        args.input = "{}_stations.db".format(pvd.agency)
     log.debug("Stations input: '{}', mode: {}".format(args.input, mode))
-    with open(args.input, 'rb') as f:
-        d = pickle.load(f)
-    if "ostat" in d.keys() and "pstat" in d.keys():
-        if args.output == '-':
-            out = sys.stdout
+    with collection.load_collection(args.input) as d:
+        if "ostat" in d.keys() and "pstat" in d.keys():
+            fps = get_fingerprints(args)
+            with get_writer(args) as w:
+                if args.format == "mediawiki":
+                    mw.report_stations(w, d, mode=mode, fps=fps)
+                else:
+                    records.write_records(w, args.format, records.station_fields,
+                        records.station_records(d, mode=mode, fps=fps))
+            save_fingerprints(args, fps)
         else:
-            out = open(args.output, "wb")
-        mw.outfile = out
-        mw.report_stations(d, mode=mode)
-        if out and out != sys.stdout:
-            out.close()
-    else:
-        log.error("Incompatible pickle file")
-        sys.exit(2)
+            log.error("Incompatible collection file")
+            sys.exit(2)
 
 
 def sub_citybikes(args):
+    disable_network()
     if not args.input:
-        args.input = "{}_citybikes.pickle".format(pvd.agency)
+        args.input = "{}_citybikes.db".format(pvd.agency)
     log.debug("Citybikes input: '{}'".format(args.input))
-    with open(args.input, 'rb') as f:
-        d = pickle.load(f)
-    if "ocbs" in d.keys() and "pcbs" in d.keys():
-        if args.output == '-':
-            out = sys.stdout
+    with collection.load_collection(args.input) as d:
+        if "ocbs" in d.keys() and "pcbs" in d.keys():
+            fps = get_fingerprints(args)
+            with get_writer(args) as w:
+                if args.format == "mediawiki":
+                    mw.report_citybikes(w, d, fps=fps)
+                else:
+                    records.write_records(w, args.format, records.citybike_fields,
+                        records.citybike_records(d, fps=fps))
+            save_fingerprints(args, fps)
         else:
-            out = open(args.output, "wb")
-        mw.outfile = out
-        mw.report_citybikes(d)
-        if out and out != sys.stdout:
-            out.close()
+            log.error("Incompatible collection file")
+            sys.exit(2)
+
+
+# Collections and options set by sub_report_all(), read by report_job()
+# in worker processes forked after loading.
+report_data = {}
+
+def report_writer(fname):
+    """Return a ReportWriter for report file fname, split to pages if
+    max_page_size is set in report_data."""
+    if report_data.get("max_page_size", None):
+        return mw.PagedReportWriter(os.path.splitext(fname)[0],
+            report_data["max_page_size"])
     else:
-        log.error("Incompatible pickle file")
+        return mw.ReportWriter(open(fname, "w", encoding="utf-8"),
+            closefile=True)
+
+
+def report_job(job):
+    """Write a report page described by job tuple (kind, params, fname)."""
+    kind, params, fname = job
+    if kind == "routes":
+        with collection.load_collection(params["input"]) as routes:
+            check_route_collection(routes, params["input"])
+            with report_writer(fname) as w:
+                mw.report_routes(w, routes)
+        return fname
+    with report_writer(fname) as w:
+        if kind == "stops":
+            d, index = report_data["stops"]
+            mw.report_stops(w, d, mode=params["mode"], city=params["city"],
+                index=index)
+        elif kind == "stations":
+            mw.report_stations(w, report_data["stations"])
+        elif kind == "citybikes":
+            mw.report_citybikes(w, report_data["citybikes"])
+    return fname
+
+
+def sub_report_all(args):
+    disable_network()
+    os.makedirs(args.outdir, exist_ok=True)
+    report_data["max_page_size"] = args.max_page_size
+    jobs = []
+    for mode in osm.stoptags.keys():
+        fname = os.path.join(args.indir, "{}_{}.db".format(pvd.agency, mode))
+        if os.path.exists(fname):
+            jobs.append(("routes", { "input": fname },
+                os.path.join(args.outdir, "routes-{}.wiki".format(mode))))
+    for kind in ("stops", "stations", "citybikes"):
+        fname = os.path.join(args.indir, "{}_{}.db".format(pvd.agency, kind))
+        if not os.path.exists(fname):
+            log.warning("'{}' not found, skipping {} reports".format(fname, kind))
+            continue
+        log.info("Loading '{}'".format(fname))
+        d = collection.load_collection(fname, lazy=False)
+        if kind == "stops":
+            index = mw.stop_index(d)
+            report_data[kind] = (d, index)
+            for mode, city in sorted(index["pst"].keys(),
+              key=lambda k: (k[0] or "", k[1] or "")):
+                name = "-".join(["stops"] + [ x for x in (mode, city) if x ])
+                jobs.append((kind, { "mode": mode, "city": city },
+                    os.path.join(args.outdir, name + ".wiki")))
+        else:
+            report_data[kind] = d
+            jobs.append((kind, {},
+                os.path.join(args.outdir, kind + ".wiki")))
+    log.info("Writing {} reports to '{}'".format(len(jobs), args.outdir))
+    # Workers are forked, so that they share the loaded data
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs,
+      mp_context=multiprocessing.get_context("fork")) as ex:
+        futures = { ex.submit(report_job, job): job for job in jobs }
+        failed = 0
+        for f in concurrent.futures.as_completed(futures):
+            try:
+                log.debug("Wrote '{}'".format(f.result()))
+            except Exception as e:
+                log.error("Report '{}' failed: {!r}".format(futures[f][2], e))
+                failed += 1
+    if failed:
         sys.exit(2)
 
 
+def add_page_size_argument(subparser):
+    subparser.add_argument('--max-page-size', '-p', metavar='<chars>',
+        type=int, dest='max_page_size', default=None,
+        help="Split the report to pages '<output>-<n>.wiki' of about this size and write an index page to '<output>.wiki'")
+
+
+def add_fingerprint_arguments(subparser):
+    """Add arguments for reporting changed rows only to a subparser."""
+    subparser.add_argument('--fingerprints', '-f', metavar='<fingerprint-file>',
+        dest='fingerprints', default=None,
+        help="Only output table rows which have changed since the report which wrote this file, and update it. Use a separate file for each report page.")
+    subparser.add_argument('--change-list', '-c', metavar='<json-file>',
+        dest='change_list', default=None,
+        help='Write lists of added, changed and removed rows to a JSON file (requires --fingerprints)')
+
+
+def add_format_argument(subparser):
+    subparser.add_argument('--format', metavar='<format>', dest='format',
+        default='mediawiki', choices=['mediawiki'] + records.formats,
+        help="Output format: mediawiki (default), or {} with one record per table row".format(
+            ", ".join(records.formats)))
+
+
+def add_linesel_arguments(subparser):
+    """Add line selection arguments to a subparser."""
+    subparser.add_argument('--lines', '-l', metavar='<lineref>[,<lineref>|<start>..<stop>...]',
+        dest='lines', default=None,
+        help="Only process the given lines or line ranges, e.g. '550,551..560,9..'")
+    subparser.add_argument('--start', metavar='<lineref>', dest='start',
+        default=None, help='Only process lines from this one onwards, in line sort order')
+    subparser.add_argument('--stop', metavar='<lineref>', dest='stop',
+        default=None, help='Only process lines up to this one, in line sort order')
+
+
 if __name__ == '__main__' and '__file__' in globals ():
     parser = argparse.ArgumentParser()
     parser.add_argument('--version', '-v', action='version', version='0.0.1')
@@ -595,11 +1032,14 @@ if __name__ == '__main__' and '__file__' in globals ():
     parser_gpx.set_defaults(func=sub_gpx)
 
     parser_osmxml = subparsers.add_parser('osmxml', help='Output OSM XML snippets with stops and some tags for a given line.')
-    parser_osmxml.add_argument('line', metavar='<lineid>',
-        help='Line id to process.')
+    parser_osmxml.add_argument('line', metavar='<lineid>[,<lineid>...]',
+        help='Line id to process, or a comma separated list of line ids.')
     parser_osmxml.add_argument('mode', nargs='?', metavar='<mode>',
         default="bus",
         help='Transport mode: train, subway, tram, bus (default) or ferry')
+    parser_osmxml.add_argument('--input', '-i', metavar='<input-file>',
+        dest='input', default=None,
+        help="Look up stops from collected stops in a collection file (default '<provider>_stops.db')")
     parser_osmxml.set_defaults(func=sub_osmxml)
 
     parser_collect = subparsers.add_parser('collect',
@@ -612,14 +1052,50 @@ if __name__ == '__main__' and '__file__' in globals ():
         dest='interval_tags', help="Collect info for 'interval*' tags for routes")
     parser_collect.add_argument('--output', '-o', metavar='<output-file>',
         dest='output', default=None,
-        help="Direct output to file (default '<provider>_<mode_or_stops>.pickle')")
+        help="Direct output to a collection file (default '<provider>_<mode_or_stops>.db')")
+    parser_collect.add_argument('--osmdb', '-d', metavar='<osmdb-file>',
+        dest='osmdb', default=None,
+        help="Read OSM data from a local store created with 'osmdb init' instead of Overpass")
+    parser_collect.add_argument('--incremental', metavar='<previous-file>',
+        dest='incremental', default=None,
+        help="Copy routes which have not changed from a previous collection file, collect only the changed ones")
+    add_linesel_arguments(parser_collect)
+    parser_collect.add_argument('--resume', '-r', action='store_true',
+        dest='resume',
+        help="Continue an interrupted collect from its checkpoint file ('<output-file>.part')")
     parser_collect.set_defaults(func=sub_collect)
 
+    parser_osmdb = subparsers.add_parser('osmdb',
+        help='Create or update a local store of OSM data in the provider area')
+    parser_osmdb.add_argument('command', metavar='init | update',
+        choices=['init', 'update'],
+        help="'init' fills the store from Overpass, 'update' applies changes since the last update")
+    parser_osmdb.add_argument('file', metavar='<osmdb-file>',
+        help='OSM store file')
+    parser_osmdb.add_argument('--replication-url', '-r', metavar='<url>',
+        dest='replication_url', default=None,
+        help="Replication server URL (default {})".format(osmdb.default_replication_url))
+    parser_osmdb.add_argument('--change-file', '-c', metavar='<change-file>',
+        dest='change_files', action='append', default=None,
+        help='Apply an osmChange file or an Overpass augmented diff instead of replication files, can be given several times')
+    parser_osmdb.set_defaults(func=sub_osmdb)
+
+    parser_migrate = subparsers.add_parser('migrate',
+        help='Convert a pickle file from an earlier version to a collection file')
+    parser_migrate.add_argument('input', metavar='<pickle-file>',
+        help='Input file')
+    parser_migrate.add_argument('output', nargs='?', metavar='<collection-file>',
+        default=None, help="Output file (default input file name with a '.db' suffix)")
+    parser_migrate.set_defaults(func=sub_migrate)
+
     parser_routes = subparsers.add_parser('routes',
-        help='Output a mediawiki report on routes from previously collected data in pickle format.')
-    # TODO: Add start/stop limits by route ref
-    parser_routes.add_argument('file', metavar='<pickle-file>',
+        help='Output a mediawiki report on routes from previously collected data.')
+    parser_routes.add_argument('file', metavar='<collection-file>',
         help='Input file')
+    add_linesel_arguments(parser_routes)
+    add_fingerprint_arguments(parser_routes)
+    add_page_size_argument(parser_routes)
+    add_format_argument(parser_routes)
     parser_routes.add_argument('--interval-tags', '-n', action='store_true',
         dest='interval_tags', help='Also report on "interval*" tags')
     parser_routes.add_argument('--output', '-o', metavar='<output-file>',
@@ -627,26 +1103,29 @@ if __name__ == '__main__' and '__file__' in globals ():
     parser_routes.set_defaults(func=sub_routes)
 
     parser_stops = subparsers.add_parser('stops',
-        help='Output a mediawiki report on stops from previously collected data in pickle format, possibly limited by mode and/or city')
+        help='Output a mediawiki report on stops from previously collected data, possibly limited by mode and/or city')
     parser_stops.add_argument('--input', '-i', metavar='<input-file>',
-        dest='input', default=None, help="Read data from a pickle file (default '<provider>_stops.pickle')")
+        dest='input', default=None, help="Read data from a collection file (default '<provider>_stops.db')")
     parser_stops.add_argument('--output', '-o', metavar='<output-file>',
         dest='output', default='-', help='Direct output to file (default stdout)')
-#    parser_stops.add_argument('--format', '-f', metavar='<format>',
-#        dest='format', default='mediawiki',
-#        help='Output format: mediawiki (default), pickle')
     parser_stops.add_argument('filt1', nargs='?', metavar='<mode>',
         help='Only report on stops with given mode: {}'\
           .format(", ".join(osm.stoptags.keys())))
     parser_stops.add_argument('filt2', nargs='?', metavar='<city>',
         help='Only report on stops in given city: {}'\
           .format(", ".join(hsl.city2prefixes.keys())))
+    parser_stops.add_argument('--suggest-radius', metavar='<meters>',
+        dest='suggest_radius', type=float, default=mw.suggestion_radius,
+        help='Suggest OSM stops without ref within this distance for stops missing from OSM, 0 disables (default %(default)s)')
+    add_fingerprint_arguments(parser_stops)
+    add_page_size_argument(parser_stops)
+    add_format_argument(parser_stops)
     parser_stops.set_defaults(func=sub_stops)
 
     parser_stations = subparsers.add_parser('stations',
-        help='Output a mediawiki report on stations from previously collected data in pickle format, possibly limited by mode')
+        help='Output a mediawiki report on stations from previously collected data, possibly limited by mode')
     parser_stations.add_argument('--input', '-i', metavar='<input-file>',
-        dest='input', default=None, help="Read data from a pickle file (default '<provider>_stations.pickle')")
+        dest='input', default=None, help="Read data from a collection file (default '<provider>_stations.db')")
     parser_stations.add_argument('--output', '-o', metavar='<output-file>',
         dest='output', default='-', help='Direct output to file (default stdout)')
     parser_stations.add_argument('filt1', nargs='?', metavar='<mode>',
@@ -655,20 +1134,39 @@ if __name__ == '__main__' and '__file__' in globals ():
 #    parser_stations.add_argument('filt2', nargs='?', metavar='<city>',
 #        help='Only report on stations in given city: {}'\
 #          .format(", ".join(hsl.city2prefixes.keys())))
+    add_fingerprint_arguments(parser_stations)
+    add_page_size_argument(parser_stations)
+    add_format_argument(parser_stations)
     parser_stations.set_defaults(func=sub_stations)
 
     parser_citybikes = subparsers.add_parser('citybikes',
-        help='Output a mediawiki report on citybike stations from previously collected data in pickle format')
+        help='Output a mediawiki report on citybike stations from previously collected data')
     parser_citybikes.add_argument('--input', '-i', metavar='<input-file>',
-        dest='input', default=None, help="Read data from a pickle file (default '<provider>_citybikes.pickle')")
+        dest='input', default=None, help="Read data from a collection file (default '<provider>_citybikes.db')")
     parser_citybikes.add_argument('--output', '-o', metavar='<output-file>',
         dest='output', default='-', help='Direct output to file (default stdout)')
+    add_fingerprint_arguments(parser_citybikes)
+    add_page_size_argument(parser_citybikes)
+    add_format_argument(parser_citybikes)
     parser_citybikes.set_defaults(func=sub_citybikes)
 
 #    parser_fullreport = subparsers.add_parser('fullreport',
 #        help='Create a report for all lines.')
 #    parser_fullreport.set_defaults(func=sub_fullreport)
 
+    parser_report_all = subparsers.add_parser('report-all',
+        help='Output all route, stop, station and citybike reports from previously collected data to a directory')
+    parser_report_all.add_argument('outdir', metavar='<output-dir>',
+        help='Directory for report files')
+    parser_report_all.add_argument('--input-dir', '-i', metavar='<input-dir>',
+        dest='indir', default='.',
+        help="Directory with collection files named '<provider>_<mode_or_stops>.db' (default current directory)")
+    parser_report_all.add_argument('--jobs', '-j', metavar='<n>', type=int,
+        dest='jobs', default=None,
+        help='Number of worker processes (default number of CPUs)')
+    add_page_size_argument(parser_report_all)
+    parser_report_all.set_defaults(func=sub_report_all)
+
     parser_help = subparsers.add_parser('help',
         help="Show help for a subcommand")
     parser_help.add_argument('subcmd', metavar='<subcommand>', nargs='?',
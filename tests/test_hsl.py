@@ -0,0 +1,33 @@
+# Copyright (C) 2018-2021 Teemu Ikonen <tpikonen@gmail.com>
+
+# This file is part of Taival.
+# Taival is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License version 3 as published by the
+# Free Software Foundation. See the file COPYING for license text.
+
+import pytest
+import hsl
+
+
+@pytest.mark.parametrize("abbr, full", hsl.synonyms)
+def test_synonyms_match(abbr, full):
+    assert hsl.names_match(full, abbr)
+    assert hsl.names_match("Ala " + full + " 2", "Ala " + abbr + " 2")
+
+
+def test_abbreviated_osm_name_does_not_match():
+    assert not hsl.names_match("Kivit.", "Kivitie")
+    assert not hsl.names_match("Ala p. 2", "Ala puisto 2")
+
+
+def test_ambiguous_abbreviation():
+    assert hsl.names_match("Myyrmäen urheilukenttä", "Myyrmäen urheiluk.")
+    assert hsl.names_match("Myyrmäen urheilukeskus", "Myyrmäen urheiluk.")
+    assert not hsl.names_match("Myyrmäen urheilukenttä", "Myyrmäen urheilukeskus")
+
+
+def test_synonyms_abbreviate_suffixes():
+    assert hsl.names_match("Kivitie", "Kivit.")
+    assert hsl.names_match("Sibeliuksen puisto", "Sibeliuksen p.")
+    assert hsl.names_match("Kaisaniemenpuisto", "Kaisaniemenp.")
+    assert not hsl.names_match("Kivitien koulu", "Kivit.n koulu")
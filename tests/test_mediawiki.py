@@ -0,0 +1,32 @@
+# Copyright (C) 2018-2021 Teemu Ikonen <tpikonen@gmail.com>
+
+# This file is part of Taival.
+# Taival is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License version 3 as published by the
+# Free Software Foundation. See the file COPYING for license text.
+
+import digiroad
+import mediawiki as mw
+from test_reports import stops_data
+
+
+def test_findr_lookup_once(monkeypatch):
+    monkeypatch.setattr(digiroad, "_stops", [
+        { "stop_id": "111", "stop_name": "Muu", "stop_lat": "60.0001", "stop_lon": "24.0" },
+        { "stop_id": "112", "stop_name": "Yksi", "stop_lat": "60.0002", "stop_lon": "24.0" },
+        { "stop_id": "333", "stop_name": "Kolme", "stop_lat": "61.0", "stop_lon": "25.0" } ])
+    monkeypatch.setattr(digiroad, "_index", None)
+    monkeypatch.setattr(mw, "stop_checks", mw.stop_checks + [("findr", mw.check_findr)])
+    queries = []
+    stops_near = digiroad.stops_near
+    def counting_stops_near(latlons, *args, **kwargs):
+        queries.append(latlons)
+        return stops_near(latlons, *args, **kwargs)
+    monkeypatch.setattr(digiroad, "stops_near", counting_stops_near)
+    sd = stops_data()
+    stops, _ = mw.select_stops(sd)
+    mw.add_stop_distances(sd, stops)
+    assert len(queries) == 1
+    os = sd["ost"]["H0001"][0]
+    assert mw.check_findr(os, sd["pst"]["bus"]["H0001"])[1] == "112"
+    assert len(queries) == 1
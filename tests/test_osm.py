@@ -0,0 +1,63 @@
+# Copyright (C) 2018-2021 Teemu Ikonen <tpikonen@gmail.com>
+
+# This file is part of Taival.
+# Taival is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License version 3 as published by the
+# Free Software Foundation. See the file COPYING for license text.
+
+import io, json
+import overpy
+import pytest
+import osm
+
+
+class Response:
+    def __init__(self, status_code, data=None):
+        self.status_code = status_code
+        self.raw = io.BytesIO(json.dumps(data).encode("utf-8"))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        pass
+
+    def raise_for_status(self):
+        assert self.status_code == 200
+
+    def json(self):
+        return json.loads(self.raw.getvalue())
+
+
+elements = [ { "type": "node", "id": 1, "lat": 60.0, "lon": 24.0 } ]
+timed_out = "runtime error: Query timed out in \"query\" at line 3 after 180 seconds."
+
+
+@pytest.fixture
+def responses(monkeypatch):
+    responses = []
+    def post(url, data, stream, timeout):
+        assert timeout
+        return responses.pop(0)
+    monkeypatch.setattr(osm.requests, "post", post)
+    monkeypatch.setattr(osm.time, "sleep", lambda t: None)
+    return responses
+
+
+def test_retry_busy_server(responses):
+    responses.extend([ Response(504), Response(429),
+        Response(200, { "elements": elements }) ])
+    assert list(osm.apiquery_elements("q")) == elements
+    assert not responses
+
+
+def test_runtime_error_remark(responses):
+    data = { "elements": elements, "remark": timed_out }
+    responses.extend([ Response(200, data), Response(200, data) ])
+    with pytest.raises(overpy.exception.OverpassRuntimeError):
+        list(osm.apiquery_elements("q"))
+    with pytest.raises(overpy.exception.OverpassRuntimeError):
+        osm.apiquery_json("q")
@@ -0,0 +1,124 @@
+# Copyright (C) 2018-2021 Teemu Ikonen <tpikonen@gmail.com>
+
+# This file is part of Taival.
+# Taival is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License version 3 as published by the
+# Free Software Foundation. See the file COPYING for license text.
+
+import io
+import pytest
+import osmdb
+
+
+def node(nid, lat, lon, tags=None, version=1):
+    e = { "type": "node", "id": nid, "version": version, "lat": lat, "lon": lon }
+    if tags:
+        e["tags"] = tags
+    return e
+
+
+def way(wid, nodes, tags=None, version=1):
+    e = { "type": "way", "id": wid, "version": version, "nodes": nodes }
+    if tags:
+        e["tags"] = tags
+    return e
+
+
+# A route on way 10 with a platform node 200 and a stop node 201
+seed = [
+    node(100, 60.00, 24.00), node(101, 60.01, 24.00), node(102, 60.02, 24.00),
+    node(200, 60.00, 24.001, { "highway": "bus_stop", "ref": "H0001" }),
+    node(201, 60.02, 24.001, { "highway": "bus_stop", "ref": "H0002" }),
+    way(10, [100, 101, 102], { "highway": "primary" }),
+    { "type": "relation", "id": 1, "version": 1,
+        "tags": { "type": "route", "route": "bus", "ref": "10" },
+        "members": [ { "type": "way", "ref": 10, "role": "" },
+            { "type": "node", "ref": 200, "role": "platform" },
+            { "type": "node", "ref": 201, "role": "platform" } ] },
+]
+
+# Elements only available from the fetch function: a way added to the
+# route and the nodes of a way which becomes a platform.
+remote = [
+    node(110, 60.02, 24.01), node(111, 60.03, 24.01),
+    way(11, [102, 110, 111], { "highway": "primary" }),
+    node(120, 60.03, 24.02), node(121, 60.03, 24.03),
+    way(12, [120, 121], { "public_transport": "platform", "highway": "platform" }),
+]
+
+osc = b"""<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6">
+  <create>
+    <node id="103" version="1" lat="60.03" lon="24.0"/>
+    <node id="900" version="1" lat="10.0" lon="10.0"/>
+    <way id="12" version="1">
+      <nd ref="120"/><nd ref="121"/>
+      <tag k="public_transport" v="platform"/><tag k="highway" v="platform"/>
+    </way>
+  </create>
+  <modify>
+    <way id="10" version="2">
+      <nd ref="100"/><nd ref="101"/><nd ref="102"/><nd ref="103"/>
+      <tag k="highway" v="primary"/>
+    </way>
+    <node id="200" version="2" lat="60.0" lon="24.001">
+      <tag k="highway" v="bus_stop"/><tag k="ref" v="H0011"/>
+    </node>
+    <relation id="1" version="2">
+      <member type="way" ref="10" role=""/>
+      <member type="way" ref="11" role=""/>
+      <member type="node" ref="200" role="platform"/>
+      <tag k="type" v="route"/><tag k="route" v="bus"/><tag k="ref" v="10"/>
+    </relation>
+  </modify>
+  <delete>
+    <node id="201" version="2"/>
+  </delete>
+</osmChange>
+"""
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = osmdb.OSMDB(str(tmp_path / "osm.db"),
+        tfilters=[ { "public_transport": "platform" } ])
+    db.load(seed)
+    db.set_meta("bbox", [59.9, 23.9, 60.1, 24.1])
+    yield db
+    db.close()
+
+
+def test_apply_change(db):
+    queries = []
+    def fetch(q):
+        queries.append(q)
+        return { "elements": remote }
+    db.fetch = fetch
+    nmod, ndel = db.apply_change(io.BytesIO(osc))
+    assert ndel == 1
+    assert len(queries) == 1
+    assert "way(id:11);" in queries[0]
+    assert "way(id:12)(59.9,23.9,60.1,24.1);" in queries[0]
+    assert db.get("node", 103)["lat"] == 60.03
+    assert db.get("node", 900) is None
+    assert db.get("node", 201) is None
+    assert db.get("node", 200)["tags"]["ref"] == "H0011"
+    assert db.get("way", 10)["nodes"] == [100, 101, 102, 103]
+    assert [ m["ref"] for m in db.get("relation", 1)["members"] ] == [10, 11, 200]
+    assert db.get("way", 11)["nodes"] == [102, 110, 111]
+    assert db.get("node", 111) is not None
+    assert db.get("node", 121) is not None
+    platforms = db.elements([ { "public_transport": "platform" } ])
+    assert [ e["id"] for e in platforms ] == [12]
+    assert not db.missing(db.recurse_down([ db.get("relation", 1) ]))
+
+
+def test_missing_members_without_fetch(db):
+    with pytest.raises(osmdb.MissingElementsError, match="osmdb init"):
+        db.apply_change(io.BytesIO(osc))
+
+
+def test_missing_members_not_fetched(db):
+    db.fetch = lambda q: { "elements": remote[3:] }
+    with pytest.raises(osmdb.MissingElementsError, match="osmdb init"):
+        db.apply_change(io.BytesIO(osc))
@@ -0,0 +1,52 @@
+# Copyright (C) 2018-2021 Teemu Ikonen <tpikonen@gmail.com>
+
+# This file is part of Taival.
+# Taival is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License version 3 as published by the
+# Free Software Foundation. See the file COPYING for license text.
+
+import csv, io
+import records
+from test_reports import stations_data, citybikes_data
+
+
+def csv_rows(fields, recs):
+    f = io.StringIO()
+    records.write_records(f, "csv", fields, recs)
+    return list(csv.DictReader(io.StringIO(f.getvalue())))
+
+
+def test_extra_station_names():
+    sd = stations_data()
+    sd["ostat"]["bus"].append({ "x:type": "w", "x:id": 6,
+        "x:latlon": (61.0, 25.0), "name": "Toinen", "amenity": "bus_station" })
+    rows = csv_rows(records.station_fields, records.station_records(sd))
+    assert [ (r["match"], r["osm_name"]) for r in rows ] == \
+        [ ("ok", "Terminaali"), ("extra", "Toinen") ]
+
+
+def test_extra_citybike_names():
+    sd = citybikes_data()
+    sd["ocbs"]["002"] = [ { "x:type": "n", "x:id": 8, "x:latlon": (60.1, 24.1),
+        "amenity": "bicycle_rental", "ref": "002", "name": "Kakkonen" } ]
+    sd["orest"] = { 9: { "x:type": "n", "x:id": 9, "x:latlon": (60.2, 24.2),
+        "amenity": "bicycle_rental", "name": "Kolmonen" } }
+    rows = csv_rows(records.citybike_fields, records.citybike_records(sd))
+    assert [ (r["match"], r["osm_name"]) for r in rows ] == \
+        [ ("ok", "Asema"), ("extra", "Kakkonen"), ("extra", "Kolmonen") ]
+
+
+def test_route_status_maybe(monkeypatch):
+    from test_reports import routes_data
+    md = routes_data()
+    cells = [ (records.mw.style_ok, "10") ] \
+        + [ (records.mw.style_ok, "") ] * len(records.route_cells)
+    cells[2] = (records.mw.style_maybe, "?")
+    matchok = True
+    def routeline_cells(md, ld, networkname, platformidx):
+        ld["details"] = ""
+        return (cells, matchok)
+    monkeypatch.setattr(records.mw, "routeline_cells", routeline_cells)
+    assert [ r["status"] for r in records.route_records(md) ] == ["maybe"]
+    matchok = False
+    assert [ r["status"] for r in records.route_records(md) ] == ["problem"]
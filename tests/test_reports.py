@@ -0,0 +1,245 @@
+# Copyright (C) 2018-2021 Teemu Ikonen <tpikonen@gmail.com>
+
+# This file is part of Taival.
+# Taival is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License version 3 as published by the
+# Free Software Foundation. See the file COPYING for license text.
+
+# Run the report subcommands on small fixture collections in a
+# subprocess, where networking is disabled before taival is imported.
+
+import os, pickle, sqlite3, subprocess, sys
+import overpy
+import pytest
+import collection
+
+srcdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+offline_main = """
+import os, runpy, sys
+sys.argv = sys.argv[1:]
+sys.path.insert(0, os.path.dirname(sys.argv[0]))
+import util
+util.disable_network()
+runpy.run_path(sys.argv[0], run_name="__main__")
+"""
+
+
+def run_taival(*args, cwd):
+    return subprocess.run([sys.executable, "-c", offline_main,
+        os.path.join(srcdir, "taival.py")] + list(args),
+        cwd=cwd, capture_output=True, text=True)
+
+
+def relation(relid, tags, roles=()):
+    return overpy.Relation(rel_id=relid, tags=tags, attributes={},
+        members=[ overpy.RelationNode(ref=relid * 10 + i, role=r, attributes={})
+            for i, r in enumerate(roles) ])
+
+
+def route_line(ref):
+    shape = [ (60.0 + 0.001 * k, 24.0) for k in range(50) ]
+    platforms = [ (60.0 + 0.01 * k, 24.0, "H{:04d}".format(k), "P{}".format(k))
+        for k in range(5) ]
+    osmplatforms = [ p + ("platform",) for p in platforms ]
+    rels = [ relation(100 + d, { "type": "route", "route": "bus", "ref": ref,
+        "name": "{}: A - B".format(ref), "network": "HSL", "from": "A",
+        "to": "B" }, ["platform"] * 5) for d in range(2) ]
+    return {
+        "lineref": ref,
+        "mode": "bus",
+        "rels": rels,
+        "rm_rels": [],
+        "codes": [ "HSL:{}:{}:01".format(ref, d) for d in range(2) ],
+        "osm2hsl": [0, 1],
+        "hsl2osm": [0, 1],
+        "id2hslindex": { r.id: d for d, r in enumerate(rels) },
+        "htags": { "shortName": ref, "longName": "A-B", "gtfsId": "HSL:" + ref },
+        "osmshapes": [shape, shape[::-1]],
+        "osmgaps": [False, False],
+        "osmplatforms": [osmplatforms, osmplatforms[::-1]],
+        "osmstopcounts": [(0, 5), (0, 5)],
+        "hslshapes": [shape, shape[::-1]],
+        "hslplatforms": [platforms, platforms[::-1]],
+    }
+
+
+def route_result(ref):
+    """Return an overpy result with two route relations of line ref, on a
+    single way, with members like in a collection from an older version,
+    which did not store the values derived from them."""
+    nodes = [ { "type": "node", "id": 1000 + k, "lat": 60.0 + 0.001 * k,
+        "lon": 24.0, "tags": {} } for k in range(50) ]
+    platforms = [ { "type": "node", "id": 2000 + k, "lat": 60.0 + 0.01 * k,
+        "lon": 24.0, "tags": { "highway": "bus_stop",
+            "ref": "H{:04d}".format(k), "name": "P{}".format(k) } }
+        for k in range(5) ]
+    way = { "type": "way", "id": 3000, "nodes": [ n["id"] for n in nodes ],
+        "tags": { "highway": "primary" } }
+    rels = [ { "type": "relation", "id": 100 + d,
+        "tags": { "type": "route", "route": "bus", "ref": ref,
+            "name": "{}: A - B".format(ref), "network": "HSL", "from": "A",
+            "to": "B" },
+        "members": [ { "type": "way", "ref": 3000, "role": "" } ]
+            + [ { "type": "node", "ref": p["id"], "role": "platform" }
+                for p in (platforms if d == 0 else platforms[::-1]) ] }
+        for d in range(2) ]
+    return overpy.Result.from_json(
+        { "elements": nodes + platforms + [way] + rels })
+
+
+def routes_data():
+    return {
+        "mode": "bus",
+        "shapetol": 30.0,
+        "interval_tags": False,
+        "agency": "HSL",
+        "agencyurl": "https://www.hsl.fi/",
+        "modecolors": {},
+        "osmdict": { "10": ["https://www.openstreetmap.org/relation/100"] },
+        "hsldict": { "10": "https://reittiopas.hsl.fi/linjat/HSL:10" },
+        "refless": [],
+        "wasroutes": {},
+        "disroutes": {},
+        "networks": ["HSL"],
+        "hsl_localbus": {},
+        "osm_minibusdict": {},
+        "failed": [],
+        "lines": { "10": route_line("10") },
+        "fingerprints": {},
+    }
+
+
+def osm_stop(ref, name, latlon, xid):
+    return { "x:type": "n", "x:id": xid, "x:latlon": latlon,
+        "x:modes": ["bus"], "highway": "bus_stop", "ref": ref, "name": name }
+
+
+def provider_stop(code, name, latlon):
+    return { "code": code, "gtfsId": "HSL:" + code, "name": name,
+        "mode": "bus", "latlon": latlon, "zoneId": "A", "namecount": 1,
+        "wheelchairBoarding": "POSSIBLE" }
+
+
+def stops_data():
+    return {
+        "ost": { "H0001": [ osm_stop("H0001", "Yksi", (60.0, 24.0), 1) ],
+            "E0002": [ osm_stop("E0002", "Kaksi", (60.1, 24.1), 2) ] },
+        "rst": { 3: osm_stop(None, "Kolme", (60.2, 24.2), 3) },
+        "pst": { "bus": {
+            "H0001": provider_stop("H0001", "Yksi", (60.0, 24.0)),
+            "V0003": provider_stop("V0003", "Kolme", (60.2001, 24.2)) } },
+        "pcl": {},
+        "agency": "HSL",
+    }
+
+
+def stations_data():
+    return {
+        "ostat": { "bus": [ { "x:type": "n", "x:id": 5,
+            "x:latlon": (60.0, 24.0), "name": "Terminaali",
+            "amenity": "bus_station" } ] },
+        "pstat": { "bus": [ { "gtfsId": "HSL:1000", "name": "Terminaali",
+            "latlon": (60.0, 24.0), "mode": "bus" } ] },
+        "agency": "HSL",
+    }
+
+
+def citybikes_data():
+    return {
+        "ocbs": { "001": [ { "x:type": "n", "x:id": 7, "x:latlon": (60.0, 24.0),
+            "amenity": "bicycle_rental", "ref": "001", "name": "Asema",
+            "capacity": "10" } ] },
+        "orest": {},
+        "pcbs": { "001": { "stationId": "001", "name": "Asema",
+            "latlon": (60.0, 24.0), "networks": ["smoove"], "state": "Station on",
+            "capacity": 10 } },
+        "agency": "HSL",
+    }
+
+
+@pytest.fixture(scope="module")
+def datadir(tmp_path_factory):
+    d = tmp_path_factory.mktemp("data")
+    collection.save_collection(str(d / "HSL_bus.db"), routes_data())
+    collection.save_collection(str(d / "HSL_stops.db"), stops_data())
+    collection.save_collection(str(d / "HSL_stations.db"), stations_data())
+    collection.save_collection(str(d / "HSL_citybikes.db"), citybikes_data())
+    return d
+
+
+@pytest.mark.parametrize("args", [
+    ["routes", "HSL_bus.db"],
+    ["routes", "HSL_bus.db", "--format", "jsonl"],
+    ["stops", "-i", "HSL_stops.db"],
+    ["stops", "-i", "HSL_stops.db", "bus", "Helsinki"],
+    ["stops", "-i", "HSL_stops.db", "--format", "csv"],
+    ["stations", "-i", "HSL_stations.db"],
+    ["stations", "-i", "HSL_stations.db", "--format", "jsonl"],
+    ["citybikes", "-i", "HSL_citybikes.db"],
+    ["citybikes", "-i", "HSL_citybikes.db", "--format", "csv"],
+])
+def test_report_offline(datadir, args):
+    p = run_taival(*args, cwd=datadir)
+    assert p.returncode == 0, p.stderr
+    assert p.stdout
+    assert "NetworkAccessError" not in p.stderr
+
+
+def test_report_all_offline(datadir, tmp_path):
+    p = run_taival("report-all", "--input-dir", str(datadir), str(tmp_path),
+        cwd=datadir)
+    assert p.returncode == 0, p.stderr
+    assert (tmp_path / "routes-bus.wiki").stat().st_size > 0
+    assert (tmp_path / "stops.wiki").stat().st_size > 0
+    assert (tmp_path / "stations.wiki").stat().st_size > 0
+    assert (tmp_path / "citybikes.wiki").stat().st_size > 0
+
+
+def test_collection_closed(datadir):
+    with collection.load_collection(str(datadir / "HSL_stops.db")) as d:
+        store = d.store
+        assert d["ost"]["H0001"][0]["name"] == "Yksi"
+    with pytest.raises(sqlite3.ProgrammingError):
+        store.conn.execute("SELECT 1")
+
+
+def test_stale_routes_rejected(tmp_path):
+    d = routes_data()
+    del d["lines"]["10"]["osmplatforms"]
+    collection.save_collection(str(tmp_path / "old.db"), d)
+    p = run_taival("routes", "old.db", cwd=tmp_path)
+    assert p.returncode == 2
+    assert "older version" in p.stderr
+
+
+def test_migrate_old_routes(tmp_path):
+    d = routes_data()
+    ld = d["lines"]["10"]
+    ld["rels"] = route_result("10").relations
+    for k in collection.route_line_keys:
+        del ld[k]
+    pfile = tmp_path / "old.pickle"
+    with open(pfile, "wb") as f:
+        pickle.dump(d, f)
+    p = run_taival("migrate", str(pfile), cwd=tmp_path)
+    assert p.returncode == 0, p.stderr
+    md = collection.load_collection(str(tmp_path / "old.db"), lazy=False)
+    ld = md["lines"]["10"]
+    assert ld["osmstopcounts"] == [(0, 5), (0, 5)]
+    assert ld["osmgaps"] == [False, False]
+    assert [ p[2] for p in ld["osmplatforms"][1] ] == \
+        [ "H{:04d}".format(k) for k in range(4, -1, -1) ]
+    assert ld["osmshapes"][0][0] == [60.0, 24.0]
+    assert ld["osmshapes"][1][0] == [60.049, 24.0]
+    p = run_taival("routes", "old.db", cwd=tmp_path)
+    assert p.returncode == 0, p.stderr
+    assert p.stdout
+    assert "NetworkAccessError" not in p.stderr
+
+
+def test_network_is_disabled(tmp_path):
+    # gpx queries the provider API, which must fail here
+    p = run_taival("gpx", "10", cwd=tmp_path)
+    assert p.returncode != 0
+    assert "NetworkAccessError" in p.stderr
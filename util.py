@@ -5,7 +5,7 @@
 # terms of the GNU Affero General Public License version 3 as published by the
 # Free Software Foundation. See the file COPYING for license text.
 
-import re, csv
+import re, csv, difflib, socket
 from collections import defaultdict
 from math import radians, degrees, cos, sin, asin, sqrt
 
@@ -32,6 +32,23 @@ def ddl_uniq_key_merge(m1, m2, ukey):
                 m1[k].append(v)
 
 
+class NetworkAccessError(RuntimeError):
+    """Raised on network access after disable_network() is called."""
+    pass
+
+
+def disable_network():
+    """Make all later socket connections and name lookups in this process
+    raise NetworkAccessError. Used to make sure that reports are made from
+    collected data only."""
+    def guard(*args, **kwargs):
+        raise NetworkAccessError("Network access attempted in offline mode")
+    socket.socket.connect = guard
+    socket.socket.connect_ex = guard
+    socket.create_connection = guard
+    socket.getaddrinfo = guard
+
+
 def linesortkey(x):
     """Key function for list.sort() for correct line name sorting."""
     num = ''
@@ -44,6 +61,37 @@ def linesortkey(x):
     #return (len([c for c in x if c.isdigit()]), x) # old version
 
 
+def parse_linespec(spec):
+    """Parse a line selection like '550,551..560,9..' to a list of
+    (start, stop) tuples, where start and stop are line refs or None for
+    an open end. A single line ref x gives (x, x)."""
+    out = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        if ".." in item:
+            start, stop = item.split("..", 1)
+            out.append((start.strip() or None, stop.strip() or None))
+        else:
+            out.append((item, item))
+    return out
+
+
+def select_lines(lines, spec=None, start=None, stop=None):
+    """Return line refs in lines selected by a line selection spec (see
+    parse_linespec()) and between start and stop, inclusive, in the order
+    given by linesortkey(). The returned list is sorted by linesortkey()."""
+    def in_range(x, a, b):
+        return (a is None or linesortkey(x) >= linesortkey(a)) \
+          and (b is None or linesortkey(x) <= linesortkey(b))
+    ranges = parse_linespec(spec) if spec else [(None, None)]
+    out = [ x for x in lines if in_range(x, start, stop)
+        and any(in_range(x, a, b) for a, b in ranges) ]
+    out.sort(key=linesortkey)
+    return out
+
+
 # Haversine function nicked from: https://stackoverflow.com/questions/4913349/haversine-formula-in-python-bearing-and-distance-between-two-gps-points
 def haversine(p1, p2):
     """
@@ -71,6 +119,14 @@ def inv_haversine(d):
     return degrees(d/r)
 
 
+def name_similarity(a, b):
+    """Return the similarity of names a and b as a number between 0 and 1,
+    ignoring case. Missing names have similarity 0."""
+    if not a or not b:
+        return 0.0
+    return difflib.SequenceMatcher(None, a.lower(), b.lower()).ratio()
+
+
 def test_osm_shapes_have_v1_roles(rels):
     """Return True any of the relations in rels contain members with
     'forward' or 'backward' roles."""